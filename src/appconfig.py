@@ -9,21 +9,83 @@ wifi_pwd = 'Replace eith he SSID password'
 # Log parameters
 APPLOG_DEFAULT_MSGSTACK_SIZE = 20
 APPLOG_LOGFILE = "app.log"
+APPLOG_CONSOLE = False # Print log messages on standard output, each message is then formatted when it is logged
+APPLOG_STRIP_TRACE = False # Remove the trace messages from the code when it is compiled, set in boot.py
+APPLOG_FLUSH_SIZE = 512 # Bytes of permanent messages kept in memory before they are written to the log file
+APPLOG_FLUSH_INTERVAL = 60 # Max seconds a permanent message waits to be written to the log file
+APPLOG_LOG_SIZE = 32768 # Max bytes used by the log file segments together
+APPLOG_LOG_SEGMENTS = 4 # Number of log file segments, app.log, app.log.1...
+APPLOG_MAX_MSG = 200 # Max characters of a permanent message saved in the log file
 
 #Network connected led
 wifi_connected_pin = 15
+NETCONN_POLL_INTERVAL = 0.5 # Seconds between two looks at the WiFi connection
+NETCONN_CONNECT_TIMEOUT = 30 # Seconds to get connected before the connect is given up
+NETCONN_RECONNECT_MIN = 2 # Seconds before the first connect again after a failed connect, doubled at each failure
+NETCONN_RECONNECT_MAX = 120 # Max seconds between two connects
+NETCONN_SAMPLE_INTERVAL = 60 # Seconds between two records of the signal strength
+NETCONN_HISTORY_SIZE = 60 # Number of records of the connection kept in memory, see /api/network
 
 #WebServer parameters
 listen_port = 80
+WEBSERVER_BACKLOG = 2 # Max number of connections waiting to be accepted
+WEBSERVER_CHUNK_SIZE = 256 # Bytes buffered before the web page is written to the client
+WEBSERVER_PAGE_CACHE_SIZE = 6144 # Max size in bytes of the cached web page, 0 disables the cache
+WEBSERVER_PAGE_MAX_AGE = 60 # Seconds the cached web page and its ETag are reused before the uptime and memory figures are rendered again
+WEBSERVER_MAX_CONNECTIONS = 4 # Clients served at the same time, more clients get 503 Service Unavailable
+WEBSERVER_MAX_HEADERS = 32 # Max number of header lines in a request
+WEBSERVER_MAX_LINE = 512 # Max bytes of the request line or of a header line, longer lines get 431
+WEBSERVER_REQUEST_TIMEOUT = 5 # Seconds for a client to send a complete request
+WEBSERVER_RESPONSE_TIMEOUT = 10 # Seconds for a response to be written to a client
+WEBSERVER_KEEPALIVE = True # Keep HTTP/1.1 connections open between requests
+WEBSERVER_KEEPALIVE_TIMEOUT = 5 # Seconds an idle kept open connection waits for the next request
+WEBSERVER_KEEPALIVE_MAX = 100 # Max number of requests on a kept open connection
+WEBSERVER_MAX_EVENT_CLIENTS = 2 # Clients connected to /events at the same time
+WEBSERVER_EVENTS_PING = 15 # Seconds between keep alive comments to clients connected to /events
+
+# Seconds between housekeeping runs (garbage collection)
+HOUSEKEEPING_INTERVAL = 10
 
 #DHT11 Sensor PIN
 dht11_pin = 28
 DHT11_POLL_INTERVALL= 6 #seconds
+DHT11_HISTORY_SIZE = 240 # Number of measures kept in memory
+DHT11_CAPTURE = "python" # How pulses are captured: "python", "native", "viper" or "pulse"
+DHT11_RETRIES = 2 # Retries when a read from the sensor fails
+DHT11_MIN_INTERVAL_MS = 1000 # Min milliseconds between the starts of two reads, the sensor samples once a second
+DHT11_MEDIAN_WINDOW = 3 # The measures reported are the median of this many reads, 1 turns the filter off
 
 #MQTT parameters
 MQTT_BROKER = "io.adafruit.com" # MQTT broker IP address or DNS  
 MQTT_PORT = 1883
-MQTT_SUBSCRIBE_TOPIC = b"Replace with the topic"
-MQTT_PUBLISH_TOPIC = b"Replace with the topic"
+MQTT_SUBSCRIBE_TOPIC = b"" # Topic of the LED commands ON/OFF, empty for no subscription
+MQTT_PUBLISH_TOPIC = b"Replace with the topic" # Temperature
+MQTT_HUMIDITY_TOPIC = b"Replace with the topic"
+MQTT_GROUP_TOPIC = b"Replace with the group topic" # username/groups/<group> for Adafruit
+MQTT_PAYLOAD = "single" # "single" a message per measure, "json" or "binary" all values in one message, see mqtt_payload.py
+MQTT_BATCH = 1 # Publish cycles sent in one "json" or "binary" message, Adafruit groups take 1
 MQTT_USERNAME = "Replace with the username"
 MQTT_PASSWORD = "Replace with the password"
+MQTT_KEEPALIVE = 60 # Seconds, the broker closes the connection when nothing is received for 1.5 times this period
+MQTT_SOCKET_TIMEOUT = 5 # Seconds to wait for the broker when sending or receiving a packet
+MQTT_PING_TIMEOUT = 10 # Seconds to wait for the answer to a ping before the connection is closed
+MQTT_RECONNECT_MIN = 2 # Seconds before the first reconnect, doubled for each failed connect
+MQTT_RECONNECT_MAX = 300 # Max seconds between reconnects
+MQTT_SUPERVISE_INTERVAL = 1 # Seconds between checks of the connection to the broker
+MQTT_QOS = 0 # QoS of the measures published, 1 to have the broker acknowledge each measure
+MQTT_MAX_INFLIGHT = 8 # QoS 1 messages sent and not yet acknowledged, publishing waits when the window is full
+MQTT_RETRIES = 2 # Times a QoS 1 message not acknowledged is sent again
+MQTT_TEMPERATURE_DEADBAND = 2.0 # Degrees the temperature changes before it is published
+MQTT_TEMPERATURE_RATE = 1.0 # Degrees per minute, a faster change is published sooner
+MQTT_HUMIDITY_DEADBAND = 4.0 # Percent the humidity changes before it is published
+MQTT_HUMIDITY_RATE = 3.0 # Percent per minute, a faster change is published sooner
+MQTT_HEARTBEAT = 600 # Max seconds between two publishes of a measure, even if it doesn't change
+MQTT_MIN_SPACING = 60 # Min seconds between two publishes of a measure
+MQTT_QUEUE_FILE = "mqtt.queue" # Measures kept while the broker can't be reached
+MQTT_QUEUE_SIZE = 16384 # Max bytes used by the queue on the flash
+MQTT_QUEUE_RAM_SIZE = 2048 # Bytes of RAM used by the queue when the flash can't be used
+MQTT_QUEUE_SLOT = 64 # Bytes per queued measure, room for the topic and the value, checked at startup for "json" and "binary" payloads
+MQTT_QUEUE_BATCH = 10 # Queued measures sent per publish interval
+MQTT_QUEUE_SPACING = 2 # Seconds between queued measures sent, Adafruit allows 30 messages a minute
+MQTT_TELEMETRY_TOPIC = b"" # Topic of the counters of the network and MQTT connections, empty turns the telemetry off
+MQTT_TELEMETRY_INTERVAL = 600 # Seconds between two publishes of the telemetry
@@ -1,12 +1,123 @@
 '''
 applog.py
 Simple module to log messages instead of calling print everywhere
+
+Messages are given as a format string and arguments, or as a callable, so a
+message below the log level costs no formatting. Trace messages are logged in
+an "if __debug__:" block, the blocks are removed when the modules are compiled
+with optimisation level 1 or higher, see APPLOG_STRIP_TRACE in appconfig.py.
+
+Permanent messages are kept in memory and appended to the log file in batches,
+when APPLOG_FLUSH_SIZE bytes are pending, when the oldest pending message is
+APPLOG_FLUSH_INTERVAL seconds old or at once for a fatal message.
+
+The log file is a set of segments, app.log is written and app.log.1 up to
+app.log.<APPLOG_LOG_SEGMENTS - 1> are older messages. When app.log would grow
+past its share of APPLOG_LOG_SIZE the segments are renamed one step older and
+the oldest segment is removed.
+A segment is a sequence of binary records:
+
+    header   magic 0xA5, severity, message length (2 bytes), time (4 bytes)
+    message  UTF-8 text
+    trailer  CRC32 of the header and the message (4 bytes), message length (2 bytes)
+
+Numbers are little endian, the time is in seconds since the epoch. The
+trailer lets the records be read backwards from the end of a segment. A
+record cut short by a reset or power loss doesn't match its CRC and is
+skipped. tools/applog_decode.py prints the segments as text on a PC.
+A text app.log written before the segments is renamed app.log.old, it can
+still be copied from the PICO but is no longer read by the application.
 '''
+import array
 import time
 import io
+import os
+try:
+    import ubinascii as binascii
+except ImportError:
+    import binascii
+try:
+    import ustruct as struct
+except ImportError:
+    import struct
 
 import appconfig as params
 
+_MAGIC = 0xA5
+_HEADER = "<BBHI" # Magic, severity, message length, time
+_HEADER_SIZE = 8
+_TRAILER = "<IH" # CRC32, message length
+_TRAILER_SIZE = 6
+
+
+_IMMUTABLE = (int, float, str, bytes, bool, type(None))
+
+
+# Formats a message with its arguments, a message that doesn't match its
+# arguments is shown as it is with the arguments instead of failing
+def _message(msg, args):
+    try:
+        return msg.format(*args) if args else str(msg)
+    except Exception:
+        return str(msg) + repr(args)
+
+
+# Returns the arguments of a message as they are when the message is logged,
+# the arguments that can change later (lists, buffers...) are kept as text
+def _snapshot(args):
+    for a in args:
+        if (not isinstance(a, _IMMUTABLE)):
+            return tuple(a if isinstance(a, _IMMUTABLE) else str(a) for a in args)
+    return args
+
+
+# Formats a time in seconds since the epoch as the timestamp shown for a message
+def _timestamp(t):
+    ts  = time.localtime(t)
+    return "{0:4d}-{1:02d}-{2:02d}T{3:02d}:{4:02d}:{5:02d}.{6}"\
+        .format(ts[0], ts[1], ts[2], ts[3], ts[4], ts[5], ts[6])
+
+
+# Returns the record written to the log file for a permanent message
+def _frame(t, severity, msg):
+    data = msg[:params.APPLOG_MAX_MSG].encode()
+    header = struct.pack(_HEADER, _MAGIC, severity, len(data), t & 0xffffffff)
+    crc = binascii.crc32(data, binascii.crc32(header)) & 0xffffffff
+    return header + data + struct.pack(_TRAILER, crc, len(data))
+
+
+# Returns the tuple (time, severity, message) for the record at pos in data
+# or None if there is no complete and valid record at pos
+def _unframe(data, pos):
+    if (len(data) - pos < _HEADER_SIZE + _TRAILER_SIZE or data[pos] != _MAGIC):
+        return None
+    magic, severity, length, t = struct.unpack_from(_HEADER, data, pos)
+    end = pos + _HEADER_SIZE + length
+    if (end + _TRAILER_SIZE > len(data)):
+        return None
+    crc, length2 = struct.unpack_from(_TRAILER, data, end)
+    if (length2 != length or 
+            crc != binascii.crc32(data[pos + _HEADER_SIZE:end], binascii.crc32(data[pos:pos + _HEADER_SIZE])) & 0xffffffff):
+        return None
+    try:
+        return (t, severity, bytes(data[pos + _HEADER_SIZE:end]).decode())
+    except UnicodeError:
+        return None
+
+
+# Returns the name of segment n of the log file, 0 is the segment written
+def _segment(n):
+    return params.APPLOG_LOGFILE if n == 0 else "{}.{}".format(params.APPLOG_LOGFILE, n)
+
+
+# Returns the size of a file, 0 if the file doesn't exist
+def _file_size(name):
+    try:
+        return os.stat(name)[6]
+    except OSError:
+        return 0
+
+
 class APPLOG:
     '''
     Simple class to write log messages from the application
@@ -21,9 +132,29 @@ class APPLOG:
     def __init__(self, log_level=INFO, msgstack_size=params.APPLOG_DEFAULT_MSGSTACK_SIZE):
         self._log_level = log_level
         self._msgstack_size = msgstack_size
-        self._msgtab = []
         self._permtab = []
+
+        # The message stack is a ring of preallocated slots holding the time,
+        # the severity and a reference to the message. The timestamp and the
+        # message text are only formatted when msgtab is read.
+        self._ring_time = array.array("q", [0] * msgstack_size)
+        self._ring_severity = bytearray(msgstack_size)
+        self._ring_msg = [None] * msgstack_size
+        self._ring_args = [None] * msgstack_size
+        self._ring_next = 0 # Index of the slot to write next
+        self._ring_count = 0
+        self._msgtab = [] # Formatted messages, valid for _msgtab_formatted
+        self._msgtab_formatted = 0
         self._severities = ["fatal", "error", "warn", "info", "debug", "trace"]
+        self._msgtab_version = 0 # Incremented when a message is pushed on the message stack
+        self._permtab_version = 0 # Incremented when a permanent message is written
+        self._permtab_read = -1 # Version of the permanent messages in _permtab
+        self._pending = [] # Framed permanent messages waiting to be written to the log file
+        self._pending_size = 0
+        self._pending_since = 0 # Time the oldest pending message was logged
+        self._segment_size = -1 # Size of the segment written, -1 before the first write
+        self._read_buffer = None # Buffer for the records read from the log file
+        self._listener = None
  
     @property
     def log_level(self):
@@ -34,6 +165,12 @@ class APPLOG:
         if (level >= 0 and level <= self.TRACE):
             self._log_level = level
 
+    def enabled(self, severity:int):
+        '''
+        Returns True if messages with the severity are logged
+        '''
+        return severity >= 0 and severity <= self._log_level
+
     def severity_text(self, severity:int):
         if (severity >= 0 and severity <= self.TRACE):
             return self._severities[severity]
@@ -41,78 +178,290 @@ class APPLOG:
 
     @property
     def msgtab(self):
+        '''
+        Returns a list with the last messages as tuples (timestamp, severity, message),
+        newest first
+        '''
+        if (self._msgtab_formatted != self._msgtab_version):
+            self._msgtab = []
+            for n in range(self._ring_count):
+                i = (self._ring_next - 1 - n) % self._msgstack_size
+                self._msgtab.append((_timestamp(self._ring_time[i]), self._ring_severity[i], 
+                                     _message(self._ring_msg[i], self._ring_args[i])))
+            self._msgtab_formatted = self._msgtab_version
         return self._msgtab
+
+    def set_listener(self, f):
+        '''
+        Set a callable() called when a message is pushed on the message stack
+        '''
+        self._listener = f
+
+    @property
+    def msgtab_version(self):
+        return self._msgtab_version
+
+    @property
+    def permtab_version(self):
+        return self._permtab_version
    
     # Simple method to write a log message
-    def log_msg(self, severity:int, msg, permanent= False):
+    def log_msg(self, severity:int, msg, *args, permanent= False):
         '''
-        Writes the log message on standard output. The last
-        20 messages are stored in a buffer and can be fetched
+        Writes the log message on standard output when
+        APPLOG_CONSOLE is set. The last 20 messages are stored in a buffer and can be fetched
         for viewing in a webpage. Messages with a fatal severity
         or  messages with the parameter permanent set to True will
         be written to permanent storage on the device into
         the file named app.log.
+
+        msg is formatted with args by str.format when the message is
+        shown, or msg can be a callable returning the message which is
+        called when the message is logged. Nothing is done for messages
+        above the log level.
         '''
+        if (severity > self._log_level or severity < 0):
+            return
+
         try:
-            if (severity >= 0 and severity <= self.log_level):
-                ts  = time.localtime()
-                t = "{0:4d}-{1:02d}-{2:02d}T{3:02d}:{4:02d}:{5:02d}.{6}"\
-                    .format(ts[0], ts[1], ts[2], ts[3], ts[4], ts[5], ts[6])
-                
-                m = (t, severity, str(msg))
-                if (severity < self.TRACE): # Don't push trace messages on the messsage stack
-                    self._msgtab.insert(0, m)
-
-                    # Only keep the last self._msgstack_size messages
-                    while (len(self._msgtab) > self._msgstack_size):
-                        self._msgtab.pop()
-
-                # A fatal event or permanent is saved so the event can be 
-                # found after the device has been rebooted. 
-                if (severity == self.FATAL or permanent):
-                    try:
-                        m = (t, severity, str(msg))
-                        f  = io.open(params.APPLOG_LOGFILE, "a+")
-                        f.write(m[0] + "\t"+ self.severity_text(m[1]) + "\t" + m[2] + "\n")
-                        f.close()
-                    except Exception as e:
-                        print("Error writing {}: ".format(params.APPLOG_LOGFILE) + str(e))
-
-                print(m[0], self.severity_text(m[1]), m[2])
+            if (callable(msg)):
+                msg = msg()
+            t = int(time.time())
+            if (severity < self.TRACE): # Don't push trace messages on the messsage stack
+                # Only keep the last self._msgstack_size messages
+                i = self._ring_next
+                self._ring_time[i] = t
+                self._ring_severity[i] = severity
+                self._ring_msg[i] = msg
+                self._ring_args[i] = _snapshot(args)
+                self._ring_next = (i + 1) % self._msgstack_size
+                if (self._ring_count < self._msgstack_size):
+                    self._ring_count += 1
+                self._msgtab_version += 1
+                if (self._listener):
+                    self._listener()
+
+            # A fatal event or permanent is saved so the event can be 
+            # found after the device has been rebooted. 
+            if (severity == self.FATAL or permanent):
+                record = _frame(t, severity, _message(msg, args))
+                if (not self._pending):
+                    self._pending_since = t
+                self._pending.append(record)
+                self._pending_size += len(record)
+                self._permtab_version += 1
+                if (severity == self.FATAL or self._pending_size >= params.APPLOG_FLUSH_SIZE):
+                    self.flush()
+
+            if (params.APPLOG_CONSOLE):
+                print(_timestamp(t), self.severity_text(severity), _message(msg, args))
         except Exception as e:
             print("applog error writing log message " + str(msg))
 
 
-    @property
-    def permtab(self):
+    def flush(self, force=True):
         '''
-        Returns a list with the 20 last permanent messages
+        Appends the pending permanent messages to the log file with one write
+        per segment, a segment is rotated before the record that would take
+        it past its share of APPLOG_LOG_SIZE.
+        With force=False the messages are only written when the oldest has
+        waited APPLOG_FLUSH_INTERVAL seconds, called from the housekeeping task.
         '''
+        if (not self._pending):
+            return
+        if (not force and time.time() - self._pending_since < params.APPLOG_FLUSH_INTERVAL):
+            return
         try:
-            self._permtab.clear()
-            n = 0
-
-            f  = io.open(params.APPLOG_LOGFILE, "r")
-            l = f.readline().strip().split()
-            while (len(l) > 0):
-                n += 1
-                if (n > self._msgstack_size):
-                    self._permtab.pop(0)
-                    n -= 1
-
-                msg = " ".join(l[2:]) if len(l) >= 2 else ""
-                m = (l[0], self._severities.index(l[1]), msg)
-                self._permtab.append(m)
-
-                l = f.readline().strip().split()
+            if (self._segment_size < 0):
+                self._segment_size = self._check_segment()
+            share = params.APPLOG_LOG_SIZE // params.APPLOG_LOG_SEGMENTS
+            pending = self._pending
+            start = 0
+            size = self._segment_size
+            for i in range(len(pending)):
+                if (size > 0 and size + len(pending[i]) > share):
+                    self._append(pending[start:i])
+                    self._rotate()
+                    start = i
+                    size = 0
+                size += len(pending[i])
+            self._append(pending[start:])
+        except Exception as e:
+            print("Error writing {}: ".format(params.APPLOG_LOGFILE) + str(e))
+            self._segment_size = -1
+        # The messages are dropped if they can't be written, so a full
+        # flash doesn't make the pending messages use all the memory
+        self._pending.clear()
+        self._pending_size = 0
+
+    def _append(self, records):
+        ''' Appends the records to the segment written with one write'''
+        if (not records):
+            return
+        data = b"".join(records)
+        f  = io.open(params.APPLOG_LOGFILE, "ab")
+        f.write(data)
+        f.close()
+        self._segment_size += len(data)
+
+    def _check_segment(self):
+        '''
+        Returns the size of the segment written. The segment is rotated
+        when it doesn't end with a valid record, a record cut short by a
+        reset, so the records written next can be read backwards. A log
+        file written in another format, which has no size limit, is moved
+        out of the segments.
+        '''
+        size = _file_size(params.APPLOG_LOGFILE)
+        if (size > 0 and self._read_back(params.APPLOG_LOGFILE, 1, []) != 0):
+            f = io.open(params.APPLOG_LOGFILE, "rb")
+            first = f.read(1)
             f.close()
+            if (first[0] != _MAGIC):
+                old = params.APPLOG_LOGFILE + ".old"
+                try:
+                    os.remove(old)
+                except OSError:
+                    pass
+                os.rename(params.APPLOG_LOGFILE, old)
+            else:
+                self._rotate()
+            return 0
+        return size
 
-            self._permtab.reverse()
-            return self._permtab
-        except Exception as e:
-            self.log_msg(APPLOG.ERROR, "Error reading permantent messages: " + str(e))
-            return []
+    def _rotate(self):
+        '''
+        Makes each segment one step older and removes the oldest segment
+        '''
+        for n in range(params.APPLOG_LOG_SEGMENTS - 1, 0, -1):
+            try:
+                if (n == params.APPLOG_LOG_SEGMENTS - 1):
+                    os.remove(_segment(n))
+                else:
+                    os.rename(_segment(n), _segment(n + 1))
+            except OSError: # The segment doesn't exist yet
+                pass
+        try:
+            if (params.APPLOG_LOG_SEGMENTS > 1):
+                os.rename(_segment(0), _segment(1))
+            else:
+                os.remove(_segment(0))
+        except OSError:
+            pass
+        self._segment_size = 0
+
+    def _read_back(self, name, n, records):
+        '''
+        Appends up to n records read backwards from the end of a segment to
+        records, newest first. Returns the number of records still wanted, or
+        -1 if a damaged record was found before n records were read.
+        '''
+        try:
+            f = io.open(name, "rb")
+        except OSError:
+            return n
+        try:
+            end = f.seek(0, 2)
+            if (self._read_buffer is None): # Room for the longest record
+                self._read_buffer = memoryview(bytearray(_HEADER_SIZE + params.APPLOG_MAX_MSG * 4 + _TRAILER_SIZE))
+            buffer = self._read_buffer
+            while (n > 0 and end > 0):
+                if (end < _HEADER_SIZE + _TRAILER_SIZE):
+                    return -1
+                f.seek(end - _TRAILER_SIZE)
+                f.readinto(buffer[:_TRAILER_SIZE])
+                length = struct.unpack_from(_TRAILER, buffer, 0)[1]
+                size = _HEADER_SIZE + length + _TRAILER_SIZE
+                if (size > end or size > len(buffer)):
+                    return -1
+                f.seek(end - size)
+                f.readinto(buffer[:size])
+                record = _unframe(buffer[:size], 0)
+                if (record is None):
+                    return -1
+                records.append(record)
+                end -= size
+                n -= 1
+            return n
+        finally:
+            f.close()
 
-            
+    def _read_forward(self, name, n, records):
+        '''
+        Appends up to n of the last valid records in a segment to records, 
+        newest first, skipping damaged records. Reads the segment in chunks
+        of twice the longest record, only used when a segment can't be read
+        backwards.
+        '''
+        try:
+            f = io.open(name, "rb")
+        except OSError:
+            return n
+        longest = _HEADER_SIZE + params.APPLOG_MAX_MSG * 4 + _TRAILER_SIZE
+        buffer = memoryview(bytearray(2 * longest))
+        found = []
+        try:
+            length = 0 # Bytes read in buffer
+            pos = 0
+            eof = False
+            while True:
+                if (not eof and length - pos < longest): # A record may go past the bytes read
+                    buffer[:length - pos] = bytes(buffer[pos:length])
+                    length -= pos
+                    pos = 0
+                    got = f.readinto(buffer[length:])
+                    if (got):
+                        length += got
+                    else:
+                        eof = True
+                if (pos >= length):
+                    break
+                record = _unframe(buffer[:length], pos)
+                if (record is None):
+                    pos += 1 # Look for the next record
+                else:
+                    found.append(record)
+                    if (len(found) > n):
+                        found.pop(0)
+                    pos += _HEADER_SIZE + len(record[2].encode()) + _TRAILER_SIZE
+        finally:
+            f.close()
+        found = found[-n:] if n > 0 else []
+        found.reverse()
+        records.extend(found)
+        return n - len(found)
 
+    @property
+    def permtab(self):
+        '''
+        Returns a list with the 20 last permanent messages, the list is
+        cached until the next permanent message is logged
+        '''
+        if (self._permtab_read == self._permtab_version):
+            return self._permtab
+        try:
+            records = []
+            for record in self._pending:
+                records.append(_unframe(record, 0))
+            records.reverse()
+            n = self._msgstack_size - len(records)
+            for segment in range(params.APPLOG_LOG_SEGMENTS):
+                if (n <= 0):
+                    break
+                name = _segment(segment)
+                found = len(records)
+                left = self._read_back(name, n, records)
+                if (left < 0):
+                    del records[found:]
+                    left = self._read_forward(name, n, records)
+                n = left
 
+            # A new list, the pages being written keep the list they got
+            self._permtab = [(_timestamp(t), severity, msg) for t, severity, msg in records[:self._msgstack_size]]
+            self._permtab_read = self._permtab_version
+            return self._permtab
+        except Exception as e:
+            self._permtab_read = self._permtab_version # Not read again until a new permanent message
+            self._permtab = []
+            self.log_msg(APPLOG.ERROR, "Error reading permantent messages: {}", e)
+            return self._permtab
@@ -0,0 +1,57 @@
+'''
+apputil.py
+Helpers shared by the modules of the application
+'''
+import array
+import random
+
+
+class RING:
+    '''
+    Fixed size ring of records, each field of the records is kept in a
+    preallocated array with the typecode given for the field
+    '''
+    def __init__(self, size, typecodes):
+        self._fields = [array.array(t, [0] * size) for t in typecodes]
+        self._size = size
+        self._next = 0 # Index of the slot to write next
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def append(self, *values):
+        i = self._next
+        for field, v in zip(self._fields, values):
+            field[i] = v
+        self._next = (i + 1) % self._size
+        if (self._count < self._size):
+            self._count += 1
+
+    def get(self, n):
+        '''
+        Returns the record n records back, 0 is the latest record
+        '''
+        if (n < 0 or n >= self._count):
+            raise IndexError(n)
+        i = (self._next - 1 - n) % self._size
+        return tuple(field[i] for field in self._fields)
+
+    def records(self, n=None):
+        '''
+        Yields the last n records, newest first
+        '''
+        if (n is None or n > self._count):
+            n = self._count
+        for k in range(n):
+            yield self.get(k)
+
+
+def backoff_delay(failures, min_delay, max_delay):
+    '''
+    Returns the seconds to wait after a number of failures in a row, the
+    delay is doubled at each failure up to max_delay, with random jitter
+    so a number of devices don't try again at the same time
+    '''
+    delay = min(max_delay, min_delay * 2 ** min(failures, 16))
+    return delay * (0.5 + random.random() / 2)
@@ -4,4 +4,11 @@ boot.py
  first amongst all other modules. The bootloader runs
  main.py after boot.py has finished.
 '''
-	
\ No newline at end of file
+import micropython
+
+import appconfig as params
+
+# Compile the modules imported from now on without the trace messages and
+# asserts, see applog.py
+if (params.APPLOG_STRIP_TRACE):
+    micropython.opt_level(1)
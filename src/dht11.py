@@ -5,12 +5,18 @@ Methods to interact with the DHT11 humidity and temperature sensor.
 Code based on https://www.instructables.com/DHT11-With-Raspberry-Pi-Pico/
 '''
 import array
+import micropython
 import time
-from machine import Pin
+from machine import Pin, time_pulse_us
 from micropython import const
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
 
 import appconfig as params
 from applog import APPLOG
+from apputil import RING
  
 class InvalidChecksum(Exception):
     pass
@@ -19,95 +25,351 @@ class InvalidPulseCount(Exception):
     pass
  
 MAX_UNCHANGED = const(100)
-MIN_INTERVAL_US = params.DHT11_POLL_INTERVALL * 100000 # datasheet or DHT11 says that repnse time migth be 6 seconds
 HIGH_LEVEL = const(50)
 EXPECTED_PULSES = const(84)
+EDGE_TIMEOUT_US = const(200) # No edge for this long ends a viper capture
+PULSE_TIMEOUT_US = const(1000) # Max wait for a pulse with time_pulse_us
+
+# Backends used to capture the pulses from the sensor, see DHT11._capture_pulses
+CAPTURE_PYTHON = "python" # Interpreted loop polling pin.value() and time.ticks_us()
+CAPTURE_NATIVE = "native" # The same loop compiled to machine code
+CAPTURE_VIPER = "viper" # Reads the RP2040 GPIO input and timer registers directly
+CAPTURE_PULSE = "pulse" # Times the high part of each bit with machine.time_pulse_us
+CAPTURES = (CAPTURE_PYTHON, CAPTURE_NATIVE, CAPTURE_VIPER, CAPTURE_PULSE)
+
+_SIO_GPIO_IN = const(0xd0000004) # RP2040 GPIO input levels
+_TIMER_TIMERAWL = const(0x40054028) # RP2040 microsecond timer, low 32 bits
+
+
+@micropython.native
+def _capture_native(pin, transitions, max_unchanged):
+    '''
+    Stores the time in us between the transitions of the pin in transitions,
+    returns the number of transitions or EXPECTED_PULSES + 1 if there were more
+    '''
+    val = 1
+    idx = 0
+    unchanged = 0
+    timestamp = time.ticks_us()
+    while unchanged < max_unchanged:
+        if val != pin.value():
+            if idx >= EXPECTED_PULSES:
+                return EXPECTED_PULSES + 1
+            now = time.ticks_us()
+            transitions[idx] = time.ticks_diff(now, timestamp) & 0xFF
+            timestamp = now
+            idx += 1
+            val = 1 - val
+            unchanged = 0
+        else:
+            unchanged += 1
+    return idx
+
+
+@micropython.viper
+def _capture_viper(transitions, mask: int, timeout_us: int) -> int:
+    '''
+    As _capture_native but reading the GPIO and timer registers, the capture
+    ends when there has been no transition for timeout_us
+    '''
+    gpio_in = ptr32(_SIO_GPIO_IN)
+    timer = ptr32(_TIMER_TIMERAWL)
+    out = ptr8(transitions)
+    val = mask
+    idx = 0
+    timestamp = timer[0]
+    while True:
+        now = timer[0]
+        level = gpio_in[0] & mask
+        if level != val:
+            if idx >= EXPECTED_PULSES:
+                return EXPECTED_PULSES + 1
+            out[idx] = now - timestamp
+            timestamp = now
+            idx += 1
+            val = level
+        elif now - timestamp > timeout_us:
+            return idx
+
+
+@micropython.native
+def _capture_pulse(pin, transitions, timeout_us):
+    '''
+    Times the response from the sensor and the high part of each of the 40 bits,
+    stored in the same places in transitions as by the other captures. Returns
+    the number of transitions, less than EXPECTED_PULSES on a timeout.
+    '''
+    t = time_pulse_us(pin, 0, timeout_us) # Response low
+    if t < 0:
+        return 0
+    transitions[1] = min(t, 255)
+    t = time_pulse_us(pin, 1, timeout_us) # Response high
+    if t < 0:
+        return 2
+    transitions[2] = min(t, 255)
+    for idx in range(4, EXPECTED_PULSES, 2):
+        t = time_pulse_us(pin, 1, timeout_us)
+        if t < 0:
+            return idx
+        transitions[idx] = min(t, 255)
+    return EXPECTED_PULSES
+
+
+class DHT11_HISTORY(RING):
+    '''
+    Fixed size ring with the last measures read from the sensor. Each record is
+    (ticks_ms, temperature, humidity) where temperature and humidity are stored
+    in tenths of degrees and percent.
+    '''
+    def __init__(self, size=params.DHT11_HISTORY_SIZE):
+        super().__init__(size, ("i", "h", "h"))
+
  
 class DHT11:
-    _temperature: float
-    _humidity: float
-    
 
-    def __init__(self, pin:Pin, log:APPLOG):
+    def __init__(self, pin:Pin, log:APPLOG, capture=params.DHT11_CAPTURE, gpio=params.dht11_pin):
+        '''
+        capture selects how the pulses from the sensor are captured, one of CAPTURES.
+        gpio is the GPIO number of pin, it is only used by CAPTURE_VIPER.
+        '''
+        if (capture not in CAPTURES):
+            raise ValueError("Unknown DHT11 capture " + str(capture))
         self._pin = pin
-        self._last_measure = time.ticks_us()
-        self._temperature = -1
-        self._humidity = -1
-        self._last_measure_ts = ""
+        self._capture = capture
+        self._gpio = gpio
+        # Buffers used to read the sensor are allocated once so a read does not
+        # allocate any memory, see _capture_pulses
+        self._transitions = bytearray(EXPECTED_PULSES)
+        self._pulses = memoryview(self._transitions)[4:]
+        self._buffer = bytearray(5)
+        self._last_measure = time.ticks_add(time.ticks_ms(), -params.DHT11_MIN_INTERVAL_MS) # Start of the last read
+        self._temperature = -10 # Last measures in tenths
+        self._humidity = -10
+        self._last_measure_time = 0 # Seconds since the epoch of the last measure, 0 if none
         self._log = log
+        self._version = 0 # Incremented for each new measure read from the sensor
+        self._listener = None
+        self._history = DHT11_HISTORY()
+
+        # The reported measures are the median of the last reads, in tenths
+        self._window_size = params.DHT11_MEDIAN_WINDOW
+        self._window_temperature = array.array("h", [0] * self._window_size)
+        self._window_humidity = array.array("h", [0] * self._window_size)
+        self._window_sorted = array.array("h", [0] * self._window_size)
+        self._window_next = 0
+        self._window_count = 0
+
+        # Counters of the reads since the sensor object was created, see stats
+        self._reads = 0
+        self._successes = 0
+        self._checksum_errors = 0
+        self._pulse_errors = 0
+        self._retries = 0
+        self._failures = 0 # Samples where all retries failed
+        self._filtered = 0 # Reads where the median differed from the value read
+        self._retry_ms_total = 0 # Time spent retrying until a read succeeded
+        self._retry_ms_max = 0
+
+    async def measure(self):
+        '''
+        Read the measures from the sensor once, the other tasks run during the
+        start signal, only the capture of the pulses blocks. Only called by the
+        sampler, see sample. Returns True when new measures were read.
+        '''
+        current_ticks = time.ticks_ms()
+        if time.ticks_diff(current_ticks, self._last_measure) < params.DHT11_MIN_INTERVAL_MS:
+            # Less than the min period since last read, which is too soon according
+            # to the datasheet
+            return False
+        self._last_measure = current_ticks
+        self._reads += 1
 
-    def measure(self):
         try:
-            current_ticks = time.ticks_us()
-            if time.ticks_diff(current_ticks, self._last_measure) < MIN_INTERVAL_US and (
-                self._temperature > -1 or self._humidity > -1
-            ):
-                # Less than the min period since last read, which is too soon according
-                # to the datasheet
-                return
- 
-            self._send_init_signal()
+            await self._send_init_signal()
             pulses = self._capture_pulses()
             buffer = self._convert_pulses_to_buffer(pulses)
             self._verify_checksum(buffer)
- 
-            self._humidity = buffer[0] + buffer[1] / 10
-            self._temperature = buffer[2] + buffer[3] / 10
-            self._last_measure = time.ticks_us()
-            ts  = time.localtime()
-            self._last_measure_ts = "{0:4d}-{1:02d}-{2:02d}T{3:02d}:{4:02d}:{5:02d}"\
-                .format(ts[0], ts[1], ts[2], ts[3], ts[4], ts[5])
         except InvalidChecksum as e:
-            self._log.log_msg(self._log.ERROR, "InvalidChecksum " + str(e))
-            self._log.log_msg(self._log.ERROR, str(type(e)))
- 
- 
+            self._checksum_errors += 1
+            self._log.log_msg(APPLOG.DEBUG, "InvalidChecksum {}", e)
+            return False
+        except InvalidPulseCount as e:
+            self._pulse_errors += 1
+            self._log.log_msg(APPLOG.DEBUG, "InvalidPulseCount {}", e)
+            return False
+
+        self._successes += 1
+        self._filter(buffer[2] * 10 + buffer[3], buffer[0] * 10 + buffer[1])
+        self._last_measure_time = time.time()
+        self._history.append(time.ticks_ms(), self._temperature, self._humidity)
+        self._version += 1
+        if (self._listener):
+            self._listener()
+        return True
+
+    async def sample(self):
+        '''
+        Read the sensor, a failed read is retried up to DHT11_RETRIES times
+        waiting the min interval of the sensor between the reads. Returns
+        True when new measures were read.
+        '''
+        start = time.ticks_ms()
+        for attempt in range(params.DHT11_RETRIES + 1):
+            if (attempt > 0):
+                self._retries += 1
+                await asyncio.sleep(params.DHT11_MIN_INTERVAL_MS / 1000)
+            if (await self.measure()):
+                if (attempt > 0):
+                    t = time.ticks_diff(time.ticks_ms(), start)
+                    self._retry_ms_total += t
+                    self._retry_ms_max = max(self._retry_ms_max, t)
+                return True
+
+        self._failures += 1
+        self._log.log_msg(APPLOG.WARN, "DHT11 read failed after {} retries", params.DHT11_RETRIES)
+        return False
+
+    # Set the reported measures to the median of the last reads
+    def _filter(self, temperature, humidity):
+        i = self._window_next
+        self._window_temperature[i] = temperature
+        self._window_humidity[i] = humidity
+        self._window_next = (i + 1) % self._window_size
+        if (self._window_count < self._window_size):
+            self._window_count += 1
+
+        self._temperature = self._median(self._window_temperature)
+        self._humidity = self._median(self._window_humidity)
+        if (self._temperature != temperature or self._humidity != humidity):
+            self._filtered += 1
+
+    # The median of the values in the window, found by an insertion sort in a preallocated array
+    def _median(self, window):
+        s = self._window_sorted
+        n = self._window_count
+        for i in range(n):
+            v = window[i]
+            j = i
+            while j > 0 and s[j - 1] > v:
+                s[j] = s[j - 1]
+                j -= 1
+            s[j] = v
+        return s[n // 2]
+
+    def set_listener(self, f):
+        ''' Set a callable() called when new measure values have been read'''
+        self._listener = f
+
+    async def run(self):
+        '''
+        Sample the sensor on a regular schedule, the properties only return
+        the last measures so no other task ever waits for the sensor
+        '''
+        while True:
+            try:
+                await self.sample()
+            except Exception as e:
+                self._log.log_msg(APPLOG.ERROR, "DHT11 sampler: {}", e)
+            await asyncio.sleep(params.DHT11_POLL_INTERVALL)
+
+    @property
+    def version(self):
+        ''' Changes every time new measure values are read from the sensor'''
+        return self._version
+
+    @property
+    def stats(self):
+        ''' Returns a dict with the counters of the reads from the sensor'''
+        return {
+            "reads": self._reads,
+            "successes": self._successes,
+            "checksum_errors": self._checksum_errors,
+            "pulse_errors": self._pulse_errors,
+            "retries": self._retries,
+            "failures": self._failures,
+            "filtered": self._filtered,
+            "retry_ms_total": self._retry_ms_total,
+            "retry_ms_max": self._retry_ms_max,
+        }
+
+    @property
+    def history(self):
+        ''' The last measures, see DHT11_HISTORY'''
+        return self._history
+
     @property
     def measure_ts(self):
         ''' Timestamp when the last measure values was read from the sensor'''
-        return self._last_measure_ts
+        if (self._last_measure_time == 0):
+            return ""
+        ts  = time.localtime(self._last_measure_time)
+        return "{0:4d}-{1:02d}-{2:02d}T{3:02d}:{4:02d}:{5:02d}"\
+            .format(ts[0], ts[1], ts[2], ts[3], ts[4], ts[5])
     
+    @property
+    def measure_time(self):
+        ''' Time in seconds since the epoch when the last measure values were read'''
+        return self._last_measure_time
+
     @property
     def measures(self):
-        ''' Returns a tuple (temperature, humidity, read timestamp)'''
-        self.measure()
-        return (self._temperature, self._humidity, self._last_measure_ts)
+        ''' Returns a tuple (temperature, humidity, read timestamp) of the last measures'''
+        return (self.temperature, self.humidity, self.measure_ts)
 
     @property
     def humidity(self):
-        self.measure()
-        return self._humidity
+        return self._humidity / 10
  
     @property
     def temperature(self):
-        self.measure()
-        return self._temperature
+        return self._temperature / 10
  
-    def _send_init_signal(self):
+    async def _send_init_signal(self):
+        # The sensor only needs the line low for at least 18 ms, a longer
+        # wait while other tasks run does no harm
         self._pin.init(Pin.OUT, Pin.PULL_DOWN)
         self._pin.value(1)
-        time.sleep_ms(50)
+        await asyncio.sleep(0.05)
         self._pin.value(0)
-        time.sleep_ms(18)
+        await asyncio.sleep(0.018)
  
     def _capture_pulses(self):
         pin = self._pin
         pin.init(Pin.IN, Pin.PULL_UP)
  
+        transitions = self._transitions
+        if (self._capture == CAPTURE_NATIVE):
+            idx = _capture_native(pin, transitions, MAX_UNCHANGED)
+        elif (self._capture == CAPTURE_VIPER):
+            idx = _capture_viper(transitions, 1 << self._gpio, EDGE_TIMEOUT_US)
+        elif (self._capture == CAPTURE_PULSE):
+            idx = _capture_pulse(pin, transitions, PULSE_TIMEOUT_US)
+        else:
+            idx = self._capture_python(pin, transitions)
+        pin.init(Pin.OUT, Pin.PULL_DOWN)
+
+        if idx > EXPECTED_PULSES:
+            raise InvalidPulseCount(
+                "Got more than {} pulses".format(EXPECTED_PULSES)
+            )
+        if idx != EXPECTED_PULSES:
+            raise InvalidPulseCount(
+                "Expected {} but got {} pulses".format(EXPECTED_PULSES, idx)
+            )
+        return self._pulses # The first 4 transitions are the start of the response
+
+    def _capture_python(self, pin, transitions):
         val = 1
         idx = 0
-        transitions = bytearray(EXPECTED_PULSES)
         unchanged = 0
         timestamp = time.ticks_us()
  
         while unchanged < MAX_UNCHANGED:
             if val != pin.value():
                 if idx >= EXPECTED_PULSES:
-                    raise InvalidPulseCount(
-                        "Got more than {} pulses".format(EXPECTED_PULSES)
-                    )
+                    return EXPECTED_PULSES + 1
                 now = time.ticks_us()
-                transitions[idx] = now - timestamp
+                transitions[idx] = (now - timestamp) & 0xFF
                 timestamp = now
                 idx += 1
  
@@ -115,12 +377,7 @@ class DHT11:
                 unchanged = 0
             else:
                 unchanged += 1
-        pin.init(Pin.OUT, Pin.PULL_DOWN)
-        if idx != EXPECTED_PULSES:
-            raise InvalidPulseCount(
-                "Expected {} but got {} pulses".format(EXPECTED_PULSES, idx)
-            )
-        return transitions[4:]
+        return idx
  
     def _convert_pulses_to_buffer(self, pulses):
         """Convert a list of 80 pulses into a 5 byte buffer
@@ -130,22 +387,21 @@ class DHT11:
             2: Integral temperature data
             3: Decimal temperature data
             4: Checksum
+        The bits are written straight into the buffer of the instance, a
+        long pulse is a 1 and a short pulse is a 0.
         """
-        # Convert the pulses to 40 bits
-        binary = 0
-        for idx in range(0, len(pulses), 2):
-            binary = binary << 1 | int(pulses[idx] > HIGH_LEVEL)
- 
-        # Split into 5 bytes
-        buffer = array.array("B")
-        for shift in range(4, -1, -1):
-            buffer.append(binary >> shift * 8 & 0xFF)
+        buffer = self._buffer
+        idx = 0
+        for n in range(5):
+            byte = 0
+            for bit in range(8):
+                byte = byte << 1 | (1 if pulses[idx] > HIGH_LEVEL else 0)
+                idx += 2 # Every other pulse is the low level between the bits
+            buffer[n] = byte
         return buffer
  
     def _verify_checksum(self, buffer):
         # Calculate checksum
-        checksum = 0
-        for buf in buffer[0:4]:
-            checksum += buf
+        checksum = buffer[0] + buffer[1] + buffer[2] + buffer[3]
         if checksum & 0xFF != buffer[4]:
-            raise InvalidChecksum()
\ No newline at end of file
+            raise InvalidChecksum()
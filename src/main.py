@@ -3,10 +3,15 @@ main.py
  Main logic to start up the the PICO Microcontroller application. 
  When the PICO is started the bootloader executes main.py after boot.py.
 '''
+import gc
 import machine
 from machine import Pin
 import ntptime
 import time
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
 
 from applog import APPLOG
 import appconfig as params
@@ -20,47 +25,87 @@ log = APPLOG(log_level=APPLOG.INFO)
 conn = NETCONN(log)
 dht11_pin = Pin(params.dht11_pin, Pin.OUT, Pin.PULL_DOWN)
 dht11 = dht11.DHT11(dht11_pin, log)
-mqtt = MQTT_CLIENT(log, dht11=dht11)
+mqtt = MQTT_CLIENT(log, dht11=dht11, conn=conn)
 webserver = WEBSERVER(log=log, conn=conn, dht11=dht11)
+webserver.set_mqtt_stats(lambda: mqtt.stats) # Shown by /api/network
+log.set_listener(webserver.notify) # Push new log messages and measures to the web page
+dht11.set_listener(webserver.notify)
+conn.add_listener(webserver.link_changed) # Listen and connect to the broker when the network is up
+conn.add_listener(mqtt.link_changed)
 
 
-try:
-    conn.wifi_connect() # Connect to a network
+# Any exception not handled inside a task is fatal, as it was for the old main loop
+def task_exception(loop, context):
+    e = context.get("exception")
+    if (e is None or isinstance(e, KeyboardInterrupt)): # CTRL-C is propagated out of asyncio.run
+        log.log_msg(APPLOG.WARN, "Task: {}", context.get("message"))
+        return
+    log.log_msg(APPLOG.FATAL, "Exception in task: {} {}", e, type(e))
+    machine.reset()
 
+
+# Housekeeping, free memory on a regular basis instead of when the heap is exhausted
+# and write the permanent log messages that have waited long enough
+async def housekeeping():
+    while True:
+        gc.collect()
+        log.flush(force=False)
+        if __debug__:
+            log.log_msg(APPLOG.TRACE, "housekeeping mem_free={}", gc.mem_free())
+        await asyncio.sleep(params.HOUSEKEEPING_INTERVAL)
+
+
+# Set the clock from the network the first time the network is up
+def link_changed(up):
+    if (not up or time.time() >= 1688586897):
+        return
     try:
-        if (time.time() < 1688586897):
-            rtc = machine.RTC()
-            log.log_msg(APPLOG.INFO,"Setting time... current time is " + str(rtc.datetime()), permanent=True)
-            ntptime.settime()
-            tm = time.localtime(time.time()+2*60*60)
-            dttm = (tm[0],tm[1],tm[2], tm[6],tm[3],tm[4],tm[5],tm[7])
-            rtc.datetime(dttm)
-            log.log_msg(APPLOG.INFO,"Time set to " + str(rtc.datetime()), permanent=True)
+        rtc = machine.RTC()
+        log.log_msg(APPLOG.INFO,"Setting time... current time is {}", rtc.datetime(), permanent=True)
+        ntptime.settime()
+        tm = time.localtime(time.time()+2*60*60)
+        dttm = (tm[0],tm[1],tm[2], tm[6],tm[3],tm[4],tm[5],tm[7])
+        rtc.datetime(dttm)
+        log.log_msg(APPLOG.INFO,"Time set to {}", rtc.datetime(), permanent=True)
     except Exception as e:
-        log.log_msg(APPLOG.WARN, "'Can't set time: " + str(e), permanent=True) 
+        log.log_msg(APPLOG.WARN, "'Can't set time: {}", e, permanent=True) 
 
-    # loop for ever,
-    #   handle request to the webserver  
-    #   and send measured values to the MQTT-service
-    while True:
-        time.sleep(0.5)
-        webserver.serve() # Non blocking 
-        mqtt.mqtt_publish() # Read mesaures and publish them in Adafruit
+conn.add_listener(link_changed)
+
+
+async def main():
+    asyncio.get_event_loop().set_exception_handler(task_exception)
+    asyncio.create_task(conn.run()) # Connect to a network, the web server listens when it is up
+    asyncio.create_task(dht11.run()) # Read mesaures from the sensor
+    asyncio.create_task(mqtt.supervise()) # Keep the connection with the broker alive
+    asyncio.create_task(mqtt.run()) # Publish measures in Adafruit
+    await housekeeping()
+
+
+try:
+    # Run the application as a set of cooperative tasks,
+    #   the network connection is kept up without ever blocking the other tasks,
+    #   the webserver handles requests as soon as they arrive,
+    #   the sensor is sampled and measured values are sent to the MQTT-service
+    #   on their own schedules
+    asyncio.run(main())
 except KeyboardInterrupt as e: # Handles the ctrl+c command.
-    log.log_msg(APPLOG.INFO, "Keyboard interupt: " + str(e))
+    log.log_msg(APPLOG.INFO, "Keyboard interupt: {}", e)
 except Exception as e: 
-    log.log_msg(APPLOG.FATAL, "Exception main: " + str(e) + " " + str(type(e)))
+    log.log_msg(APPLOG.FATAL, "Exception main: {} {}", e, type(e))
     machine.reset() 
 finally:
     try:
         webserver.close()
     except Exception as e:
-        log.log_msg(APPLOG.ERROR, str(e))
+        log.log_msg(APPLOG.ERROR, "{}", e)
 
     try:
         conn.wifi_disconnect()
     except Exception as e:
-        log.log_msg(APPLOG.ERROR, str(e))
+        log.log_msg(APPLOG.ERROR, "{}", e)
+
+    log.flush()
 
 log.log_msg(log.DEBUG, "main done!")
 		
\ No newline at end of file
@@ -3,74 +3,451 @@ mqtt_client.py
 Send MQTT-messages to a MQTT broker service (AdaFruit)
 '''
 
+import gc
+import json
 import time
 import ubinascii
-from simple2 import MQTTClient
+try:
+    import uasyncio as asyncio
+    from uasyncio import core as _core
+except ImportError:
+    import asyncio
+    _core = None
+from simple2 import MQTTClient, MQTTException
 import machine
 
 import appconfig as params
 from applog import APPLOG
+from apputil import backoff_delay
 import dht11
+import mqtt_payload
+from netconn import NETCONN
+from mqtt_queue import MQTT_QUEUE
+from mqtt_router import MQTT_ROUTER
+from report_policy import REPORT_POLICY
+
+_DNS_REFRESH = 5 # Failed connects in a row before the address of the broker is looked up again
+_CONNECT_POLL = 0.1 # Seconds between the checks of a connect in progress
+
+
+# Returns when the socket has data to read or after timeout seconds
+if (_core is not None):
+    def _wait_read(sock): # The way the streams of uasyncio wait
+        yield _core._io_queue.queue_read(sock)
+
+    async def _readable(sock, timeout):
+        try:
+            await asyncio.wait_for(_wait_read(sock), timeout)
+        except asyncio.TimeoutError:
+            pass
+else:
+    async def _readable(sock, timeout):
+        loop = asyncio.get_event_loop()
+        ready = loop.create_future()
+        wake = lambda: ready.done() or ready.set_result(None)
+        fd = sock.fileno()
+        loop.add_reader(fd, wake)
+        timer = loop.call_later(timeout, wake)
+        try:
+            await ready
+        finally:
+            timer.cancel()
+            loop.remove_reader(fd)
+
 
 class MQTT_CLIENT:
-    def __init__(self, log:APPLOG, dht11: dht11.DHT11):
+    def __init__(self, log:APPLOG, dht11: dht11.DHT11, conn:NETCONN=None):
         self._log = log
         self._dht11 = dht11
+        self._conn = conn # Its counters are published with the telemetry
 
         self._CLIENT_ID = ubinascii.hexlify(machine.unique_id()) #To create an MQTT client, we need to get the PICOW unique ID
 
      
-        self._poll_interval = 30 #seconds read mesure interval
-        self._publish_interval = 60 #seconds  publish to Adafruit interval
-        self._last_publish = time.time() - self._publish_interval # last_publish variable will hold the last time a message was sent.
+        # Measures are published when they change enough, see report_policy.py
+        self._temperature_policy = REPORT_POLICY(params.MQTT_TEMPERATURE_DEADBAND, params.MQTT_TEMPERATURE_RATE,
+                                                 params.MQTT_HEARTBEAT, params.MQTT_MIN_SPACING)
+        self._humidity_policy = REPORT_POLICY(params.MQTT_HUMIDITY_DEADBAND, params.MQTT_HUMIDITY_RATE,
+                                              params.MQTT_HEARTBEAT, params.MQTT_MIN_SPACING)
+        self._dht11_version = -1 # Version of the last measures looked at
+        self._batch = [] # Records waiting to be published together, see mqtt_payload.py
+        self._start_time = int(time.time())
         self._mqtt_server_connected = False
-
+        self._connecting = False # A connect is in progress, see _poll_connect
+        self._queue = MQTT_QUEUE(log) # Measures waiting for the connection to the broker
+        if (params.MQTT_PAYLOAD != mqtt_payload.PAYLOAD_SINGLE):
+            size = mqtt_payload.max_size(params.MQTT_PAYLOAD, params.MQTT_BATCH)
+            if (size > self._queue.max_payload(params.MQTT_GROUP_TOPIC)):
+                self._log.log_msg(APPLOG.WARN, "MQTT_QUEUE_SLOT too small for {} payloads of {} bytes, they won't be queued",
+                                  params.MQTT_PAYLOAD, size)
+        self._unacked = [] # QoS 1 messages (pid, t, topic, payload) sent and not yet acknowledged, oldest first
+        self._window = asyncio.Event() # Set when a slot of the in-flight window is freed, see drain
+        self._mqttClient = MQTTClient(self._CLIENT_ID, params.MQTT_BROKER, params.MQTT_PORT, \
+                                params.MQTT_USERNAME, params.MQTT_PASSWORD, keepalive=params.MQTT_KEEPALIVE, 
+                                ssl=False, ssl_params={}, socket_timeout=params.MQTT_SOCKET_TIMEOUT,
+                                max_inflight=params.MQTT_MAX_INFLIGHT, max_retries=params.MQTT_RETRIES)
+        self._mqttClient.set_callback_status(self.status_cb)
+        self._mqttClient.set_callback(self.sub_cb) # The call back function will run whenever a message is published on a topic that the PicoW is subscribed to
+        self._router = MQTT_ROUTER() # Handlers of the subscriptions, see mqtt_router.py
+        self._subscriptions = {} # Topic filter: QoS, subscribed again on each connect
+        self._subscribing = {} # Pid: topic filter of the subscriptions not yet acknowledged
+        self._led = machine.Pin("LED", machine.Pin.OUT)
+        if (params.MQTT_SUBSCRIBE_TOPIC):
+            self.subscribe(params.MQTT_SUBSCRIBE_TOPIC, self.led_cb)
+        self._failures = 0 # Failed connects in a row
+        self._connect_failures = 0 # Failed connects and connections lost since the start
+        self._reconnect_at = time.ticks_ms() # When to connect next
+        self._link_up = False # The network link is up, see link_changed
+        self._telemetry_at = time.ticks_ms() # When the telemetry was last published
 
 
     # Received messages from subscriptions will be delivered to this callback
-    def sub_cb(self, topic, msg):
-        led = machine.Pin("LED",machine.Pin.OUT)
-        print((topic, msg))
-        if msg.decode() == "ON":
-            led.value(1)
-        else:
-            led.value(0)
+    # topic and msg are memoryviews only valid during the call
+    def sub_cb(self, topic, msg, retained=False, duplicate=False):
+        if (self._router.dispatch(topic, msg, retained, duplicate) == 0):
+            self._log.log_msg(APPLOG.DEBUG, "No handler for MQTT message on {}", bytes(topic))
+
+
+    def subscribe(self, topic_filter, handler, qos=0):
+        '''
+        Calls handler(topic, msg, retained, duplicate) for the messages on the
+        topics matching topic_filter, + and # wildcards are allowed, see mqtt_router.py
+        '''
+        topic_filter = topic_filter.encode() if isinstance(topic_filter, str) else topic_filter
+        self._router.add(topic_filter, handler)
+        if (topic_filter not in self._subscriptions):
+            self._subscriptions[topic_filter] = qos
+            if (self._mqtt_server_connected):
+                try:
+                    self._subscribing[self._mqttClient.subscribe(topic_filter, qos)] = topic_filter
+                except (OSError, MQTTException) as e:
+                    self._disconnected(e)
+
+
+    # Turns the LED on with the message ON, off with any other message
+    def led_cb(self, topic, msg, retained, duplicate):
+        self._led.value(1 if bytes(msg) == b"ON" else 0)
+
+
+    # Delivery status of the messages published with QoS 1 and of the subscriptions
+    def status_cb(self, pid, status):
+        topic_filter = self._subscribing.pop(pid, None)
+        if (topic_filter is not None):
+            if (status != 1): # The connection is kept, the other subscriptions and the publishes still work
+                self._log.log_msg(APPLOG.WARN, "MQTT subscription {} {}", topic_filter,
+                                  "refused by the broker" if status == 3 else "not acknowledged")
+            return
+        self._window.set()
+        for i, message in enumerate(self._unacked):
+            if (message[0] == pid):
+                del self._unacked[i]
+                if (status == 0): # Not acknowledged after the retries, sent again from the queue
+                    self._log.log_msg(APPLOG.WARN, "MQTT message {} not acknowledged by the broker", pid)
+                    self._queue.put(message[1], message[2], message[3], front=True)
+                return
+
+
+    def _send(self, t, topic, payload, data=None):
+        '''
+        Publishes a measure, data is the payload sent if it isn't payload.
+        A message sent with QoS 1 is kept until the broker acknowledges it.
+        '''
+        pid = self._mqttClient.publish(topic, payload if data is None else data, qos=params.MQTT_QOS)
+        if (pid):
+            self._unacked.append((pid, t, topic, payload))
+
+
+    def _requeue(self):
+        '''
+        Puts the messages not acknowledged back in front of the queue, the
+        broker forgets them when the connection is closed
+        '''
+        for pid, t, topic, payload in reversed(self._unacked):
+            self._queue.put(t, topic, payload, front=True)
+        if (self._unacked):
+            self._log.log_msg(APPLOG.INFO, "{} MQTT messages not acknowledged queued again", len(self._unacked))
+            self._unacked.clear()
 
 
     def mqtt_connect(self):
-        # Default  MQTT_BROKER to connect to
-        self._mqttClient = MQTTClient(self._CLIENT_ID, params.MQTT_BROKER, params.MQTT_PORT, \
-                                params.MQTT_USERNAME, params.MQTT_PASSWORD, keepalive=60, ssl=False, ssl_params={})
-        self._mqttClient.set_callback(self.sub_cb) # whenever a new message comes (to picoW), print the topic and message (The call back function will run whenever a message is published on a topic that the PicoW is subscribed to.)
-        self._mqttClient.connect()
-        #mqttClient.subscribe(params.MQTT_SUBSCRIBE_TOPIC)
-        self._log.log_msg(APPLOG.INFO, "Connected with MQTT broker: {}".format(params.MQTT_BROKER))
-        self._log.log_msg(APPLOG.DEBUG, "Measure intervals:  poll: {} seconds, publish: {} seconds" \
-                    .format(self._poll_interval, self._publish_interval))
+        '''
+        Starts a connect to MQTT_BROKER, the supervisor follows it with _poll_connect
+        so a broker that is slow to answer doesn't hold up the other tasks
+        '''
+        self._requeue() # A clean session forgets the messages in flight
+        self._mqttClient.connect_start()
+        self._connecting = True
+
+
+    def _poll_connect(self):
+        ''' Finishes the connect once the broker has accepted it'''
+        if (self._mqttClient.connect_poll() is None):
+            return # Not yet accepted by the broker
+        self._connecting = False
+        self._subscribing.clear()
+        for topic_filter, qos in self._subscriptions.items(): # The broker forgets them with a clean session
+            self._subscribing[self._mqttClient.subscribe(topic_filter, qos)] = topic_filter
+        self._log.log_msg(APPLOG.INFO, "Connected with MQTT broker: {}", params.MQTT_BROKER)
+        self._log.log_msg(APPLOG.DEBUG, "Report policy: heartbeat {} seconds, min spacing {} seconds", 
+                    params.MQTT_HEARTBEAT, params.MQTT_MIN_SPACING)
         self._mqtt_server_connected = True
+        self._failures = 0
 
 
     def mqtt_publish(self):
-        self._log.log_msg(APPLOG.TRACE, 'Entering mqtt_publish dht11 is {}'.format(type(dht11)))
-
-        if (not self._mqtt_server_connected):
-            self.mqtt_connect() # Open a connection to Adafruit
+        '''
+        Publishes the temperature and the humidity read since the last call
+        when their report policy says they are worth reporting
+        '''
+        if __debug__:
+            self._log.log_msg(APPLOG.TRACE, 'Entering mqtt_publish dht11 is {}', type(dht11))
 
-        now = time.time()
-        published_period = now - self._last_publish
-        if (published_period < self._publish_interval):
-            return
+        if (self._dht11.version == self._dht11_version):
+            return # No new measures
+        self._dht11_version = self._dht11.version
 
         temp = 0
         humidity = 0
         ts = ""
         try:
             (temp, humidity, ts) = self._dht11.measures
-            self._log.log_msg(APPLOG.TRACE, "ts={} temp={}, humidity={}%".format(ts, temp, humidity))
+            if __debug__:
+                self._log.log_msg(APPLOG.TRACE, "ts={} temp={}, humidity={}%", ts, temp, humidity)
         except Exception as e:
-                self._log.log_msg(APPLOG.ERROR, str(e))
+                self._log.log_msg(APPLOG.ERROR, "{}", e)
 
         if (temp > 0):
-            self._mqttClient.publish(params.MQTT_PUBLISH_TOPIC, str(temp).encode())
-            self._log.log_msg(APPLOG.DEBUG, "Published temp={}, humidity={}%".format(temp, humidity))
-            self._last_publish = time.time()
+            t = self._dht11.measure_time
+            report_temperature = self._temperature_policy.update(temp, t)
+            report_humidity = self._humidity_policy.update(humidity, t)
+            if (params.MQTT_PAYLOAD == mqtt_payload.PAYLOAD_SINGLE):
+                if (report_temperature):
+                    self._publish(params.MQTT_PUBLISH_TOPIC, str(temp).encode(), t)
+                if (report_humidity):
+                    self._publish(params.MQTT_HUMIDITY_TOPIC, str(humidity).encode(), t)
+            elif (report_temperature or report_humidity):
+                # All the values are published in one message, MQTT_BATCH publish cycles at a time
+                self._batch.append((t, temp, humidity, self._dht11.stats["failures"], 
+                                    int(time.time()) - self._start_time, gc.mem_free()))
+                if (len(self._batch) >= params.MQTT_BATCH):
+                    if (params.MQTT_PAYLOAD == mqtt_payload.PAYLOAD_JSON):
+                        payload = mqtt_payload.pack_json(self._batch)
+                    else:
+                        payload = mqtt_payload.pack_binary(self._batch)
+                    self._batch.clear()
+                    self._publish(params.MQTT_GROUP_TOPIC, payload, t)
+
+
+    def _publish(self, topic, payload, t):
+        '''
+        Publishes a measure read at time t, the measure is queued when the
+        broker can't be reached
+        '''
+        # Queued measures are sent first, so the measures reach the broker in order
+        if (self._mqtt_server_connected and len(self._queue) == 0 and not self._mqttClient.inflight_full):
+            try:
+                self._send(t, topic, payload)
+                self._log.log_msg(APPLOG.DEBUG, "Published {}={}", topic, payload)
+                return
+            except (OSError, MQTTException) as e:
+                self._disconnected(e)
+        self._queue.put(t, topic, payload)
+        self._log.log_msg(APPLOG.DEBUG, "Queued {}={}, {} measures queued", topic, payload, len(self._queue))
+
+
+    def _try_connect(self):
+        if (self._failures > 0 and self._failures % _DNS_REFRESH == 0):
+            self._mqttClient.addrinfo = None # The broker may have moved
+        try:
+            self.mqtt_connect() # Open a connection to Adafruit
+        except (OSError, MQTTException) as e:
+            self._disconnected(e)
+
+
+    def _disconnected(self, e):
+        '''
+        Closes the connection after an error without sending DISCONNECT to a
+        broker that may not answer, the supervisor connects again after the
+        backoff_delay of the failed connects in a row
+        '''
+        self._log.log_msg(APPLOG.WARN, "MQTT broker {} not available: {} {}", params.MQTT_BROKER, e, type(e))
+        self._mqtt_server_connected = False
+        self._connecting = False
+        self._window.set() # drain stops waiting for acknowledgements
+        self._requeue()
+        try:
+            self._mqttClient.close()
+        except Exception:
+            pass
+        delay = backoff_delay(self._failures, params.MQTT_RECONNECT_MIN, params.MQTT_RECONNECT_MAX)
+        self._reconnect_at = time.ticks_add(time.ticks_ms(), int(delay * 1000))
+        self._failures += 1
+        self._connect_failures += 1
+        self._log.log_msg(APPLOG.DEBUG, "MQTT reconnect in {} seconds", int(delay))
+
+
+    def link_changed(self, up):
+        '''
+        Connects at once when the network link goes up, closes the connection
+        when it goes down instead of waiting for a socket error
+        '''
+        self._link_up = up
+        if (up):
+            self._failures = 0
+            self._reconnect_at = time.ticks_ms()
+        elif (self._mqtt_server_connected or self._connecting):
+            self._log.log_msg(APPLOG.INFO, "MQTT connection closed, network down")
+            self._mqtt_server_connected = False
+            self._connecting = False
+            self._window.set()
+            self._requeue()
+            try:
+                self._mqttClient.close() # The broker can't be reached to send DISCONNECT
+            except Exception:
+                pass
+
+
+    def _receive(self):
+        '''
+        Handles the packets received from the broker until no more data is
+        waiting, and sends again the QoS 1 messages not acknowledged in time
+        '''
+        client = self._mqttClient
+        client.check_msg() # Returns at once when nothing has been received
+        while (self._mqtt_server_connected and client.poller_r.poll(0)):
+            client.check_msg()
+
+
+    async def supervise(self):
+        '''
+        Keeps the connection to the broker alive. Wakes as soon as the broker
+        sends a packet to read it, and at least every MQTT_SUPERVISE_INTERVAL
+        seconds to ping the broker when nothing has been received for half the
+        keepalive period, close a connection that doesn't answer a ping within
+        MQTT_PING_TIMEOUT seconds and reconnect when the backoff delay is over
+        and the network link is up. A connect is checked every _CONNECT_POLL
+        seconds until the broker accepts it or MQTT_SOCKET_TIMEOUT is over.
+        '''
+        client = self._mqttClient
+        while True:
+            try:
+                now = time.ticks_ms()
+                if (self._connecting):
+                    self._poll_connect()
+                elif (not self._mqtt_server_connected):
+                    if (self._link_up and time.ticks_diff(now, self._reconnect_at) >= 0):
+                        self._try_connect()
+                else:
+                    self._receive()
+                    ping_pending = time.ticks_diff(client.last_ping, client.last_cpacket) > 0
+                    if (ping_pending):
+                        if (time.ticks_diff(now, client.last_ping) > params.MQTT_PING_TIMEOUT * 1000):
+                            raise MQTTException(30) # The broker doesn't answer
+                    elif (time.ticks_diff(now, client.last_cpacket) >= params.MQTT_KEEPALIVE * 500):
+                        if __debug__:
+                            self._log.log_msg(APPLOG.TRACE, "MQTT ping")
+                        client.ping()
+            except (OSError, MQTTException) as e:
+                self._disconnected(e)
+            except Exception as e:
+                self._log.log_msg(APPLOG.ERROR, "MQTT supervisor: {} {}", e, type(e))
+            if (self._mqtt_server_connected):
+                await _readable(client.sock, params.MQTT_SUPERVISE_INTERVAL)
+            else:
+                await asyncio.sleep(_CONNECT_POLL if self._connecting else params.MQTT_SUPERVISE_INTERVAL)
+
+
+    async def drain(self):
+        '''
+        Sends the queued measures, MQTT_QUEUE_BATCH at a time with
+        MQTT_QUEUE_SPACING seconds between the messages to respect the rate
+        limit of the broker. When the in-flight window is full it waits until
+        an acknowledgement frees a slot. Single measures are sent as JSON with the time
+        they were read, {"value": 21.5, "created_at": "2023-07-05T21:30:12"}.
+        '''
+        sent = 0
+        while (self._mqtt_server_connected and sent < params.MQTT_QUEUE_BATCH):
+            if (self._mqttClient.inflight_full): # Wait for the broker to acknowledge a message sent
+                self._window.clear()
+                try:
+                    await asyncio.wait_for(self._window.wait(), params.MQTT_SUPERVISE_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            message = self._queue.peek()
+            if (message is None):
+                break
+            t, topic, payload = message
+            data = payload
+            if (topic != params.MQTT_GROUP_TOPIC): # Group payloads hold the time of their records
+                data = '{{"value":{},"created_at":"{}"}}'.format(payload.decode(), mqtt_payload.iso_time(t)).encode()
+            try:
+                self._send(t, topic, payload, data)
+            except (OSError, MQTTException) as e:
+                self._disconnected(e)
+                break
+            self._queue.pop()
+            sent += 1
+            await asyncio.sleep(params.MQTT_QUEUE_SPACING)
+        if (sent > 0):
+            self._log.log_msg(APPLOG.INFO, "Sent {} queued measures, {} left, {} dropped", 
+                              sent, len(self._queue), self._queue.dropped)
+
+
+    def publish_telemetry(self):
+        '''
+        Publishes the counters of the network and MQTT connections on
+        MQTT_TELEMETRY_TOPIC every MQTT_TELEMETRY_INTERVAL seconds, an empty
+        topic turns the telemetry off. Telemetry is never queued, it is only
+        of interest when it can be sent.
+        '''
+        now = time.ticks_ms()
+        if (not params.MQTT_TELEMETRY_TOPIC or not self._mqtt_server_connected or self._mqttClient.inflight_full
+                or time.ticks_diff(now, self._telemetry_at) < params.MQTT_TELEMETRY_INTERVAL * 1000):
+            return
+        self._telemetry_at = now
+        payload = json.dumps({"wifi": self._conn.stats if self._conn else None, "mqtt": self.stats})
+        try:
+            self._mqttClient.publish(params.MQTT_TELEMETRY_TOPIC, payload.encode(), qos=0)
+        except (OSError, MQTTException) as e:
+            self._disconnected(e)
+
+
+    async def run(self):
+        '''
+        Looks at the measures each time the sensor is sampled and publishes
+        the measures worth reporting. A broker or network that is down never
+        stops the task, the measures are queued until the connection is back.
+        '''
+        while True:
+            try:
+                self.mqtt_publish()
+                await self.drain()
+                self.publish_telemetry()
+            except Exception as e:
+                self._log.log_msg(APPLOG.ERROR, "MQTT publisher: {} {}", e, type(e))
+            await asyncio.sleep(params.DHT11_POLL_INTERVALL)
+
+
+    @property
+    def policies(self):
+        ''' The report policies of the temperature and the humidity'''
+        return (self._temperature_policy, self._humidity_policy)
+
+
+    @property
+    def stats(self):
+        ''' Returns a dict with the state and the counters of the connection to the broker'''
+        client = self._mqttClient
+        return {
+            "connected": self._mqtt_server_connected,
+            "connect_failures": self._connect_failures,
+            "failures_in_row": self._failures,
+            "queued": len(self._queue),
+            "dropped": self._queue.dropped,
+            "inflight": len(client.inflight),
+            "bytes_sent": client.bytes_sent,
+            "bytes_received": client.bytes_received,
+            "packets_sent": client.packets_sent,
+            "packets_received": client.packets_received,
+        }
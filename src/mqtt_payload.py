@@ -0,0 +1,85 @@
+'''
+mqtt_payload.py
+Builds the payloads publishing several values in one MQTT message.
+
+A record is the tuple (time, temperature, humidity, sensor failures, uptime,
+mem_free) of one publish cycle. The records are sent as
+
+    JSON     for an Adafruit group feed, one record is
+             {"feeds": {"temperature": 21.0, "humidity": 45.0, "sensor-failures": 0,
+                        "uptime": 3600, "mem-free": 120000}, "created_at": "2023-07-05T21:30:12"}
+             and a batch of records is a list of these objects
+    binary   a version byte (1) and the number of records, then for each record
+             time (4 bytes), temperature and humidity in tenths (2 bytes each, signed),
+             sensor failures (2 bytes), uptime (4 bytes) and mem_free (4 bytes),
+             little endian, 20 bytes per record, unpack_binary decodes them
+'''
+import time
+try:
+    import ustruct as struct
+except ImportError:
+    import struct
+
+PAYLOAD_SINGLE = "single" # One message per value on its own topic
+PAYLOAD_JSON = "json"
+PAYLOAD_BINARY = "binary"
+PAYLOADS = (PAYLOAD_SINGLE, PAYLOAD_JSON, PAYLOAD_BINARY)
+
+BINARY_VERSION = 1
+BINARY_RECORD = "<IhhHII" # Time, temperature, humidity, sensor failures, uptime, mem_free
+BINARY_RECORD_SIZE = 20
+FEEDS = ("temperature", "humidity", "sensor-failures", "uptime", "mem-free")
+
+
+def iso_time(t):
+    ''' Formats a time in seconds since the epoch as 2023-07-05T21:30:12'''
+    ts = time.localtime(t)
+    return "{:4d}-{:02d}-{:02d}T{:02d}:{:02d}:{:02d}".format(ts[0], ts[1], ts[2], ts[3], ts[4], ts[5])
+
+
+def max_size(payload, batch):
+    '''
+    Returns the max bytes of a "json" or "binary" payload of batch records
+    '''
+    widest = (0x7fffffff, -40.0, 100.0, 0xffff, 0xffffffff, 0xffffffff)
+    return len(pack_json([widest] * batch) if payload == PAYLOAD_JSON else pack_binary([widest] * batch))
+
+
+def pack_json(records):
+    '''
+    Returns the JSON payload for a list of records
+    '''
+    items = []
+    for r in records:
+        feeds = ",".join('"{}":{}'.format(name, value) for name, value in zip(FEEDS, r[1:]))
+        items.append('{{"feeds":{{{}}},"created_at":"{}"}}'.format(feeds, iso_time(r[0])))
+    return (items[0] if len(items) == 1 else "[" + ",".join(items) + "]").encode()
+
+
+def pack_binary(records):
+    '''
+    Returns the binary payload for a list of records
+    '''
+    buffer = bytearray(2 + BINARY_RECORD_SIZE * len(records))
+    buffer[0] = BINARY_VERSION
+    buffer[1] = len(records)
+    offset = 2
+    for t, temperature, humidity, failures, uptime, mem_free in records:
+        struct.pack_into(BINARY_RECORD, buffer, offset, t & 0xffffffff, int(round(temperature * 10)),
+                         int(round(humidity * 10)), failures & 0xffff, uptime & 0xffffffff, mem_free)
+        offset += BINARY_RECORD_SIZE
+    return bytes(buffer)
+
+
+def unpack_binary(payload):
+    '''
+    Returns the list of records in a binary payload
+    '''
+    if (len(payload) < 2 or payload[0] != BINARY_VERSION or len(payload) < 2 + BINARY_RECORD_SIZE * payload[1]):
+        raise ValueError("Not a binary payload version {}".format(BINARY_VERSION))
+    records = []
+    for n in range(payload[1]):
+        t, temperature, humidity, failures, uptime, mem_free = \
+            struct.unpack_from(BINARY_RECORD, payload, 2 + n * BINARY_RECORD_SIZE)
+        records.append((t, temperature / 10, humidity / 10, failures, uptime, mem_free))
+    return records
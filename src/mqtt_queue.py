@@ -0,0 +1,250 @@
+'''
+mqtt_queue.py
+Keeps the messages that could not be published to the MQTT broker in a file
+on the flash, so they can be sent when the connection is back.
+
+The file is a ring of MQTT_QUEUE_SIZE // MQTT_QUEUE_SLOT fixed size slots, when
+all the slots are used the oldest message is dropped. A slot holds
+
+    header   magic 0xA6, sequence number (4 bytes), time (4 bytes),
+             topic length, payload length (2 bytes)
+    topic, payload
+    CRC32 of the header, the topic and the payload (4 bytes)
+
+Numbers are little endian. The magic of a slot is cleared when its message
+has been sent, the queue is found again after a reboot from the sequence
+numbers of the slots with a valid CRC.
+
+When the file can't be created, read or written, on a full or damaged
+filesystem, the queue goes on in MQTT_QUEUE_RAM_SIZE bytes of RAM, the
+messages are then lost at a reboot.
+'''
+import io
+try:
+    import ubinascii as binascii
+except ImportError:
+    import binascii
+try:
+    import ustruct as struct
+except ImportError:
+    import struct
+
+import appconfig as params
+from applog import APPLOG
+
+_MAGIC = 0xA6 # 0xA5 was the format with a one byte payload length
+_HEADER = "<BIIBH" # Magic, sequence number, time, topic length, payload length
+_HEADER_SIZE = 12
+_CRC_SIZE = 4
+
+
+# Returns True if sequence number a comes before b, the numbers wrap around at 2**32
+def _before(a, b):
+    return 0 < ((b - a) & 0xffffffff) < 0x80000000
+
+
+class MQTT_QUEUE:
+    '''
+    Bounded queue of messages (time, topic, payload) kept in a file, oldest first
+    '''
+    def __init__(self, log:APPLOG, path=params.MQTT_QUEUE_FILE, size=params.MQTT_QUEUE_SIZE,
+                 slot_size=params.MQTT_QUEUE_SLOT):
+        self._log = log
+        self._path = path
+        self._slot_size = slot_size
+        self._slots = size // slot_size
+        self._slot = bytearray(slot_size) # Buffer for the slot read or written
+        self._first = 0 # Slot of the oldest message
+        self._count = 0
+        self._seq = 0 # Sequence number of the next message
+        self._first_seq = 0 # Sequence number of the oldest message, or below it
+        self._dropped = 0 # Messages dropped when the queue was full
+        self._ram = None # The slots when the file can't be used, see _fail
+        if (self._slots > 0):
+            try:
+                self._load()
+            except OSError as e:
+                self._fail(e)
+
+    def __len__(self):
+        return self._count
+
+    @property
+    def dropped(self):
+        return self._dropped
+
+    def _load(self):
+        '''
+        Finds the queued messages in the file, creates the file if it doesn't
+        exist or doesn't have the size of the queue
+        '''
+        try:
+            f = io.open(self._path, "rb")
+        except OSError:
+            self._create()
+            return
+        try:
+            oldest = None
+            newest = None
+            slot = 0
+            while (slot < self._slots and f.readinto(self._slot) == self._slot_size):
+                seq = self._valid()
+                if (seq is not None):
+                    self._count += 1
+                    if (oldest is None or _before(seq, oldest[0])):
+                        oldest = (seq, slot)
+                    if (newest is None or _before(newest, seq)):
+                        newest = seq
+                slot += 1
+        finally:
+            f.close()
+        if (slot < self._slots): # The size of the queue was changed
+            self._log.log_msg(APPLOG.WARN, "MQTT queue {} resized, {} messages dropped", self._path, self._count)
+            self._count = 0
+            self._create()
+            return
+        if (oldest is not None):
+            self._first = oldest[1]
+            self._first_seq = oldest[0]
+            self._seq = (newest + 1) & 0xffffffff
+            self._log.log_msg(APPLOG.INFO, "MQTT queue {} messages waiting to be sent", self._count)
+
+    def _fail(self, e):
+        '''
+        The file can't be used, the queue goes on in RAM, empty
+        '''
+        self._log.log_msg(APPLOG.ERROR, "MQTT queue {} can't be used, {} messages dropped, queue kept in RAM: {}",
+                          self._path, self._count, e)
+        self._dropped += self._count
+        self._slots = params.MQTT_QUEUE_RAM_SIZE // self._slot_size
+        self._ram = bytearray(self._slots * self._slot_size)
+        self._first = 0
+        self._count = 0
+
+    def _create(self):
+        zeros = bytes(self._slot_size)
+        f = io.open(self._path, "wb")
+        try:
+            for _ in range(self._slots):
+                f.write(zeros)
+        finally:
+            f.close()
+
+    def _valid(self):
+        '''
+        Returns the sequence number of the message in the slot buffer,
+        None if the slot is free or damaged
+        '''
+        slot = self._slot
+        if (slot[0] != _MAGIC):
+            return None
+        magic, seq, t, topic_len, payload_len = struct.unpack_from(_HEADER, slot, 0)
+        end = _HEADER_SIZE + topic_len + payload_len
+        if (end + _CRC_SIZE > self._slot_size):
+            return None
+        if (struct.unpack_from("<I", slot, end)[0] != binascii.crc32(memoryview(slot)[:end]) & 0xffffffff):
+            return None
+        return seq
+
+    def _write_slot(self, slot, data):
+        if (self._ram is not None):
+            self._ram[slot * self._slot_size:slot * self._slot_size + len(data)] = data
+            return
+        f = io.open(self._path, "r+b")
+        try:
+            f.seek(slot * self._slot_size)
+            f.write(data)
+        finally:
+            f.close()
+
+    def _read_slot(self, slot):
+        ''' Reads a slot in the slot buffer'''
+        if (self._ram is not None):
+            self._slot[:] = memoryview(self._ram)[slot * self._slot_size:(slot + 1) * self._slot_size]
+            return
+        f = io.open(self._path, "rb")
+        try:
+            f.seek(slot * self._slot_size)
+            f.readinto(self._slot)
+        finally:
+            f.close()
+
+    def max_payload(self, topic):
+        ''' Returns the max bytes of a payload that can be queued with the topic'''
+        return self._slot_size - _HEADER_SIZE - _CRC_SIZE - len(topic)
+
+    def put(self, t, topic, payload, front=False):
+        '''
+        Queues a message, drops the oldest message if the queue is full.
+        With front set the message is put back before the oldest message,
+        for a message that was taken from the queue and could not be sent,
+        it is dropped if the queue is full.
+        Returns False if the message is too long for a slot.
+        '''
+        end = _HEADER_SIZE + len(topic) + len(payload)
+        if (self._slots == 0 or end + _CRC_SIZE > self._slot_size or len(topic) > 255):
+            self._log.log_msg(APPLOG.WARN, "MQTT message too long to be queued {}", topic)
+            return False
+        if (self._count == 0):
+            self._first_seq = self._seq
+        if (self._count == self._slots):
+            if (front):
+                self._dropped += 1
+                return True
+            self._advance()
+            self._dropped += 1
+        if (front):
+            self._first = (self._first - 1) % self._slots
+            self._first_seq = (self._first_seq - 1) & 0xffffffff
+            seq, index = self._first_seq, self._first
+        else:
+            seq, index = self._seq, (self._first + self._count) % self._slots
+            self._seq = (self._seq + 1) & 0xffffffff
+        slot = self._slot
+        struct.pack_into(_HEADER, slot, 0, _MAGIC, seq, t & 0xffffffff, len(topic), len(payload))
+        slot[_HEADER_SIZE:_HEADER_SIZE + len(topic)] = topic
+        slot[_HEADER_SIZE + len(topic):end] = payload
+        struct.pack_into("<I", slot, end, binascii.crc32(memoryview(slot)[:end]) & 0xffffffff)
+        try:
+            self._write_slot(index, memoryview(slot)[:end + _CRC_SIZE])
+        except OSError as e:
+            self._fail(e)
+            return self.put(t, topic, payload, front)
+        self._count += 1
+        return True
+
+    def _advance(self):
+        self._first = (self._first + 1) % self._slots
+        self._first_seq = (self._first_seq + 1) & 0xffffffff
+        self._count -= 1
+
+    def peek(self):
+        '''
+        Returns the oldest message as a tuple (time, topic, payload), None if
+        the queue is empty
+        '''
+        while (self._count > 0):
+            try:
+                self._read_slot(self._first)
+            except OSError as e:
+                self._fail(e)
+                break
+            if (self._valid() is not None):
+                magic, seq, t, topic_len, payload_len = struct.unpack_from(_HEADER, self._slot, 0)
+                topic = bytes(self._slot[_HEADER_SIZE:_HEADER_SIZE + topic_len])
+                return (t, topic, bytes(self._slot[_HEADER_SIZE + topic_len:_HEADER_SIZE + topic_len + payload_len]))
+            self._log.log_msg(APPLOG.WARN, "MQTT queue damaged message dropped")
+            self._advance()
+        return None
+
+    def pop(self):
+        '''
+        Removes the oldest message once it has been sent
+        '''
+        if (self._count > 0):
+            try:
+                self._write_slot(self._first, b"\0")
+            except OSError as e:
+                self._fail(e)
+                return
+            self._advance()
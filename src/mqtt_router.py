@@ -0,0 +1,122 @@
+'''
+mqtt_router.py
+Routes the messages received on the MQTT subscriptions to the handlers
+registered per topic filter.
+
+A topic filter is a topic with the MQTT wildcards
+    +   matches one level, username/feeds/+ matches username/feeds/led
+    #   matches the level above and all the levels below, it must be the last level,
+        username/# matches username, username/feeds and username/feeds/led
+Wildcards in the first level don't match topics starting with $ ($SYS/...).
+
+The filters are kept in a trie with one node per level, so a message only
+looks at the nodes along its topic instead of trying every filter.
+A node is a dict from the level to the next node, the handlers of the
+filter ending at the node are kept under the key None.
+'''
+
+_SEPARATOR = b"/"
+_ONE_LEVEL = b"+"
+_ALL_LEVELS = b"#"
+_HANDLERS = None # Key of the handlers in a node
+
+
+def _levels(topic_filter):
+    '''
+    Returns the levels of a topic filter, raises ValueError if a wildcard is misplaced
+    '''
+    levels = topic_filter.split(_SEPARATOR)
+    for i, level in enumerate(levels):
+        if (level == _ALL_LEVELS and i == len(levels) - 1 or level == _ONE_LEVEL):
+            continue
+        if (_ALL_LEVELS in level or _ONE_LEVEL in level):
+            raise ValueError("Invalid topic filter {}".format(topic_filter))
+    return levels
+
+
+class MQTT_ROUTER:
+    '''
+    Calls handler(topic, msg, retained, duplicate) for each filter matching
+    the topic of a message. The topic is bytes, msg is the payload as received,
+    a memoryview only valid during the call, handlers decode it if they need to.
+    '''
+    def __init__(self):
+        self._root = {}
+        self._count = 0
+
+
+    def add(self, topic_filter, handler):
+        '''
+        Registers a handler for the topic filter, a filter can have several handlers
+        '''
+        node = self._root
+        for level in _levels(topic_filter):
+            node = node.setdefault(level, {})
+        node.setdefault(_HANDLERS, []).append(handler)
+        self._count += 1
+
+
+    def remove(self, topic_filter, handler=None):
+        '''
+        Removes a handler, or all the handlers if handler is None, of the topic filter.
+        Returns the number of handlers removed.
+        '''
+        path = [self._root]
+        for level in _levels(topic_filter):
+            node = path[-1].get(level)
+            if (node is None):
+                return 0
+            path.append(node)
+        handlers = path[-1].get(_HANDLERS, [])
+        removed = len(handlers) if handler is None else handlers.count(handler)
+        if (removed > 0):
+            handlers[:] = [] if handler is None else [h for h in handlers if h != handler]
+            if (not handlers):
+                del path[-1][_HANDLERS]
+            # Prune the nodes left empty
+            levels = _levels(topic_filter)
+            for i in range(len(levels), 0, -1):
+                if (path[i]):
+                    break
+                del path[i - 1][levels[i - 1]]
+            self._count -= removed
+        return removed
+
+
+    def dispatch(self, topic, msg, retained=False, duplicate=False):
+        '''
+        Calls the handlers of the filters matching topic, returns the number of handlers called
+        '''
+        topic = bytes(topic)
+        return self._match(self._root, topic, topic.split(_SEPARATOR), 0, msg, retained, duplicate)
+
+
+    def _match(self, node, topic, levels, i, msg, retained, duplicate):
+        called = 0
+        wildcards = i > 0 or not topic.startswith(b"$")
+        child = node.get(_ALL_LEVELS) if wildcards else None
+        if (child is not None):
+            called += self._call(child, topic, msg, retained, duplicate)
+        if (i == len(levels)):
+            return called + self._call(node, topic, msg, retained, duplicate)
+        child = node.get(_ONE_LEVEL) if wildcards else None
+        if (child is not None):
+            called += self._match(child, topic, levels, i + 1, msg, retained, duplicate)
+        child = node.get(levels[i])
+        if (child is not None):
+            called += self._match(child, topic, levels, i + 1, msg, retained, duplicate)
+        return called
+
+
+    def _call(self, node, topic, msg, retained, duplicate):
+        handlers = node.get(_HANDLERS)
+        if (handlers is None):
+            return 0
+        for handler in handlers:
+            handler(topic, msg, retained, duplicate)
+        return len(handlers)
+
+
+    def __len__(self):
+        ''' Number of handlers registered'''
+        return self._count
@@ -1,79 +1,241 @@
 '''
-network.py
+netconn.py
 Manages connection to WiFi network
+
+The connection is a state machine advanced by poll, which never waits:
+    DOWN        not connected, connecting starts at the next poll
+    CONNECTING  waiting for the access point and an IP-address,
+                the led blinks
+    UP          connected, the led is on
+    BACKOFF     a connect failed or timed out, the next connect starts after
+                a delay doubled at each failure, with random jitter
+The listeners are called with True when the link goes up and False when it
+goes down, so the web server and the MQTT client follow the link instead of
+the application waiting for it or restarting the device.
+
+Each state change and, while connected, the signal strength every
+NETCONN_SAMPLE_INTERVAL seconds are recorded in a small history, with the
+counters in stats it tells the radio conditions apart from the application.
 '''
 import machine
 import network
-from time import sleep
+import time
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
 
 import appconfig as params
 from applog import APPLOG
+from apputil import RING, backoff_delay
+
+
+class NETCONN_HISTORY(RING):
+    '''
+    Fixed size ring with the last samples of the connection. Each record is
+    (time, state, status, rssi) where time is in seconds since the epoch, status
+    is the status of the interface and rssi the signal strength in dBm, 0 when
+    not connected.
+    '''
+    def __init__(self, size=params.NETCONN_HISTORY_SIZE):
+        super().__init__(size, ("I", "B", "b", "b"))
+
+    def append(self, t, state, status, rssi):
+        super().append(t, state, max(-128, min(127, status)), max(-128, min(127, rssi)))
 
 
 class NETCONN:
-    _ip_address = None # IP-address of the established connection
-    _netconn_led = None # Led that lights when the network is connected
+    DOWN = 0
+    CONNECTING = 1
+    UP = 2
+    BACKOFF = 3
+    STATES = ("down", "connecting", "up", "backoff")
 
     def __init__(self, log:APPLOG):
         self._log = log
+        self._wlan = network.WLAN(network.STA_IF) # Connect as a station interface. STA_IF meaning as any other device that normally connects to it.
+        self._netconn_led = machine.Pin(params.wifi_connected_pin, machine.Pin.OUT) # Led that lights when the network is connected
+        self._ip_address = None # IP-address of the established connection
+        self._state = NETCONN.DOWN
+        self._listeners = [] # Callables(up) called when the link goes up or down
+        self._failures = 0 # Failed connects in a row
+        self._connect_at = time.ticks_ms() # When the connect started, or when to connect next in BACKOFF
+        self._down_at = self._connect_at # When the link went down
+        self._history = NETCONN_HISTORY()
+        self._sampled_at = self._connect_at # When the signal strength was last recorded
+        self._rssi = 0 # Last signal strength in dBm, 0 when not connected
+        self._connects = 0 # Counters of the connection, see stats
+        self._link_losses = 0
+        self._connect_failures = 0
+        self._connect_ms = 0 # Time from link down to connected of the last connect
+        self._connect_ms_max = 0
 
-    # Returns True if there is an established connection 
+    # Returns True if there is an established connection
     def is_connected(self):
-        wlan = network.WLAN(network.STA_IF)
-        return wlan.isconnected()
+        return self._wlan.isconnected()
+
+
+    def add_listener(self, f):
+        ''' Add a callable(up) called with True when the link goes up, False when it goes down'''
+        self._listeners.append(f)
 
 
     def wifi_connect(self):
-        wlan = network.WLAN(network.STA_IF) # Connect as a station interface. STA_IF meaning as any other device that normally connects to it.
-        self._netconn_led = machine.Pin(params.wifi_connected_pin, machine.Pin.OUT)
-
-        self._log.log_msg(APPLOG.TRACE, "isconnected=" + str(wlan.isconnected()))
-        if (wlan.isconnected() == False):
-            wlan.active(True) # Turns on the wifi-interface
-            wlan.connect(params.wifi_ssid, params.wifi_pwd)		# Ask the interaface to connect to the network whose ssid is provided, with the provided password.
-            loop_count = 0
-            while wlan.isconnected() == False:	# While the interface is not connected, print message and wait for 1 sec, do this until it is connected
-                wstat = wlan.status()
-                loop_count += 1
-                if (loop_count > 60):
-                    self._log.log_msg(APPLOG.FATAL, "No WLAN connection status={}".format(wstat))
-                    machine.reset()
-
-                if (loop_count % 5 == 0):
-                    self._log.log_msg(APPLOG.DEBUG, 'Waiting for connection... status=' + str(wstat))
-                    self._netconn_led.on();
-                sleep(0.5)
-                self._netconn_led.off();
-                sleep(0.5)
-
-        self._ip_address = wlan.ifconfig()[0]	# Sets the ip adress of the pico. Length of the array is four, where router ip is the last, and the pico adress is the first.
-        self._netconn_led = machine.Pin(params.wifi_connected_pin, machine.Pin.OUT)
-        self._netconn_led.on();
-        self._log.log_msg(APPLOG.DEBUG, "IP:" + str(self._ip_address))
-        return wlan
-        
+        '''
+        Asks the interface to connect to the network, returns at once,
+        poll follows the connection
+        '''
+        if __debug__:
+            self._log.log_msg(APPLOG.TRACE, "wifi_connect status={}", self._wlan.status())
+        self._wlan.active(True) # Turns on the wifi-interface
+        self._wlan.connect(params.wifi_ssid, params.wifi_pwd) # Ask the interaface to connect to the network whose ssid is provided, with the provided password.
+        self._connect_at = time.ticks_ms()
+        self._set_state(NETCONN.CONNECTING)
+
+
+    def poll(self):
+        '''
+        Advances the state machine, called every NETCONN_POLL_INTERVAL seconds by run
+        '''
+        now = time.ticks_ms()
+        connected = self._wlan.isconnected()
+        if (self._state == NETCONN.UP):
+            if (not connected):
+                self._log.log_msg(APPLOG.WARN, "WLAN connection lost status={}", self._wlan.status())
+                self._ip_address = None
+                self._netconn_led.off()
+                self._rssi = 0
+                self._link_losses += 1
+                self._down_at = now
+                self._set_state(NETCONN.DOWN)
+                self._notify(False)
+            elif (time.ticks_diff(now, self._sampled_at) >= params.NETCONN_SAMPLE_INTERVAL * 1000):
+                self._sample(now)
+        elif (connected):
+            self._ip_address = self._wlan.ifconfig()[0] # Sets the ip adress of the pico. Length of the array is four, where router ip is the last, and the pico adress is the first.
+            self._netconn_led.on()
+            self._connect_ms = time.ticks_diff(now, self._down_at)
+            self._connect_ms_max = max(self._connect_ms, self._connect_ms_max)
+            self._connects += 1
+            self._failures = 0
+            self._log.log_msg(APPLOG.INFO, "WLAN connected IP:{} in {} ms", self._ip_address, self._connect_ms)
+            self._rssi = self._read_rssi()
+            self._sampled_at = now
+            self._set_state(NETCONN.UP)
+            self._notify(True)
+        elif (self._state == NETCONN.CONNECTING):
+            wstat = self._wlan.status()
+            if (wstat < 0 or time.ticks_diff(now, self._connect_at) > params.NETCONN_CONNECT_TIMEOUT * 1000):
+                self._failed(wstat)
+            else:
+                self._netconn_led.value(not self._netconn_led.value()) # Blink while connecting
+        elif (self._state == NETCONN.DOWN or time.ticks_diff(now, self._connect_at) >= 0):
+            self.wifi_connect()
+
+
+    def _failed(self, wstat):
+        '''
+        Gives up a connect, the next connect starts after the backoff_delay
+        of the failed connects in a row
+        '''
+        try:
+            self._wlan.disconnect()
+        except Exception as e:
+            self._log.log_msg(APPLOG.ERROR, "wifi_disconnect: {} {}", e, type(e))
+        self._netconn_led.off()
+        delay = backoff_delay(self._failures, params.NETCONN_RECONNECT_MIN, params.NETCONN_RECONNECT_MAX)
+        self._connect_at = time.ticks_add(time.ticks_ms(), int(delay * 1000))
+        self._failures += 1
+        self._connect_failures += 1
+        self._set_state(NETCONN.BACKOFF, wstat)
+        self._log.log_msg(APPLOG.WARN, "No WLAN connection status={}, next try in {} seconds", wstat, int(delay))
+
+
+    def _set_state(self, state, wstat=None):
+        self._state = state
+        self._history.append(int(time.time()), state, self._wlan.status() if wstat is None else wstat, self._rssi)
+
+
+    def _read_rssi(self):
+        try:
+            return self._wlan.status("rssi")
+        except Exception: # Not connected, or not known by the interface
+            return 0
+
+
+    def _sample(self, now):
+        ''' Records the signal strength'''
+        self._rssi = self._read_rssi()
+        self._sampled_at = now
+        self._history.append(int(time.time()), self._state, self._wlan.status(), self._rssi)
+
+
+    def _notify(self, up):
+        for f in self._listeners:
+            try:
+                f(up)
+            except Exception as e:
+                self._log.log_msg(APPLOG.ERROR, "WLAN listener: {} {}", e, type(e))
+
+
+    async def run(self):
+        '''
+        Connects to the network and keeps the connection up
+        '''
+        while True:
+            try:
+                self.poll()
+            except Exception as e:
+                self._log.log_msg(APPLOG.ERROR, "WLAN supervisor: {} {}", e, type(e))
+            await asyncio.sleep(params.NETCONN_POLL_INTERVAL)
+
+
     def wifi_disconnect(self):
         try:
             if (self.is_connected() == True):
-                wlan = network.WLAN(network.STA_IF) 
-                wlan.disconnect()
-                wlan.active(False)
-                wlan.deinit()
+                self._wlan.disconnect()
+                self._wlan.active(False)
+                self._wlan.deinit()
         except Exception as e:
-            self._log.log_msg(APPLOG.ERROR, "wifi_disconnect: " + str(e))
-            self._log.log_msg(APPLOG.ERROR, type(e))
+            self._log.log_msg(APPLOG.ERROR, "wifi_disconnect: {} {}", e, type(e))
 
         try:
-            netconn_led = machine.Pin(params.wifi_connected_pin, machine.Pin.OUT)
-            netconn_led.off()
+            self._netconn_led.off()
         except Exception as e:
-            self._log.log_msg(APPLOG.ERROR, "wifi_disconnect (led): " + str(e))
-            self._log.log_msg(APPLOG.ERROR, type(e))
+            self._log.log_msg(APPLOG.ERROR, "wifi_disconnect (led): {} {}", e, type(e))
+        self._rssi = 0
+        self._state = NETCONN.DOWN
+
+
+    @property
+    def ip_address(self):
+        ''' IP-address of the connection, None when not connected'''
+        return self._ip_address
+
+
+    @property
+    def state(self):
+        ''' The state of the connection, NETCONN.DOWN, CONNECTING, UP or BACKOFF'''
+        return self._state
+
 
+    @property
+    def history(self):
+        ''' The NETCONN_HISTORY of the connection'''
+        return self._history
 
-    # Returns the network connection object 
-    def connect(self):
-        if (self.is_connected() == False):
-            self.wifi_connect() # Connect to the network if not already done
 
-        return network.WLAN(network.STA_IF)
\ No newline at end of file
+    @property
+    def stats(self):
+        ''' Returns a dict with the state and the counters of the connection'''
+        return {
+            "state": NETCONN.STATES[self._state],
+            "ip": self._ip_address,
+            "rssi": self._rssi,
+            "connects": self._connects,
+            "reconnects": max(0, self._connects - 1),
+            "link_losses": self._link_losses,
+            "connect_failures": self._connect_failures,
+            "connect_ms": self._connect_ms,
+            "connect_ms_max": self._connect_ms_max,
+        }
@@ -0,0 +1,75 @@
+'''
+report_policy.py
+Decides when a measured value is worth publishing (report by exception)
+instead of publishing every value on a fixed interval.
+
+A value is reported when
+    it is the first value,
+    it differs from the last value reported by at least the deadband,
+    it changes faster than the rate, in units per minute, measured over at least
+    rate_window seconds so the noise between two reads doesn't count as a fast change,
+    or nothing has been reported for the heartbeat interval,
+but never sooner than the minimum spacing after the last report.
+tools/report_policy_sim.py simulates the policy on recorded values.
+'''
+
+
+class REPORT_POLICY:
+    '''
+    Report by exception policy of one channel (temperature, humidity...)
+    A deadband or rate of 0 turns that rule off.
+    '''
+    def __init__(self, deadband, rate=0, heartbeat=600, min_spacing=60, rate_window=60):
+        self.deadband = deadband
+        self.rate = rate
+        self.rate_window = rate_window
+        self.heartbeat = heartbeat
+        self.min_spacing = min_spacing
+        self.reset()
+
+    def reset(self):
+        self._reported_value = None
+        self._reported_time = 0
+        self._rate_value = None # Value the rate is measured from
+        self._rate_time = 0
+        self._next_value = None # Becomes the value the rate is measured from after rate_window
+        self._next_time = 0
+        self.samples = 0
+        self.reports = 0
+
+    def update(self, value, t):
+        '''
+        Returns True if the value read at time t, in seconds, is to be reported
+        '''
+        self.samples += 1
+        report = self._due(value, t)
+        if (self._next_value is None or t - self._next_time >= self.rate_window):
+            self._rate_value = self._next_value
+            self._rate_time = self._next_time
+            self._next_value = value
+            self._next_time = t
+        if (report):
+            self._reported_value = value
+            self._reported_time = t
+            self.reports += 1
+        return report
+
+    def _due(self, value, t):
+        if (self._reported_value is None):
+            return True
+        elapsed = t - self._reported_time
+        if (elapsed < self.min_spacing):
+            return False
+        if (elapsed >= self.heartbeat):
+            return True
+        if (self.deadband > 0 and abs(value - self._reported_value) >= self.deadband):
+            return True
+        if (self.rate > 0 and self._rate_value is not None and 
+                abs(value - self._rate_value) * 60 / (t - self._rate_time) >= self.rate):
+            return True
+        return False
+
+    @property
+    def reported(self):
+        ''' The last value reported, None before the first report'''
+        return self._reported_value
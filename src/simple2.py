@@ -6,6 +6,10 @@ https://github.com/fizista/micropython-umqtt.simple2
 import usocket as socket
 import uselect
 from utime import ticks_add, ticks_ms, ticks_diff
+try:
+    import uheapq as heapq
+except ImportError:
+    import heapq
 
 
 class MQTTException(Exception):
@@ -21,7 +25,7 @@ def pid_gen(pid=0):
 class MQTTClient:
 
     def __init__(self, client_id, server, port=0, user=None, password=None, keepalive=0,
-                 ssl=False, ssl_params=None, socket_timeout=15, message_timeout=10):
+                 ssl=False, ssl_params=None, socket_timeout=15, message_timeout=10, max_inflight=8, max_retries=2):
         """
         Default constructor, initializes MQTTClient object.
 
@@ -51,6 +55,12 @@ class MQTTClient:
         :param message_timeout: The time in seconds after which the library recognizes that a message with QoS=1
                                 or topic subscription has not been received by the server.
         :type message_timeout: int
+        :param max_inflight: The number of QoS=1 messages sent and not yet acknowledged by the server, publish
+                             raises MQTTException(9) when the window is full.
+        :type max_inflight: int
+        :param max_retries: The number of times a QoS=1 message is sent again with the DUP flag when the server
+                            doesn't acknowledge it within message_timeout.
+        :type max_retries: int
         """
         if port == 0:
             port = 8883 if ssl else 1883
@@ -60,6 +70,7 @@ class MQTTClient:
         self.poller_w = None
         self.server = server
         self.port = port
+        self.addrinfo = None  # Cached result of getaddrinfo for server and port
         self.ssl = ssl
         self.ssl_params = ssl_params if ssl_params else {}
         self.newpid = pid_gen()
@@ -74,48 +85,72 @@ class MQTTClient:
         self.lw_msg = b""
         self.lw_qos = 0
         self.lw_retain = False
-        self.rcv_pids = {}  # PUBACK and SUBACK pids awaiting ACK response
+        self.rcv_pids = {}  # PUBACK and SUBACK pids awaiting ACK response, the deadline of each pid
+        self.inflight = {}  # QoS=1 messages awaiting PUBACK, pid: [topic, msg, retain, retries]
+        self.deadlines = []  # Heap of (deadline, pid), deadline in ms after tick_base
+        self.tick_base = ticks_ms()
+        self.max_inflight = max_inflight
+        self.max_retries = max_retries
 
         self.last_ping = ticks_ms()  # Time of the last PING sent
         self.last_cpacket = ticks_ms()  # Time of last Control Packet
 
         self.socket_timeout = socket_timeout
         self.message_timeout = message_timeout
-
-    def _read(self, n):
+        self.txbuf = bytearray(128)  # Packets are assembled here and sent with one write
+        self.connect_len = 0  # Length of the CONNECT packet in txbuf not yet sent, see connect_poll
+        self.connect_deadline = None  # When connect_poll gives up
+        self.rxbuf = bytearray(128)  # Packets are received here, see _read
+        self.rxview = memoryview(self.rxbuf)
+        self.bytes_sent = 0  # Counters of the traffic on the socket, kept across connections
+        self.bytes_received = 0
+        self.packets_sent = 0
+        self.packets_received = 0
+
+    def _read(self, n, start=0):
         """
         Private class method.
 
         :param n: Expected length of read bytes
         :type n: int
-        :return:
+        :param start: Bytes already at the start of the receive buffer, kept and
+                      not read again
+        :type start: int
+        :return: memoryview of the bytes read at the start of the receive buffer,
+                 valid until the next read
 
         Notes:
-        Current usocket implementation returns None on .read from
+        Current usocket implementation returns None on .readinto from
         non-blocking socket with no data. However, OSError
         EAGAIN is checked for in case this ever changes.
         """
         if n < 0:
             raise MQTTException(2)
-        msg = b''
-        while len(msg) < n:
+        if len(self.rxbuf) < n:
+            rxbuf = bytearray(n)
+            rxbuf[:start] = self.rxview[:start]
+            self.rxbuf = rxbuf
+            self.rxview = memoryview(rxbuf)
+        got = start
+        while got < n:
             try:
-                rbytes = self.sock.read(n - len(msg))
+                rcount = self.sock.readinto(self.rxview[got:n])
             except OSError as e:
                 if e.args[0] == 11:     # EAGAIN / EWOULDBLOCK
-                    rbytes = None
+                    rcount = None
                 else:
                     raise
             except AttributeError:
                 raise MQTTException(8)
-            if rbytes is None:
+            if rcount is None:
                 self._sock_timeout(self.poller_r, self.socket_timeout)
                 continue
-            if rbytes == b'':
+            if rcount == 0:
                 raise MQTTException(1) # Connection closed by host (?)
             else:
-                msg += rbytes
-        return msg
+                got += rcount
+        self.bytes_received += n - start
+        return self.rxview[:n]
 
     def _write(self, bytes_wr, length=-1):
         """
@@ -139,32 +174,83 @@ class MQTTClient:
         else:
             if out != length:
                 raise MQTTException(3)
+        self.bytes_sent += out
+        self.packets_sent += 1
         return out
 
-    def _send_str(self, s):
+    def _bytes(self, s):
         """
         Private class method.
         :param s:
-        :type s: byte
-        :return: None
+        :type s: str or byte
+        :return: s as bytes
         """
-        assert len(s) < 65536
-        self._write(len(s).to_bytes(2, 'big'))
-        self._write(s)
+        return s.encode() if isinstance(s, str) else s
 
-    def _recv_len(self):
+    def _tx(self, size):
         """
         Private class method.
-        :return:
+        Returns the buffer packets are assembled in, grown to hold size bytes if needed.
+
+        :param size: Length of the packet
+        :type size: int
+        :return: bytearray
+        """
+        if len(self.txbuf) < size:
+            self.txbuf = bytearray(size)
+        return self.txbuf
+
+    def _put_str(self, buf, offset, s):
+        """
+        Private class method.
+        Copies a string prefixed with its length into the packet buffer.
+
+        :param buf: Packet buffer
+        :type buf: bytearray
+        :param offset: Position in buf
+        :type offset: int
+        :param s:
+        :type s: byte
+        :return: Position in buf after the string
         :rtype int
         """
+        n = len(s)
+        assert n < 65536
+        buf[offset] = n >> 8
+        buf[offset + 1] = n & 0xFF
+        buf[offset + 2:offset + 2 + n] = s
+        return offset + 2 + n
+
+    def _recv_len(self, min_len=0):
+        """
+        Private class method.
+        Reads the remaining length together with the first min_len bytes of the
+        packet, which are always there, so a length of one or two bytes takes a
+        single read instead of one read per byte.
+
+        :param min_len: Least remaining length of the packet
+        :type min_len: int
+        :return: The remaining length, and the length of the fixed header part
+                 at the start of the receive buffer, the packet bytes read so
+                 far follow it
+        :rtype tuple
+        """
+        got = 1 + min_len
+        buf = self._read(got)
         n = 0
         sh = 0
+        i = 0
         while 1:
-            b = self._read(1)[0]
+            if i == got:  # Only length bytes so far
+                if got == 4:
+                    raise MQTTException(-1)  # Longer than four bytes
+                buf = self._read(got + 1, got)
+                got += 1
+            b = buf[i]
+            i += 1
             n |= (b & 0x7f) << sh
             if not b & 0x80:
-                return n
+                return n, i
             sh += 7
 
     def _varlen_encode(self, value, buf, offset=0):
@@ -179,29 +265,43 @@ class MQTTClient:
     def _sock_timeout(self, poller, socket_timeout):
         if self.sock:
             res = poller.poll(-1 if socket_timeout is None else int(socket_timeout * 1000))
-            # https://github.com/micropython/micropython/issues/3747#issuecomment-385650294
-            # Sockets on esp8266 don't return POLLHUP or POLLERR at all.
-            # If a connection is broken then the socket will become readable and a read on it will return b''.
-            # POLLIN(value:1) - you have something to read
-            # POLLHUP(value:16) - your input is ended
-            # POLLIN(1) & POLLHUP(16) = 17 - that meanss that your input is ended and that your have still
-            #                                something to read from the buffer
-            if res:
-                for fd, flag in res:
-                    if (not flag & uselect.POLLIN) and (flag & uselect.POLLHUP):
-                        raise MQTTException(2 if poller == self.poller_r else 3)
-                    if (flag & uselect.POLLERR):
-                        raise MQTTException(1)
-            else:
+            if not self._poll_ready(poller, res):
                 raise MQTTException(30)
         else:
             raise MQTTException(28)
 
+    def _poll_ready(self, poller, res):
+        """
+        Private class method.
+        Checks the result of poller.poll.
+
+        :return: True when the socket is ready, False when poll returned nothing
+        :rtype: bool
+        """
+        # https://github.com/micropython/micropython/issues/3747#issuecomment-385650294
+        # Sockets on esp8266 don't return POLLHUP or POLLERR at all.
+        # If a connection is broken then the socket will become readable and a read on it will return b''.
+        # POLLIN(value:1) - you have something to read
+        # POLLHUP(value:16) - your input is ended
+        # POLLIN(1) & POLLHUP(16) = 17 - that meanss that your input is ended and that your have still
+        #                                something to read from the buffer
+        if not res:
+            return False
+        for fd, flag in res:
+            if (not flag & uselect.POLLIN) and (flag & uselect.POLLHUP):
+                raise MQTTException(2 if poller == self.poller_r else 3)
+            if (flag & uselect.POLLERR):
+                raise MQTTException(1)
+        return True
+
     def set_callback(self, f):
         """
         Set callback for received subscription messages.
 
         :param f: callable(topic, msg, retained, duplicate)
+
+        topic and msg are memoryviews of the receive buffer, they are only
+        valid during the call, use bytes(msg) to keep a copy.
         """
         self.cb = f
 
@@ -217,6 +317,7 @@ class MQTTClient:
             status = 1 - successfully delivered
             status = 2 - Unknown PID. It is also possible that the PID is outdated,
                          i.e. it came out of the message timeout.
+            status = 3 - subscription refused by the server, the connection stays open
         """
         self.cbstat = f
 
@@ -252,10 +353,28 @@ class MQTTClient:
         :return: Existing persistent session of the client from previous interactions.
         :rtype: bool
         """
-        #self.disconnect()
+        n = self.connect_start(clean_session)
+        self._write(self.txbuf, n)
+        self.connect_len = 0
+        return self._connack(self._read(4))
 
+    def connect_start(self, clean_session=True):
+        """
+        Starts a connection with the MQTT server without waiting for it, connect_poll
+        follows the connection until the server accepts it.
+        The address of the server is looked up at the first connect only and with
+        ssl the handshake waits for the server.
 
-        ai = socket.getaddrinfo(self.server, self.port)[0]
+        :param clean_session: Starts new session on true, resumes past session if false.
+        :type clean_session: bool
+        :return: Length of the CONNECT packet assembled in txbuf
+        :rtype: int
+        """
+        # The address of the server is looked up once, reconnects skip the
+        # DNS query, set addrinfo to None to look it up again
+        if self.addrinfo is None:
+            self.addrinfo = socket.getaddrinfo(self.server, self.port)[0]
+        ai = self.addrinfo
 
         self.sock_raw = socket.socket(ai[0], ai[1], ai[2])
         self.sock_raw.setblocking(False)
@@ -301,42 +420,85 @@ class MQTTClient:
         # 11,12 - keepalive
         # 13,14 - client ID length
         # 15-15+len(client_id) - byte(client_id)
-        premsg = bytearray(b"\x10\0\0\0\0\0")
-        msg = bytearray(b"\0\x04MQTT\x04\0\0\0")
-
-        sz = 10 + 2 + len(self.client_id)
+        flags = bool(clean_session) << 1
+        client_id = self._bytes(self.client_id)
+        sz = 10 + 2 + len(client_id)
 
-        msg[7] = bool(clean_session) << 1
         # Clean session = True, remove current session
         if bool(clean_session):
             self.rcv_pids.clear()
+            self.inflight.clear()
+            self.deadlines.clear()
+        user = pswd = None
         if self.user is not None:
-            sz += 2 + len(self.user)
-            msg[7] |= 1 << 7  # User Name Flag
+            user = self._bytes(self.user)
+            sz += 2 + len(user)
+            flags |= 1 << 7  # User Name Flag
             if self.pswd is not None:
-                sz += 2 + len(self.pswd)
-                msg[7] |= 1 << 6  # # Password Flag
+                pswd = self._bytes(self.pswd)
+                sz += 2 + len(pswd)
+                flags |= 1 << 6  # # Password Flag
         if self.keepalive:
             assert self.keepalive < 65536
-            msg[8] |= self.keepalive >> 8
-            msg[9] |= self.keepalive & 0x00FF
         if self.lw_topic:
             sz += 2 + len(self.lw_topic) + 2 + len(self.lw_msg)
-            msg[7] |= 0x4 | (self.lw_qos & 0x1) << 3 | (self.lw_qos & 0x2) << 3
-            msg[7] |= self.lw_retain << 5
-
-        plen = self._varlen_encode(sz, premsg, 1)
-        self._write(premsg, plen)
-        self._write(msg)
-        self._send_str(self.client_id)
+            flags |= 0x4 | (self.lw_qos & 0x1) << 3 | (self.lw_qos & 0x2) << 3
+            flags |= self.lw_retain << 5
+
+        buf = self._tx(5 + sz)
+        buf[0] = 0x10
+        i = self._varlen_encode(sz, buf, 1)
+        buf[i:i + 7] = b"\0\x04MQTT\x04"
+        buf[i + 7] = flags
+        buf[i + 8] = self.keepalive >> 8
+        buf[i + 9] = self.keepalive & 0x00FF
+        i = self._put_str(buf, i + 10, client_id)
         if self.lw_topic:
-            self._send_str(self.lw_topic)
-            self._send_str(self.lw_msg)
-        if self.user is not None:
-            self._send_str(self.user)
-            if self.pswd is not None:
-                self._send_str(self.pswd)
-        resp = self._read(4)
+            i = self._put_str(buf, i, self._bytes(self.lw_topic))
+            i = self._put_str(buf, i, self._bytes(self.lw_msg))
+        if user is not None:
+            i = self._put_str(buf, i, user)
+            if pswd is not None:
+                i = self._put_str(buf, i, pswd)
+        self.connect_len = i
+        self.connect_deadline = None if self.socket_timeout is None else \
+            ticks_add(ticks_ms(), int(self.socket_timeout * 1000))
+        return i
+
+    def connect_poll(self):
+        """
+        Advances a connection started by connect_start, never waits. Sends the
+        CONNECT packet when the socket is connected and reads the CONNACK when it
+        has arrived. Raises MQTTException(30) when the server hasn't accepted the
+        connection within socket_timeout.
+
+        :return: None while connecting, then the existing persistent session of the
+                 client as connect returns it.
+        :rtype: bool
+        """
+        if not self.sock:
+            raise MQTTException(28)
+        if self.connect_deadline is not None and ticks_diff(ticks_ms(), self.connect_deadline) > 0:
+            raise MQTTException(30)
+        if self.connect_len:
+            if not self._poll_ready(self.poller_w, self.poller_w.poll(0)):
+                return None
+            self._write(self.txbuf, self.connect_len)
+            self.connect_len = 0
+        if not self._poll_ready(self.poller_r, self.poller_r.poll(0)):
+            return None
+        return self._connack(self._read(4))
+
+    def _connack(self, resp):
+        """
+        Private class method.
+        Checks the CONNACK packet.
+
+        :param resp: The 4 bytes of the CONNACK
+        :return: Existing persistent session of the client from previous interactions.
+        :rtype: bool
+        """
+        self.packets_received += 1
         if not (resp[0] == 0x20 and resp[1] == 0x02):  # control packet type, Remaining Length == 2
             raise MQTTException(29)
         if resp[3] != 0:
@@ -358,6 +520,16 @@ class MQTTClient:
             self._write(b"\xe0\0")
         except (OSError, MQTTException):
             pass
+        self.close()
+
+    def close(self):
+        """
+        Closes the socket without sending DISCONNECT, when the connection is known
+        to be lost a write would only wait for socket_timeout.
+        :return: None
+        """
+        if not self.sock:
+            return
         if self.poller_r:
             self.poller_r.unregister(self.sock)
         if self.poller_w:
@@ -369,6 +541,7 @@ class MQTTClient:
         self.poller_r = None
         self.poller_w = None
         self.sock = None
+        self.connect_len = 0
 
     def ping(self):
         """
@@ -392,26 +565,65 @@ class MQTTClient:
         :type qos: int
         :param dup: Duplicate delivery of a PUBLISH Control Packet
         :type dup: bool
-        :return: None
+        :return: None, or the pid of a QoS=1 message. The message is kept until the server acknowledges it,
+                 don't change msg before. Raises MQTTException(9) when max_inflight messages are not yet
+                 acknowledged.
         """
         assert qos in (0, 1)
-        pkt = bytearray(b"\x30\0\0\0\0")
-        pkt[0] |= qos << 1 | retain | int(dup) << 3
-        sz = 2 + len(topic) + len(msg)
-        if qos > 0:
-            sz += 2
-        plen = self._varlen_encode(sz, pkt, 1)
-        self._write(pkt, plen)
-        self._send_str(topic)
+        topic = self._bytes(topic)
+        msg = self._bytes(msg)
         pid = 0
         if qos > 0:
+            if len(self.inflight) >= self.max_inflight:
+                raise MQTTException(9)  # Wait for the server to acknowledge the messages sent
             pid = next(self.newpid)
-            self._write(pid.to_bytes(2, 'big'))
-        self._write(msg)
+        self._send_publish(topic, msg, retain, qos, dup, pid)
         if qos > 0:
-            self.rcv_pids[pid] = ticks_add(ticks_ms(), self.message_timeout * 1000)
+            self.inflight[pid] = [topic, msg, retain, 0]
+            self._await_ack(pid)
             return pid
 
+    def _send_publish(self, topic, msg, retain, qos, dup, pid):
+        """
+        Private class method.
+        Assembles the PUBLISH packet and sends it with one write.
+        """
+        sz = 2 + len(topic) + len(msg)
+        if qos > 0:
+            sz += 2
+        buf = self._tx(5 + sz)
+        buf[0] = 0x30 | qos << 1 | retain | int(dup) << 3
+        i = self._varlen_encode(sz, buf, 1)
+        i = self._put_str(buf, i, topic)
+        if qos > 0:
+            buf[i] = pid >> 8
+            buf[i + 1] = pid & 0xFF
+            i += 2
+        buf[i:i + len(msg)] = msg
+        self._write(buf, i + len(msg))
+
+    def _await_ack(self, pid):
+        """
+        Private class method.
+        Sets the deadline for the acknowledgement of pid and adds it to the deadline heap.
+        """
+        deadline = ticks_add(ticks_ms(), self.message_timeout * 1000)
+        self.rcv_pids[pid] = deadline
+        key = ticks_diff(deadline, self.tick_base)
+        if key > 0x10000000:  # Move the base before the keys get near the wrap of the ticks
+            self.tick_base = ticks_ms()
+            self.deadlines = [(ticks_diff(d, self.tick_base), p) for p, d in self.rcv_pids.items()]
+            heapq.heapify(self.deadlines)
+        else:
+            heapq.heappush(self.deadlines, (key, pid))
+
+    @property
+    def inflight_full(self):
+        """
+        True when publish with QoS=1 must wait for acknowledgements from the server.
+        """
+        return len(self.inflight) >= self.max_inflight
+
     def subscribe(self, topic, qos=0):
         """
         Subscribes to a given topic.
@@ -425,22 +637,41 @@ class MQTTClient:
         """
         assert qos in (0, 1)
         assert self.cb is not None, "Subscribe callback is not set"
-        pkt = bytearray(b"\x82\0\0\0\0\0\0")
+        topic = self._bytes(topic)
         pid = next(self.newpid)
         sz = 2 + 2 + len(topic) + 1
-        plen = self._varlen_encode(sz, pkt, 1)
-        pkt[plen:plen + 2] = pid.to_bytes(2, 'big')
-        self._write(pkt, plen + 2)
-        self._send_str(topic)
-        self._write(qos.to_bytes(1, "little"))  # maximum QOS value that can be given by the server to the client
-        self.rcv_pids[pid] = ticks_add(ticks_ms(), self.message_timeout * 1000)
+        buf = self._tx(5 + sz)
+        buf[0] = 0x82
+        i = self._varlen_encode(sz, buf, 1)
+        buf[i] = pid >> 8
+        buf[i + 1] = pid & 0xFF
+        i = self._put_str(buf, i + 2, topic)
+        buf[i] = qos  # maximum QOS value that can be given by the server to the client
+        self._write(buf, i + 1)
+        self._await_ack(pid)
         return pid
 
     def _message_timeout(self):
-        curr_tick = ticks_ms()
-        for pid, timeout in self.rcv_pids.items():
-            if ticks_diff(timeout, curr_tick) <= 0:
+        """
+        Private class method.
+        Handles the acknowledgements past their deadline, only the heap entries
+        that are due are looked at. A QoS=1 message is sent again with the DUP flag
+        until it has been sent max_retries times, then its status is reported as a timeout.
+        """
+        now = ticks_diff(ticks_ms(), self.tick_base)
+        while self.deadlines and self.deadlines[0][0] <= now:
+            key, pid = heapq.heappop(self.deadlines)
+            deadline = self.rcv_pids.get(pid)
+            if deadline is None or ticks_diff(deadline, self.tick_base) != key:
+                continue  # Acknowledged, or sent again with a later deadline
+            msg = self.inflight.get(pid)
+            if msg is not None and msg[3] < self.max_retries:
+                msg[3] += 1
+                self._send_publish(msg[0], msg[1], msg[2], 1, True, pid)
+                self._await_ack(pid)
+            else:
                 self.rcv_pids.pop(pid)
+                self.inflight.pop(pid, None)
                 self.cbstat(pid, 0)
 
     def check_msg(self):
@@ -460,13 +691,13 @@ class MQTTClient:
         """
         if self.sock:
             try:
-                res = self.sock.read(1)
+                res = self.sock.readinto(self.rxbuf, 1)
                 if res is None:
                     # wait forever if no timeout, else wait 1 msec
                     if not self.poller_r.poll(-1 if self.socket_timeout is None else 1):
                         self._message_timeout()
                         return None
-                    res = self.sock.read(1)
+                    res = self.sock.readinto(self.rxbuf, 1)
                     if res is None:
                         self._message_timeout()
                         return None
@@ -480,25 +711,28 @@ class MQTTClient:
         else:
             raise MQTTException(28)
 
-        if res == b'':
+        if res == 0:
             raise MQTTException(1) # Connection closed by host
 
-        if res == b"\xd0":  # PINGRESP
+        op = self.rxbuf[0]
+        self.bytes_received += 1
+        self.packets_received += 1
+
+        if op == 0xd0:  # PINGRESP
             if self._read(1)[0] != 0:
                 MQTTException(-1)
             self.last_cpacket = ticks_ms()
             return
 
-        op = res[0]
-
         if op == 0x40:  # PUBACK
-            sz = self._read(1)
-            if sz != b"\x02":
+            resp = self._read(3)
+            if resp[0] != 0x02:
                 raise MQTTException(-1)
-            rcv_pid = int.from_bytes(self._read(2), 'big')
+            rcv_pid = resp[1] << 8 | resp[2]
             if rcv_pid in self.rcv_pids:
                 self.last_cpacket = ticks_ms()
                 self.rcv_pids.pop(rcv_pid)
+                self.inflight.pop(rcv_pid, None)
                 self.cbstat(rcv_pid, 1)
             else:
                 self.cbstat(rcv_pid, 2)
@@ -510,16 +744,14 @@ class MQTTClient:
             # 2,3 - PID
             # 4 - Payload
             if resp[0] != 0x03:
-                raise MQTTException(40, resp)
-            if resp[3] == 0x80:
-                raise MQTTException(44)
-            if resp[3] not in (0, 1, 2):
-                raise MQTTException(40, resp)
+                raise MQTTException(40, bytes(resp))
+            if resp[3] not in (0, 1, 2, 0x80):
+                raise MQTTException(40, bytes(resp))
             pid = resp[2] | (resp[1] << 8)
             if pid in self.rcv_pids:
                 self.last_cpacket = ticks_ms()
                 self.rcv_pids.pop(pid)
-                self.cbstat(pid, 1)
+                self.cbstat(pid, 3 if resp[3] == 0x80 else 1)
             else:
                 raise MQTTException(5)
 
@@ -527,21 +759,28 @@ class MQTTClient:
 
         if op & 0xf0 != 0x30:  # 3.3 PUBLISH – Publish message
             return op
-        sz = self._recv_len()
-        topic_len = int.from_bytes(self._read(2), 'big')
-        topic = self._read(topic_len)
-        sz -= topic_len + 2
+        # The whole packet is read at once, the topic and the message
+        # passed to the callback are views of the receive buffer
+        sz, hl = self._recv_len(2)  # A PUBLISH starts with the length of the topic
+        pkt = self._read(hl + sz, max(hl, 1 + 2))[hl:]
+        topic_len = pkt[0] << 8 | pkt[1]
+        topic = pkt[2:2 + topic_len]
+        i = 2 + topic_len
         if op & 6:  # QoS level > 0
-            pid = int.from_bytes(self._read(2), 'big')
-            sz -= 2
-        msg = self._read(sz) if sz else b''
+            pid = pkt[i] << 8 | pkt[i + 1]
+            i += 2
+        msg = pkt[i:sz]
         retained = op & 0x01
         dup = op & 0x08
         self.cb(topic, msg, bool(retained), bool(dup))
         self.last_cpacket = ticks_ms()
         if op & 6 == 2:  # QoS==1
-            self._write(b"\x40\x02")  # Send PUBACK
-            self._write(pid.to_bytes(2, 'big'))
+            buf = self._tx(4)  # Send PUBACK
+            buf[0] = 0x40
+            buf[1] = 0x02
+            buf[2] = pid >> 8
+            buf[3] = pid & 0xFF
+            self._write(buf, 4)
         elif op & 6 == 4:  # QoS==2
             raise NotImplementedError()
         elif op & 6 == 6:  # 3.3.1.2 QoS - Reserved – must not be used
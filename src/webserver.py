@@ -11,89 +11,23 @@ Compilation: Durim Miziraj
 '''
 
 import gc
+import json
 import machine
-import socket
+import random
 import time
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
 
 import appconfig as params
 from applog import APPLOG
 from dht11 import DHT11
 from netconn import NETCONN
 
-class WEBSERVER:
-    def __init__(self, log:APPLOG, conn:NETCONN, dht11:DHT11):
-        self._log = log
-        self._conn = conn
-        self._dht11 = dht11
-        self._socket: socket.socket
-        self._is_listening = False
-        self._display_msgtab = True
-
-
-    # Open a port to listen on
-    def _open_socket(self):
-        ip = self._conn.connect().ifconfig()[0]
-        s = socket.socket()		# Creating a socket.
-        address = (ip, params.listen_port) 	# Port 80 is the default port for http requests.
-        n = 0
-        while n < 15:
-            n +=1 
-            try:
-                self._log.log_msg(APPLOG.TRACE, "Bind")
-                s.bind(address) 		# Binding the socket to the ip and port number.
-                n = 15
-            except Exception as e:
-                if (n == 15):
-                    raise e
-                time.sleep(2)
-
-        s.listen(1)	# Starts listening to requests that come in. The number is the max size of the queue for requests.
-        self._is_listening = True
-        self._log.log_msg(APPLOG.INFO, "listening on " + str(address) + " port " + str(params.listen_port))
-        return s
-
-
-    #Returns a string showing uptim, the time between now and when the PICO was started
-    def _uptime(self):
-        self._log.log_msg(APPLOG.TRACE, 'Entering _uptime')
-        # Calculating total uptime in seconds, minutes, hours and days
-        uptime_seconds = int(round((time.ticks_ms())/1000))
-        uptime_minutes = int(round(uptime_seconds/60))
-        uptime_hours = int(round(uptime_minutes/60))
-        uptime_days = int(round(uptime_hours/24))
-
-        # Calculating the current duration of uptime in a standard 
-        current_seconds = uptime_seconds % 60
-        current_minutes = uptime_minutes % 60
-        current_hours = uptime_hours % 60
-
-        # Printing the current uptime in days, hours, minutes and seconds
-        t = str(uptime_days) + " days, " + str(current_hours) + " hours, " + \
-            str(current_minutes) + " minutes, " +  str(current_seconds) + " seconds"
-        return(t)    
-
-
-    #Construct the web page to show for the end user
-    def _webpage(self):
-        self._log.log_msg(APPLOG.TRACE, 'Entering webserver._webpage')
-
-        temperature = 0
-        humidity = 0
-        measure_ts = ""
-        try:
-            (temperature, humidity, measure_ts) = self._dht11.measures
-        except Exception as e:
-            self._log.log_msg(APPLOG.ERROR, "webpage: " + str(e))
-
-        msgtab = self._log.msgtab
-        msgtab_button = "showpermmsg?"
-        msgtab_txt = "Show Permanent Messages"
-        if (not self._display_msgtab):
-            msgtab = self._log.permtab
-            msgtab_button = "showlivemsg?"
-            msgtab_txt = "Show Live Messages"
-     
-        html1 = f"""
+# Status page template. The template is compiled once when the module is loaded,
+# static parts are kept as constant bytes and {{name}} marks a value slot.
+_PAGE_HEAD = """
                 <!DOCTYPE html>
                 <html>
                     <body>
@@ -117,8 +51,8 @@ class WEBSERVER:
                             </tr>
                             <tr>
                                 <td style="width:20%;">
-                                    <form action="./{msgtab_button}"> 
-                                        <input type="submit" value="{msgtab_txt}" />
+                                    <form action="./{{msgtab_button}}"> 
+                                        <input type="submit" value="{{msgtab_txt}}" />
                                     </form>
                                 </td>
                                 <td style="width:20%;"></td>
@@ -129,7 +63,7 @@ class WEBSERVER:
                         <table align=left style="float:left;  text-align:left; table-layout: fixed; width: 100%;" >
                             <tr>
                                 <td style=" text-align:left; width:20%;"><b>Device uptime</b></td>
-                                <td style=" text-align:left; width:30%;">{self._uptime()}</td>
+                                <td style=" text-align:left; width:30%;">{{uptime}}</td>
                                 <td style=" text-align:left; width:50%;"></td>
                             </tr>
                         </table>
@@ -137,27 +71,27 @@ class WEBSERVER:
                         <table align=left style="float:left;  text-align:left; table-layout: fixed; width: 100%;" >
                             <tr>
                                 <td style=" text-align:left; width:20%;"><b>CPU frequency MHz</b></td>
-                                <td style=" text-align:right; width:5%;">{int(machine.freq()/1000000)}</td>
+                                <td style=" text-align:right; width:5%;">{{freq}}</td>
                                 <td style=" text-align:left; width:75%;"></td>
                             </tr>
                             <tr>
                                 <td style=" text-align:left; width:20%;"><b>Memory allocated (KB)</b></td>
-                                <td style=" text-align:right; width:5%;">{gc.mem_alloc()}</td>
+                                <td style=" text-align:right; width:5%;">{{mem_alloc}}</td>
                                 <td style=" text-align:left; width:75%;"></td>
                             </tr>
                             <tr>
                                 <td style=" text-align:left; width:20%;"><b>Memory free (KB)</b></td>
-                                <td style=" text-align:right; width:5%;">{gc.mem_free()}</td>
+                                <td style=" text-align:right; width:5%;">{{mem_free}}</td>
                                 <td style=" text-align:left; width:75%;"></td>
                             </tr>
                             <tr>
                                 <td style=" text-align:left; width:20%;"><b>Total mem (KB)</b></td>
-                                <td style=" text-align:right; width:5%;">{gc.mem_free() + gc.mem_alloc()}</td>
+                                <td style=" text-align:right; width:5%;">{{mem_total}}</td>
                                 <td style=" text-align:left; width:75%;"></td>
                             </tr>
                             <tr>
-                                <td style=" text-align:left; width:20%;"></td>
-                                <td style=" text-align:left; width:5%;"></td>
+                                <td style=" text-align:left; width:20%;"><b>Last page peak heap (B)</b></td>
+                                <td style=" text-align:right; width:5%;">{{peak_heap}}</td>
                                 <td style=" text-align:left; width:75%;"></td>
                             </tr>
                         </table>
@@ -165,15 +99,15 @@ class WEBSERVER:
                         <table align=left style="float:left;  text-align:left; table-layout: fixed; width: 50%;" >
                             <tr>
                                 <td style=" text-align:left; width:20%;"><b>Measures read time</b></td>
-                                <td style=" text-align:left; width:30%;">{measure_ts}</td>
+                                <td id="measure_ts" style=" text-align:left; width:30%;">{{measure_ts}}</td>
                             </tr>
                             <tr>
                                 <td style=" text-align:left; width:20%;"><b>Temerature in degrees</b></td>
-                                <td style=" text-align:left; width:30%;">{temperature}</td>
+                                <td id="temperature" style=" text-align:left; width:30%;">{{temperature}}</td>
                             </tr>
                             <tr>
                                 <td style=" text-align:left; width:20%;"><b>Humidity</b></td>
-                                <td style=" text-align:left; width:30%;">{humidity}%</td>
+                                <td style=" text-align:left; width:30%;"><span id="humidity">{{humidity}}</span>%</td>
                             </tr>
                             <tr>
                                 <td style=" text-align:left; width:20%;"></td>
@@ -184,99 +118,706 @@ class WEBSERVER:
                                 <td style=" text-align:left; width:30%;"></td>
                             </tr>
                         </table>
-                """
-        
-        html2 = f"""
-                        <table style="float:left; text-align:left; table-layout: fixed; width: 100%;">
+                        <table id="msgtab" style="float:left; text-align:left; table-layout: fixed; width: 100%;">
                             <tr>
                                 <th style=" text-align:left; width:20%;">Log time</th>
                                 <th style=" text-align:left; width:10%;">Severity</th>
                                 <th style=" text-align:left; width:70%;">Message</th>
                             </tr>
                 """
+_PAGE_HEAD_SLOTS = ("msgtab_button", "msgtab_txt", "uptime", "freq", "mem_alloc", "mem_free", "mem_total", 
+                    "peak_heap", "measure_ts", "temperature", "humidity")
 
-        msg_count = len(msgtab)
-        for n in range(0,msg_count):
-            html2 += f"""
+_PAGE_ROW = """
                             <tr>
-                                <td style=" text-align:left; width:20%;">{msgtab[n][0]}</td>
-                                <td style=" text-align:left; width:10%;">{self._log.severity_text(msgtab[n][1])}</td>
-                                <td style=" text-align:left; width:70%;">{str(msgtab[n][2]).replace('<','&lt').replace('>','&gt')}</td>
+                                <td style=" text-align:left; width:20%;">{{ts}}</td>
+                                <td style=" text-align:left; width:10%;">{{severity}}</td>
+                                <td style=" text-align:left; width:70%;">{{msg}}</td>
                             </tr>
-                     """
+                """
+_PAGE_ROW_SLOTS = ("ts", "severity", "msg")
 
-        html3 = f"""
+# The script updates the page with the events pushed from /events, log
+# messages are only added when the live messages are shown
+_PAGE_TAIL = """
                         </table>
+                        <script>
+                            var events = new EventSource("./events");
+                            events.addEventListener("measure", function(e) {
+                                var m = JSON.parse(e.data);
+                                document.getElementById("measure_ts").textContent = m.measure_ts;
+                                document.getElementById("temperature").textContent = m.temperature;
+                                document.getElementById("humidity").textContent = m.humidity;
+                            });
+                            if ({{live}}) events.addEventListener("log", function(e) {
+                                var m = JSON.parse(e.data);
+                                var t = document.getElementById("msgtab");
+                                var r = t.insertRow(1);
+                                for (var i = 0; i < 3; i++) r.insertCell().textContent = m[i];
+                                if (t.rows.length > {{rows}} + 1) t.deleteRow(-1);
+                            });
+                        </script>
                     </body>
                 </html>
                 """
-        return str(html1 + html2 + html3)
+_PAGE_TAIL_SLOTS = ("live", "rows")
 
 
-    def serve(self):
+def _compile_template(text, slots):
+    '''
+    Compiles a template into a tuple alternating constant bytes and the index
+    of the value to insert, (bytes, index, bytes, ..., bytes). The indentation
+    of the template is stripped as it is only there for readability.
+    '''
+    text = "".join(line.strip() for line in text.split("\n"))
+    parts = []
+    while True:
+        start = text.find("{{")
+        if start < 0:
+            parts.append(text.encode())
+            return tuple(parts)
+        end = text.index("}}", start)
+        parts.append(text[:start].encode())
+        parts.append(slots.index(text[start + 2:end]))
+        text = text[end + 2:]
+
+PAGE_HEAD = _compile_template(_PAGE_HEAD, _PAGE_HEAD_SLOTS)
+PAGE_ROW = _compile_template(_PAGE_ROW, _PAGE_ROW_SLOTS)
+PAGE_TAIL = _compile_template(_PAGE_TAIL, _PAGE_TAIL_SLOTS)
+
+# Fields returned by the measurement api, /api/measures and /api/measures.csv
+API_FIELDS = ("temperature", "humidity", "measure_ts", "uptime", "mem_alloc", "mem_free")
+API_CSV_HEADER = ",".join(API_FIELDS) + "\n"
+
+# Request headers kept when a request is parsed, all other headers are skipped
+REQUEST_HEADERS = ("connection", "if-none-match")
+
+
+class REQUESTERROR(ValueError):
+    '''
+    A request the server refuses, status is the HTTP status sent to the client
+    '''
+    def __init__(self, status, reason):
+        super().__init__(reason)
+        self.status = status
+
+
+class LINEREADER:
+    '''
+    Reads the lines of the requests from a client, at most WEBSERVER_MAX_LINE
+    bytes per line, so a client can't make the server buffer a line without
+    end. The bytes read after a line are kept for the next request on a
+    kept open connection.
+    '''
+    def __init__(self, reader, size=params.WEBSERVER_MAX_LINE):
+        self._reader = reader
+        self._size = size
+        self._data = b""
+
+    async def readline(self):
         '''
-        Handle request if there is any to handle
+        Returns the next line with its newline, what is left when the client
+        closed the connection, b"" at the end. Raises REQUESTERROR when the
+        line is too long.
         '''
-        self._log.log_msg(APPLOG.TRACE, 'Entering webserver.serve')
+        while True:
+            i = self._data.find(b"\n")
+            if (i >= 0):
+                line = self._data[:i + 1]
+                self._data = self._data[i + 1:]
+                return line
+            if (len(self._data) >= self._size):
+                raise REQUESTERROR("431 Request Header Fields Too Large", "Line too long")
+            data = await self._reader.read(self._size - len(self._data))
+            if (not data):
+                line = self._data
+                self._data = b""
+                return line
+            self._data += data
 
-        if (not self._is_listening):
-            self._socket = self._open_socket()
 
-        temperature = 0 
-        self._socket.setblocking(False)
-        client: socket.socket
-        try:
-            (client, client_adress) = self._socket.accept() # Accepts the connection of the device that is connectiong to it
-            self._socket.setblocking(True)
-        except Exception as e :
-            self._socket.setblocking(True)
+class PAGEWRITER:
+    '''
+    Writes a response to a client through a small buffer that is reused
+    between requests, so the page is never held in memory as a whole. The
+    peak heap usage seen while writing is recorded for each response.
+    When given a cache buffer the response is also copied into it, as long
+    as it fits. With chunked set every write is sent as a HTTP/1.1 chunk so
+    the connection can be kept open after the response.
+    '''
+    def __init__(self, size=params.WEBSERVER_CHUNK_SIZE):
+        self._buf = bytearray(size)
+        self._mv = memoryview(self._buf)
+        self._len = 0
+        self._writer = None
+        self.count = 0 # Bytes written in this response
+        self.sent = 0 # Bytes written to the socket in this response, with the chunk headers
+        self.writes = 0
+        self.heap_start = 0
+        self.heap_peak = 0
+        self._cache = None
+        self.cached = 0 # Bytes copied to the cache, -1 if the response did not fit
+        self._chunked = False
+
+    def open(self, writer, cache=None, chunked=False):
+        self._writer = writer
+        self._chunked = chunked
+        self._len = 0
+        self.count = 0
+        self.sent = 0
+        self.writes = 0
+        self.heap_start = self.heap_peak = gc.mem_alloc()
+        self._cache = cache
+        self.cached = 0
+
+    def _keep(self, data):
+        if (self._cache is not None):
+            n = len(data)
+            if (self.cached + n <= len(self._cache)):
+                self._cache[self.cached:self.cached + n] = data
+                self.cached += n
+            else:
+                self._cache = None
+                self.cached = -1
+
+    async def write(self, data):
+        if (isinstance(data, str)):
+            data = data.encode()
+        n = len(data)
+        if (self._len + n > len(self._buf)):
+            await self.flush()
+        if (n >= len(self._buf)):
+            # Large constant parts of the page are written as they are
+            self._keep(data)
+            self._send(data)
+            await self._writer.drain()
             return
+        self._mv[self._len:self._len + n] = data
+        self._len += n
+
+    async def render(self, template, values):
+        '''
+        Writes a compiled template filling in the slots from the tuple values
+        '''
+        for part in template:
+            if (isinstance(part, int)):
+                await self.write(str(values[part]))
+            else:
+                await self.write(part)
+
+    async def flush(self):
+        heap = gc.mem_alloc()
+        if (heap > self.heap_peak):
+            self.heap_peak = heap
+        if (self._len > 0):
+            self._keep(self._mv[:self._len])
+            self._send(self._mv[:self._len])
+            self._len = 0
+            await self._writer.drain()
+
+    def _send(self, data):
+        if (self._chunked):
+            head = "{:x}\r\n".format(len(data)).encode()
+            self._writer.write(head)
+            self._writer.write(data)
+            self._writer.write(b"\r\n")
+            self.sent += len(head) + 2
+            self.writes += 2 # And the data counted below
+        else:
+            self._writer.write(data)
+        self.count += len(data)
+        self.sent += len(data)
+        self.writes += 1
+
+    async def close(self):
+        '''
+        Flush what is left in the buffer, returns the peak heap growth while writing
+        '''
+        await self.flush()
+        if (self._chunked):
+            self._writer.write(b"0\r\n\r\n") # Last chunk
+            self.sent += 5
+            self.writes += 1
+            await self._writer.drain()
+        self._writer = None
+        self._cache = None
+        return self.heap_peak - self.heap_start
+
+
+class WEBSERVER:
+    def __init__(self, log:APPLOG, conn:NETCONN, dht11:DHT11):
+        self._log = log
+        self._conn = conn
+        self._dht11 = dht11
+        self._server = None
+        self._is_listening = False
+        self._display_msgtab = True
+        self._connections = 0 # Number of open client connections
+        self._pagewriters = [] # Page writers not in use, reused between requests
+        self._page_heap = 0 # Peak heap growth while writing the last page
+        self._event_clients = [] # One asyncio.Event for each client connected to /events
+        self._mqtt_stats = None # Callable() returning the counters of the MQTT connection
+        self._bytes_sent = 0 # Counters of the traffic on the client sockets, see stats
+        self._bytes_received = 0
+        self._packets_sent = 0
+        self._packets_received = 0
+
+        # The last rendered page is kept with the ETag built from the versions of
+        # the measures and log messages it shows and a coarse time, see _page_etag
+        self._page_cache = bytearray(params.WEBSERVER_PAGE_CACHE_SIZE) if params.WEBSERVER_PAGE_CACHE_SIZE > 0 else None
+        self._page_cache_len = 0
+        self._page_cache_etag = None
+        self._page_cache_busy = False
+        self._boot_id = random.getrandbits(24) # The versions restart at 0 on each boot, the id keeps their ETags apart
+
+
+    async def start(self):
+        '''
+        Start listening on the port, requests are then handled by the server task
+        as soon as they arrive. Called when the network link goes up.
+        '''
+        n = 0
+        while (not self._is_listening and n < 15):
+            n +=1 
+            ip = self._conn.ip_address
+            if (ip is None): # The link went down again
+                return
+            try:
+                if __debug__:
+                    self._log.log_msg(APPLOG.TRACE, "Bind")
+                self._server = await asyncio.start_server(self._handle, ip, params.listen_port, backlog=params.WEBSERVER_BACKLOG)
+                self._is_listening = True
+                self._log.log_msg(APPLOG.INFO, "listening on {} port {}", ip, params.listen_port)
+            except Exception as e:
+                if (n == 15):
+                    self._log.log_msg(APPLOG.ERROR, "Can't listen on {} port {}: {}", ip, params.listen_port, e)
+                    return
+                await asyncio.sleep(2)
+
+
+    def link_changed(self, up):
+        '''
+        Listens again on the new address when the network link goes up,
+        stops listening when it goes down
+        '''
+        if (up):
+            asyncio.create_task(self.start())
+        else:
+            self.close()
+
+
+    def set_mqtt_stats(self, f):
+        ''' Set a callable() returning a dict with the counters of the MQTT connection, shown by /api/network'''
+        self._mqtt_stats = f
+
+
+    @property
+    def stats(self):
+        '''
+        Returns a dict with the counters of the traffic on the client sockets,
+        the packets are the writes to the sockets and the lines read from them
+        '''
+        return {
+            "bytes_sent": self._bytes_sent,
+            "bytes_received": self._bytes_received,
+            "packets_sent": self._packets_sent,
+            "packets_received": self._packets_received,
+        }
+
+
+    def notify(self):
+        '''
+        Wakes up the clients connected to /events, called when there are new
+        measures or log messages
+        '''
+        for event in self._event_clients:
+            event.set()
 
-        # There is a request to handle if we landed here
-        client.setblocking(True)
-        request = str(client.recv(2048))	# Recieving data (a request) from the client device that is up
-                                            # to 2 kb. Stores the request as a string.
-        self._log.log_msg(APPLOG.TRACE, "Accepted request {}".format(request))
 
+    #Returns a string showing uptim, the time between now and when the PICO was started
+    def _uptime(self):
+        if __debug__:
+            self._log.log_msg(APPLOG.TRACE, 'Entering _uptime')
+        # Calculating total uptime in seconds, minutes, hours and days
+        uptime_seconds = int(round((time.ticks_ms())/1000))
+        uptime_minutes = int(round(uptime_seconds/60))
+        uptime_hours = int(round(uptime_minutes/60))
+        uptime_days = int(round(uptime_hours/24))
+
+        # Calculating the current duration of uptime in a standard 
+        current_seconds = uptime_seconds % 60
+        current_minutes = uptime_minutes % 60
+        current_hours = uptime_hours % 60
+
+        # Printing the current uptime in days, hours, minutes and seconds
+        t = str(uptime_days) + " days, " + str(current_hours) + " hours, " + \
+            str(current_minutes) + " minutes, " +  str(current_seconds) + " seconds"
+        return(t)    
+
+
+    # Returns a tuple with the values of API_FIELDS
+    def _api_measures(self):
+        temperature = 0
+        humidity = 0
+        measure_ts = ""
+        try:
+            (temperature, humidity, measure_ts) = self._dht11.measures
+        except Exception as e:
+            self._log.log_msg(APPLOG.ERROR, "api: {}", e)
+        return (temperature, humidity, measure_ts, time.ticks_ms() // 1000, gc.mem_alloc(), gc.mem_free())
+
+
+    # Returns a dict with the state, counters and history of the network connection
+    def _api_network(self):
+        return {
+            "wifi": self._conn.stats,
+            "history": [list(r) for r in self._conn.history.records()],
+            "web": self.stats,
+            "mqtt": self._mqtt_stats() if self._mqtt_stats else None,
+        }
+
+
+    # Returns the ETag of the web page as it would be rendered now, the uptime,
+    # memory figures and peak heap on the page aren't versioned so the ETag also
+    # changes every WEBSERVER_PAGE_MAX_AGE seconds to keep them from going stale
+    def _page_etag(self):
+        log_version = self._log.msgtab_version if self._display_msgtab else self._log.permtab_version
+        age_bucket = time.ticks_ms() // (params.WEBSERVER_PAGE_MAX_AGE * 1000)
+        return '"{:x}-{}-{}-{}-{}"'.format(self._boot_id, self._dht11.version, log_version, int(self._display_msgtab), age_bucket)
+
+
+    # Read a line from the client, raises asyncio.TimeoutError when the deadline has passed
+    async def _readline(self, lines:LINEREADER, deadline):
+        remaining = time.ticks_diff(deadline, time.ticks_ms())
+        if (remaining <= 0):
+            raise asyncio.TimeoutError()
+        line = await asyncio.wait_for(lines.readline(), remaining / 1000)
+        self._bytes_received += len(line)
+        self._packets_received += 1
+        return line
+
+
+    # Write to the client, all the writes to the client sockets go through here or a PAGEWRITER
+    def _write(self, writer, data):
+        writer.write(data)
+        self._bytes_sent += len(data)
+        self._packets_sent += 1
+
+
+    # Count the writes made by a PAGEWRITER
+    def _release(self, out:PAGEWRITER):
+        self._bytes_sent += out.sent
+        self._packets_sent += out.writes
+        out.sent = out.writes = 0
+        self._pagewriters.append(out)
+
+
+    async def _read_request(self, lines:LINEREADER, timeout):
+        '''
+        Reads a request from the client one line at a time as the lines arrive.
+        Returns a tuple (path, version, headers) where headers is a dict with the
+        headers in REQUEST_HEADERS, or None if the client closed the connection.
+        '''
+        deadline = time.ticks_add(time.ticks_ms(), int(timeout * 1000))
+        line = await self._readline(lines, deadline)
+        if __debug__:
+            self._log.log_msg(APPLOG.TRACE, "Accepted request {}", line)
+        request = line.split() # First index is a html GET method, the other is the type of request.
+        if (len(request) < 2):
+            return None
+
+        headers = {}
+        n = 0
+        while True:
+            line = await self._readline(lines, deadline)
+            if (line == b"\r\n" or line == b"\n" or line == b""):
+                break
+            n += 1
+            if (n > params.WEBSERVER_MAX_HEADERS):
+                raise REQUESTERROR("431 Request Header Fields Too Large", "Too many headers")
+            i = line.find(b":")
+            if (i > 0):
+                name = line[:i].decode().strip().lower()
+                if (name in REQUEST_HEADERS):
+                    headers[name] = line[i + 1:].decode().strip()
+
+        version = request[2].decode() if len(request) > 2 else "HTTP/1.0"
+        return (request[1].decode(), version, headers)
+
+
+    # Write the head of a response where the length of the body is not known until
+    # it is written, when the connection is kept open the body is sent in chunks
+    def _write_head(self, writer, content_type, keep_alive, extra=""):
+        self._write(writer, "HTTP/1.1 200 OK\r\nContent-Type: {}\r\n{}{}Connection: {}\r\n\r\n"
+                            .format(content_type, extra, "Transfer-Encoding: chunked\r\n" if keep_alive else "", 
+                                    "keep-alive" if keep_alive else "close").encode())
+
+
+    # Write the measures history to the client, newest first
+    async def _write_history(self, writer, csv, keep_alive):
+        self._write_head(writer, "text/csv" if csv else "application/json", keep_alive)
+        out = self._pagewriters.pop() if self._pagewriters else PAGEWRITER()
+        try:
+            out.open(writer, chunked=keep_alive)
+            await out.write(b"time,temperature,humidity\n" if csv else b"[")
+            now_ticks = time.ticks_ms()
+            now = int(time.time())
+            sep = ""
+            for (ticks, temperature, humidity) in self._dht11.history.records():
+                ts = now - time.ticks_diff(now_ticks, ticks) // 1000
+                if (csv):
+                    await out.write("{},{},{}\n".format(ts, temperature / 10, humidity / 10))
+                else:
+                    await out.write("{}[{},{},{}]".format(sep, ts, temperature / 10, humidity / 10))
+                    sep = ","
+            if (not csv):
+                await out.write(b"]")
+            await out.close()
+        finally:
+            self._release(out)
+
+
+    # Write a complete response with a small body to the client
+    async def _send(self, writer, body, content_type, keep_alive=False, status="200 OK"):
+        if (isinstance(body, str)):
+            body = body.encode()
+        self._write(writer, "HTTP/1.1 {}\r\nContent-Type: {}\r\nContent-Length: {}\r\nConnection: {}\r\n\r\n"
+                            .format(status, content_type, len(body), "keep-alive" if keep_alive else "close").encode())
+        self._write(writer, body)
+        await writer.drain()
+
+
+    #Write the web page to show for the end user
+    async def _write_page(self, out:PAGEWRITER):
+        if __debug__:
+            self._log.log_msg(APPLOG.TRACE, 'Entering webserver._write_page')
+
+        temperature = 0
+        humidity = 0
+        measure_ts = ""
         try:
-            request = request.split()[1] # First index is a html GET method, the other is the type of request.
-            self._log.log_msg(APPLOG.TRACE, request)
-        except IndexError:	
-            # Catches errors when the request does not have any specified GET variable
-            client.close()	
+            (temperature, humidity, measure_ts) = self._dht11.measures
+        except Exception as e:
+            self._log.log_msg(APPLOG.ERROR, "webpage: {}", e)
+
+        msgtab = self._log.msgtab
+        msgtab_button = "showpermmsg?"
+        msgtab_txt = "Show Permanent Messages"
+        if (not self._display_msgtab):
+            msgtab = self._log.permtab
+            msgtab_button = "showlivemsg?"
+            msgtab_txt = "Show Live Messages"
+
+        mem_alloc = gc.mem_alloc()
+        mem_free = gc.mem_free()
+        await out.render(PAGE_HEAD, (msgtab_button, msgtab_txt, self._uptime(), int(machine.freq()/1000000), 
+                                     mem_alloc, mem_free, mem_free + mem_alloc, self._page_heap, 
+                                     measure_ts, temperature, humidity))
+        for m in msgtab:
+            await out.render(PAGE_ROW, (m[0], self._log.severity_text(m[1]), 
+                                        str(m[2]).replace('<','&lt;').replace('>','&gt;')))
+        await out.render(PAGE_TAIL, ("true" if self._display_msgtab else "false", params.APPLOG_DEFAULT_MSGSTACK_SIZE))
+
+
+    async def _handle(self, reader, writer):
+        '''
+        Handle the requests from a connected client. Each connection is handled
+        by its own task, a slow or idle client is timed out without holding up
+        other clients or the rest of the application.
+        '''
+        if __debug__:
+            self._log.log_msg(APPLOG.TRACE, 'Entering webserver._handle')
+        if (self._connections >= params.WEBSERVER_MAX_CONNECTIONS):
+            # Too many clients already, tell this one to come back later
+            try:
+                self._write(writer, b"HTTP/1.1 503 Service Unavailable\r\nRetry-After: 1\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+                await writer.drain()
+            except OSError:
+                pass
+            await self._close_client(writer)
+            return
+
+        self._connections += 1
+        lines = LINEREADER(reader)
+        try:
+            served = 0
+            keep_alive = True
+            while keep_alive:
+                timeout = params.WEBSERVER_REQUEST_TIMEOUT if served == 0 else params.WEBSERVER_KEEPALIVE_TIMEOUT
+                request = await self._read_request(lines, timeout)
+                if (request is None):
+                    break
+                (path, version, headers) = request
+                served += 1
+                if (path == '/events'):
+                    await self._events(writer) # Runs until the client disconnects
+                    break
+
+                # HTTP/1.1 connections are kept open unless the client asks to close
+                connection = headers.get("connection", "").lower()
+                keep_alive = params.WEBSERVER_KEEPALIVE and version == "HTTP/1.1" and connection != "close" \
+                    and served < params.WEBSERVER_KEEPALIVE_MAX
+                await asyncio.wait_for(self._respond(writer, path, headers, keep_alive), params.WEBSERVER_RESPONSE_TIMEOUT)
+        except asyncio.TimeoutError:
+            if __debug__:
+                self._log.log_msg(APPLOG.TRACE, "Client timed out")
+        except REQUESTERROR as e:
+            self._log.log_msg(APPLOG.DEBUG, "Client error: {}", e)
+            try:
+                await self._send(writer, e.status, "text/plain", status=e.status)
+            except OSError:
+                pass
+        except (OSError, ValueError) as e:
+            self._log.log_msg(APPLOG.DEBUG, "Client error: {}", e)
+        except MemoryError:
+            # Not enough memory for this client, the others are still served
+            self._log.log_msg(APPLOG.WARN, "Client error: out of memory")
+        finally:
+            self._connections -= 1
+            await self._close_client(writer)
+
+
+    async def _events(self, writer):
+        '''
+        Server-Sent Events, keeps the connection open and pushes a small event
+        when there are new measures or log messages until the client disconnects
+        '''
+        if (len(self._event_clients) >= params.WEBSERVER_MAX_EVENT_CLIENTS):
+            await self._send(writer, b"", "text/plain", status="503 Service Unavailable")
             return
 
-        if request == '/refresh?':
+        event = asyncio.Event()
+        self._event_clients.append(event)
+        try:
+            self._write(writer, b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\nConnection: close\r\n\r\n")
+            dht11_version = None
+            log_version = self._log.msgtab_version
+            while True:
+                if (self._dht11.version != dht11_version):
+                    dht11_version = self._dht11.version
+                    data = json.dumps(dict(zip(API_FIELDS, self._api_measures())))
+                    self._write(writer, "event: measure\ndata: {}\n\n".format(data).encode())
+
+                if (self._log.msgtab_version != log_version):
+                    # The newest message is first in msgtab, send the new ones oldest first
+                    msgtab = self._log.msgtab
+                    n = min(self._log.msgtab_version - log_version, len(msgtab))
+                    log_version = self._log.msgtab_version
+                    for m in reversed(msgtab[:n]):
+                        data = json.dumps((m[0], self._log.severity_text(m[1]), str(m[2])))
+                        self._write(writer, "event: log\ndata: {}\n\n".format(data).encode())
+
+                await asyncio.wait_for(writer.drain(), params.WEBSERVER_RESPONSE_TIMEOUT)
+                try:
+                    await asyncio.wait_for(event.wait(), params.WEBSERVER_EVENTS_PING)
+                    event.clear()
+                except asyncio.TimeoutError:
+                    self._write(writer, b": ping\n\n") # A comment, finds clients that have gone away
+        finally:
+            self._event_clients.remove(event)
+
+
+    async def _close_client(self, writer):
+        try:
+            writer.close() # Closes the connection to the client device
+            await writer.wait_closed()
+        except OSError:
+            pass
+
+
+    async def _respond(self, writer, request, headers, keep_alive):
+        '''
+        Write the response to a request
+        '''
+        if __debug__:
+            self._log.log_msg(APPLOG.TRACE, "{}", request)
+        if request == '/api/measures':
+            values = self._api_measures()
+            await self._send(writer, json.dumps(dict(zip(API_FIELDS, values))), "application/json", keep_alive)
+            return
+        elif request == '/api/measures.csv':
+            values = self._api_measures()
+            await self._send(writer, API_CSV_HEADER + ",".join(str(v) for v in values) + "\n", "text/csv", keep_alive)
+            return
+        elif request == '/api/sensor':
+            await self._send(writer, json.dumps(self._dht11.stats), "application/json", keep_alive)
+            return
+        elif request == '/api/network':
+            await self._send(writer, json.dumps(self._api_network()), "application/json", keep_alive)
+            return
+        elif request == '/api/history':
+            await self._write_history(writer, False, keep_alive)
+            return
+        elif request == '/api/history.csv':
+            await self._write_history(writer, True, keep_alive)
+            return
+        elif request == '/refresh?':
             pass
         elif request == '/showpermmsg?':	
-            self._msgtab = self._display_msgtab = False
+            self._display_msgtab = False
         elif request == '/showlivemsg?':	
-            self._msgtab = self._display_msgtab = True
+            self._display_msgtab = True
         elif request == '/restart?':	
-            client.close()
             self._log.log_msg(APPLOG.INFO, "Restarting device by machine.reset()")
+            self._log.flush() # Keep the permanent messages waiting to be written
             machine.reset()
             return # We never reach this point
         elif request == '/terminate?':	
-            client.close()
             self._log.log_msg(APPLOG.INFO, "Terminating application by simulating CTRL-C")
             raise KeyboardInterrupt
-            
-        html = self._webpage()	# Stores the html code with the variables that are meant to be shown to the user.
-        n = client.write(html) # Sends the  html code to the client.
-        client.close() # Closes the connection to the client device
+
+        connection = "keep-alive" if keep_alive else "close"
+
+        # Nothing shown on the page has changed since the client got it
+        etag = self._page_etag()
+        if (headers.get("if-none-match") == etag):
+            self._write(writer, "HTTP/1.1 304 Not Modified\r\nETag: {}\r\nConnection: {}\r\n\r\n".format(etag, connection).encode())
+            await writer.drain()
+            return
+
+        # Nothing has changed since the page was rendered for another client
+        if (self._page_cache_etag == etag):
+            self._write(writer, "HTTP/1.1 200 OK\r\nContent-Type: text/html\r\nCache-Control: no-cache\r\nETag: {}\r\nContent-Length: {}\r\nConnection: {}\r\n\r\n"
+                                .format(etag, self._page_cache_len, connection).encode())
+            self._write(writer, memoryview(self._page_cache)[:self._page_cache_len])
+            await writer.drain()
+            if __debug__:
+                self._log.log_msg(APPLOG.TRACE, "Page sent from cache")
+            return
+
+        self._write_head(writer, "text/html", keep_alive, "Cache-Control: no-cache\r\nETag: {}\r\n".format(etag))
+
+        # Stream the html code to the client through a small reused buffer
+        cache = None
+        if (self._page_cache is not None and not self._page_cache_busy):
+            cache = self._page_cache
+            self._page_cache_busy = True
+            self._page_cache_etag = None
+        out = self._pagewriters.pop() if self._pagewriters else PAGEWRITER()
+        try:
+            out.open(writer, cache, chunked=keep_alive)
+            await self._write_page(out)
+            self._page_heap = await out.close()
+            self._log.log_msg(APPLOG.DEBUG, "Page sent {} bytes, peak heap {} bytes", out.count, self._page_heap)
+            if (cache is not None and out.cached >= 0):
+                self._page_cache_len = out.cached
+                self._page_cache_etag = etag
+        finally:
+            self._release(out)
+            if (cache is not None):
+                self._page_cache_busy = False
 
 
     def close(self):
         '''
         Stop listening on port
         '''
-        self._log.log_msg(APPLOG.TRACE, "Entering webserver.close")
+        if __debug__:
+            self._log.log_msg(APPLOG.TRACE, "Entering webserver.close")
         if (self._is_listening):
             self._is_listening = False
 
             try:
-                self._socket.close()
+                self._server.close()
             except Exception as ignored:
-                self._log.log_msg(APPLOG.WARN," Error closing socket: " + str(ignored))
-
+                self._log.log_msg(APPLOG.WARN," Error closing server: {}", ignored)
@@ -0,0 +1,83 @@
+'''
+applog_decode.py
+Prints the permanent messages in the log file segments written by applog.py
+as text, oldest first. Copy the segments from the PICO and run it on a PC:
+
+    mpremote cp :app.log :app.log.1 :app.log.2 :app.log.3 .
+    python tools/applog_decode.py app.log
+
+Given app.log the older segments app.log.1, app.log.2... are decoded first.
+Damaged records are skipped and counted. The PICO clock is set to local
+time, the times are shown as they are stored without a time zone.
+'''
+import argparse
+import os
+import struct
+import time
+import zlib
+
+MAGIC = 0xA5
+HEADER = "<BBHI" # Magic, severity, message length, time
+HEADER_SIZE = struct.calcsize(HEADER)
+TRAILER = "<IH" # CRC32 of the header and the message, message length
+TRAILER_SIZE = struct.calcsize(TRAILER)
+SEVERITIES = ["fatal", "error", "warn", "info", "debug", "trace"]
+
+
+def decode(data):
+    '''
+    Returns the records in data as tuples (time, severity, message) and the
+    number of bytes skipped because they were not part of a valid record
+    '''
+    records = []
+    skipped = 0
+    pos = 0
+    while (pos < len(data)):
+        record = None
+        if (data[pos] == MAGIC and len(data) - pos >= HEADER_SIZE + TRAILER_SIZE):
+            magic, severity, length, t = struct.unpack_from(HEADER, data, pos)
+            end = pos + HEADER_SIZE + length
+            if (end + TRAILER_SIZE <= len(data)):
+                crc, length2 = struct.unpack_from(TRAILER, data, end)
+                if (length2 == length and crc == zlib.crc32(data[pos:end]) & 0xffffffff):
+                    record = (t, severity, data[pos + HEADER_SIZE:end].decode("utf-8", "replace"))
+        if (record is None):
+            skipped += 1
+            pos += 1
+        else:
+            records.append(record)
+            pos = end + TRAILER_SIZE
+    return records, skipped
+
+
+def segments(path):
+    '''
+    Returns the segment files of the log file, oldest first
+    '''
+    names = [path]
+    n = 1
+    while os.path.exists("{}.{}".format(path, n)):
+        names.append("{}.{}".format(path, n))
+        n += 1
+    names.reverse()
+    return names
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Decode the PICO application log segments")
+    parser.add_argument("logfile", help="The segment written last, app.log")
+    args = parser.parse_args()
+
+    for name in segments(args.logfile):
+        with open(name, "rb") as f:
+            records, skipped = decode(f.read())
+        for t, severity, msg in records:
+            ts = time.gmtime(t)
+            severity = SEVERITIES[severity] if severity < len(SEVERITIES) else str(severity)
+            print("{}\t{}\t{}".format(time.strftime("%Y-%m-%dT%H:%M:%S", ts), severity, msg))
+        if (skipped):
+            print("# {}: {} bytes skipped".format(name, skipped))
+
+
+if __name__ == "__main__":
+    main()
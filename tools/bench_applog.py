@@ -0,0 +1,62 @@
+'''
+bench_applog.py
+Measures the cost of a trace message when trace messages are filtered out,
+the way the messages were written before and with the deferred arguments.
+The MicroPython unix port needs a larger heap, and with -O the trace
+messages are left out altogether:
+
+    MICROPYPATH=src micropython -X heapsize=256k tools/bench_applog.py
+    MICROPYPATH=src micropython -O tools/bench_applog.py
+'''
+try:
+    import benchutil # Sets up the path and the stand-ins on a PC
+except ImportError: # On the PICO
+    pass
+
+import gc
+import time
+
+from applog import APPLOG
+
+LOOPS = 2000
+
+log = APPLOG(log_level=APPLOG.INFO)
+request = b"GET /refresh? HTTP/1.1\r\n"
+value = 21.5
+
+
+def loop_empty():
+    for _ in range(LOOPS):
+        pass
+
+
+def loop_eager():
+    for _ in range(LOOPS):
+        log.log_msg(APPLOG.TRACE, "Accepted request {} value {}".format(request, value))
+
+
+def loop_deferred():
+    for _ in range(LOOPS):
+        log.log_msg(APPLOG.TRACE, "Accepted request {} value {}", request, value)
+
+
+def loop_debug():
+    for _ in range(LOOPS):
+        if __debug__:
+            log.log_msg(APPLOG.TRACE, "Accepted request {} value {}", request, value)
+
+
+def measure(f):
+    gc.collect()
+    alloc = gc.mem_alloc() if hasattr(gc, "mem_alloc") else 0
+    start = time.ticks_us()
+    f()
+    us = time.ticks_diff(time.ticks_us(), start)
+    alloc = (gc.mem_alloc() - alloc) if hasattr(gc, "mem_alloc") else 0
+    return us, alloc
+
+
+base, _ = measure(loop_empty)
+for name, f in (("format() at call", loop_eager), ("deferred args", loop_deferred), ("if __debug__", loop_debug)):
+    us, alloc = measure(f)
+    print("{:18s} {:7.2f} us/iteration {:6d} bytes/iteration".format(name, (us - base) / LOOPS, alloc // LOOPS))
@@ -0,0 +1,91 @@
+'''
+bench_mqtt_publish.py
+Measures MQTTClient.publish from simple2.py against a socket stand-in that
+counts the socket writes and poll calls, and compares it with the separate
+writes for the header, topic, packet id and payload publish made before.
+'''
+try:
+    import benchutil # Sets up the path and the stand-ins on a PC
+except ImportError: # On the PICO
+    pass
+
+import gc
+import time
+
+from simple2 import MQTTClient
+
+MESSAGES = 1000
+TOPIC = b"username/feeds/temperature"
+PAYLOAD = b"21.5"
+
+
+class STANDIN:
+    '''
+    Stands in for the socket and the poller, accepts everything written
+    '''
+    def __init__(self):
+        self.writes = 0
+        self.polls = 0
+        self.bytes = 0
+
+    def write(self, buf, length=-1):
+        n = len(buf) if length < 0 else min(length, len(buf))
+        self.writes += 1
+        self.bytes += n
+        return n
+
+    def poll(self, timeout):
+        self.polls += 1
+        return [(self, 4)] # POLLOUT
+
+
+def client():
+    c = MQTTClient(b"bench", "localhost")
+    c.sock = c.poller_w = STANDIN()
+    return c
+
+
+def publish_before(c, topic, msg, qos=0):
+    '''
+    Publish as it was written before the packet was assembled in one buffer
+    '''
+    pkt = bytearray(b"\x30\0\0\0\0")
+    pkt[0] |= qos << 1
+    sz = 2 + len(topic) + len(msg)
+    if qos > 0:
+        sz += 2
+    plen = c._varlen_encode(sz, pkt, 1)
+    c._write(pkt, plen)
+    c._write(len(topic).to_bytes(2, 'big'))
+    c._write(topic)
+    if qos > 0:
+        c._write((1).to_bytes(2, 'big'))
+    c._write(msg)
+
+
+def publish_now(c, topic, msg, qos=0):
+    c.publish(topic, msg, qos=qos)
+    # As if the PUBACK had arrived, the in-flight window would be full after max_inflight messages
+    c.rcv_pids.clear()
+    c.inflight.clear()
+    c.deadlines.clear()
+
+
+def measure(name, f, qos):
+    c = client()
+    gc.collect()
+    alloc = gc.mem_alloc() if hasattr(gc, "mem_alloc") else 0
+    start = time.ticks_us()
+    for _ in range(MESSAGES):
+        f(c, TOPIC, PAYLOAD, qos)
+    us = time.ticks_diff(time.ticks_us(), start)
+    alloc = (gc.mem_alloc() - alloc) if hasattr(gc, "mem_alloc") else 0
+    s = c.sock
+    print("{:14s} qos{} {:8.0f} msg/s {:5.1f} writes/msg {:5.1f} polls/msg {:5d} bytes/msg {:5d} heap bytes/msg"
+          .format(name, qos, MESSAGES * 1000000 / us, s.writes / MESSAGES, s.polls / MESSAGES,
+                  s.bytes // MESSAGES, alloc // MESSAGES))
+
+
+for qos in (0, 1):
+    measure("before", publish_before, qos)
+    measure("one write", publish_now, qos)
@@ -0,0 +1,128 @@
+'''
+bench_mqtt_receive.py
+Measures the inbound messages per second of MQTTClient.check_msg from
+simple2.py against a broker stand-in that hands out PUBLISH packets in TCP
+sized segments, and compares it with the receive path used before, which
+read each field into a new bytes object and grew the message with +=.
+'''
+try:
+    import benchutil # Sets up the path and the stand-ins on a PC
+except ImportError: # On the PICO
+    pass
+
+import gc
+import time
+
+from simple2 import MQTTClient
+
+MESSAGES = 500
+SEGMENT = 536 # Bytes handed out per read, the default TCP MSS
+TOPIC = b"username/feeds/command"
+
+
+def publish_packet(topic, msg, qos=0, pid=1):
+    c = MQTTClient(b"bench", "localhost")
+    sz = 2 + len(topic) + len(msg) + (2 if qos else 0)
+    header = bytearray(5)
+    header[0] = 0x30 | qos << 1
+    n = c._varlen_encode(sz, header, 1)
+    pkt = bytes(header[:n]) + len(topic).to_bytes(2, "big") + topic
+    if qos:
+        pkt += pid.to_bytes(2, "big")
+    return pkt + msg
+
+
+class BROKER:
+    '''
+    Stands in for the socket connected to the broker, reads return at most
+    SEGMENT bytes of the packets queued
+    '''
+    def __init__(self, data):
+        self._data = memoryview(data)
+        self._pos = 0
+        self.reads = 0
+
+    def readinto(self, buf, n=-1):
+        n = len(buf) if n < 0 else min(n, len(buf))
+        n = min(n, SEGMENT, len(self._data) - self._pos)
+        if (n == 0):
+            return None
+        buf[:n] = self._data[self._pos:self._pos + n]
+        self._pos += n
+        self.reads += 1
+        return n
+
+    def read(self, n):
+        n = min(n, SEGMENT, len(self._data) - self._pos)
+        if (n == 0):
+            return None
+        self.reads += 1
+        self._pos += n
+        return bytes(self._data[self._pos - n:self._pos])
+
+    def write(self, buf, n=-1):
+        return len(buf) if n < 0 else n
+
+
+def read_before(c, n):
+    msg = b''
+    while len(msg) < n:
+        msg += c.sock.read(n - len(msg))
+    return msg
+
+
+def receive_before(c):
+    '''
+    The PUBLISH receive path as it was before the receive buffer
+    '''
+    op = c.sock.read(1)[0]
+    sz = 0
+    sh = 0
+    while 1:
+        b = read_before(c, 1)[0]
+        sz |= (b & 0x7f) << sh
+        if not b & 0x80:
+            break
+        sh += 7
+    topic_len = int.from_bytes(read_before(c, 2), 'big')
+    topic = read_before(c, topic_len)
+    sz -= topic_len + 2
+    if op & 6:
+        pid = int.from_bytes(read_before(c, 2), 'big')
+        sz -= 2
+    msg = read_before(c, sz) if sz else b''
+    c.cb(topic, msg, bool(op & 1), bool(op & 8))
+
+
+def receive_now(c):
+    c.check_msg()
+
+
+def measure(name, f, size):
+    packet = publish_packet(TOPIC, b"x" * size)
+    received = [0, 0] # Messages, messages with the wrong size
+
+    def cb(topic, msg, retained, dup):
+        received[0] += 1
+        if (len(msg) != size or len(topic) != len(TOPIC)):
+            received[1] += 1
+
+    c = MQTTClient(b"bench", "localhost")
+    c.set_callback(cb)
+    c.sock = BROKER(packet * MESSAGES)
+    gc.collect()
+    alloc = gc.mem_alloc() if hasattr(gc, "mem_alloc") else 0
+    start = time.ticks_us()
+    for _ in range(MESSAGES):
+        f(c)
+    us = time.ticks_diff(time.ticks_us(), start)
+    alloc = (gc.mem_alloc() - alloc) if hasattr(gc, "mem_alloc") else 0
+    ok = received[0] == MESSAGES and received[1] == 0
+    print("{:8s} {:5d} bytes {:8.0f} msg/s {:5.1f} reads/msg {:6d} heap bytes/msg {}".format(
+        name, size, MESSAGES * 1000000 / us, c.sock.reads / MESSAGES,
+        alloc // MESSAGES, "OK" if ok else "FAIL"))
+
+
+for size in (8, 128, 1024):
+    measure("before", receive_before, size)
+    measure("readinto", receive_now, size)
@@ -0,0 +1,21 @@
+'''
+benchutil.py
+Imported first by the benchmarks in tools, so they run unchanged on the PICO,
+on the MicroPython unix port and with CPython. On a PC it adds src and the
+stand-ins in tools/host to the path, see tools/host/hostshim.py. Run the
+benchmarks from the top folder:
+
+    mpremote run tools/bench_X.py
+    MICROPYPATH=src micropython tools/bench_X.py
+    python tools/bench_X.py
+
+On the PICO the modules of src must be copied to it, this module isn't needed
+there and the benchmarks carry on when it can't be imported.
+'''
+import sys
+
+if (sys.implementation.name != "micropython"):
+    import os
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "host"))
+    import hostshim
+    hostshim.install()
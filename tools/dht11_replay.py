@@ -0,0 +1,125 @@
+'''
+dht11_replay.py
+Replays DHT11 waveforms through the capture backends in dht11.py and reports
+the success rate and the time in microseconds per read for each backend.
+It also checks that decoding the pulses does not allocate any memory and
+exits with status 1 when it does.
+Run it on the PICO with the application files installed:
+
+    mpremote run tools/dht11_replay.py
+
+The waveforms are built from the DHT11 datasheet timing with random jitter.
+Waveforms captured from a real sensor can be added to WAVEFORMS, a waveform
+is the list of microseconds between the transitions of the data line.
+The viper and pulse backends read the pin hardware directly and can't be
+replayed, compare them on a real sensor with the counters in DHT11.
+'''
+import gc
+import random
+import time
+from machine import Pin
+
+from applog import APPLOG
+import dht11
+
+READS = 50 # Reads per backend and waveform
+
+
+def waveform(data, jitter=4):
+    '''
+    Returns the transitions for the 5 bytes in data, starting with the line
+    pulled up until the sensor responds
+    '''
+    def us(t):
+        return t + random.randint(-jitter, jitter)
+
+    w = [us(30), us(80), us(80)]
+    for byte in data:
+        for shift in range(7, -1, -1):
+            w.append(us(50))
+            w.append(us(70) if byte >> shift & 1 else us(26))
+    w.append(us(50)) # The sensor releases the line after the last bit
+    return w
+
+
+def frame(humidity, temperature):
+    return (humidity, 0, temperature, 0, (humidity + temperature) & 0xFF)
+
+
+WAVEFORMS = [waveform(frame(45, 21)), waveform(frame(60, 24), jitter=8), waveform(frame(33, 19), jitter=12)]
+
+
+class REPLAYPIN:
+    '''
+    Stands in for the data pin, the level follows the waveform in real time
+    from when the pin is made an input
+    '''
+    def __init__(self, transitions):
+        self._edges = []
+        t = 0
+        for d in transitions:
+            t += d
+            self._edges.append(t)
+        self._start = 0
+        self._next = 0
+
+    def init(self, mode, pull=None):
+        if (mode == Pin.IN):
+            self._start = time.ticks_us()
+            self._next = 0
+
+    def value(self, v=None):
+        elapsed = time.ticks_diff(time.ticks_us(), self._start)
+        while self._next < len(self._edges) and elapsed >= self._edges[self._next]:
+            self._next += 1
+        return 1 - (self._next & 1) if self._next < len(self._edges) else 1
+
+
+def run(capture):
+    log = APPLOG(log_level=APPLOG.FATAL)
+    ok = 0
+    total_us = 0
+    for w in WAVEFORMS:
+        sensor = dht11.DHT11(REPLAYPIN(w), log, capture=capture)
+        for _ in range(READS):
+            start = time.ticks_us()
+            try:
+                buffer = sensor._convert_pulses_to_buffer(sensor._capture_pulses())
+                sensor._verify_checksum(buffer)
+                ok += 1
+            except (dht11.InvalidPulseCount, dht11.InvalidChecksum):
+                pass
+            total_us += time.ticks_diff(time.ticks_us(), start)
+    reads = READS * len(WAVEFORMS)
+    print("{:8s} success {:5.1f}%  {:6d} us/read".format(capture, 100 * ok / reads, total_us // reads))
+
+
+def check_allocations():
+    '''
+    Decodes the waveforms as captured, the heap must not grow
+    '''
+    sensor = dht11.DHT11(REPLAYPIN([]), APPLOG(log_level=APPLOG.FATAL))
+    trains = []
+    for w in WAVEFORMS:
+        pulses = bytearray(dht11.EXPECTED_PULSES)
+        for i in range(dht11.EXPECTED_PULSES):
+            pulses[i] = w[i]
+        trains.append(pulses)
+
+    gc.collect()
+    gc.disable()
+    before = gc.mem_alloc()
+    for _ in range(READS):
+        for pulses in trains:
+            sensor._transitions[:] = pulses
+            sensor._verify_checksum(sensor._convert_pulses_to_buffer(sensor._pulses))
+    grown = gc.mem_alloc() - before
+    gc.enable()
+    print("decode   {} bytes allocated in {} decodes {}".format(grown, READS * len(trains), "OK" if grown == 0 else "FAIL"))
+    if (grown != 0):
+        raise SystemExit(1)
+
+
+for capture in (dht11.CAPTURE_PYTHON, dht11.CAPTURE_NATIVE):
+    run(capture)
+check_allocations()
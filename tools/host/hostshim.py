@@ -0,0 +1,76 @@
+'''
+hostshim.py
+Makes the modules in src and the benchmarks in tools importable on CPython:
+adds the MicroPython functions of the time and gc modules that CPython lacks,
+makes the u-prefixed module names point to the CPython modules, except usocket
+which has a stand-in in this folder, and puts src and the stand-ins of this
+folder on sys.path.
+
+    import hostshim
+    hostshim.install()
+'''
+import gc
+import os
+import sys
+import time
+
+HOST = os.path.dirname(os.path.abspath(__file__))
+SRC = os.path.join(HOST, "..", "..", "src")
+
+_TICKS_PERIOD = 0x40000000 # The ticks wrap around as on the PICO
+_TICKS_MAX = _TICKS_PERIOD - 1
+_start = time.monotonic_ns()
+
+
+def ticks_ms():
+    return ((time.monotonic_ns() - _start) // 1000000) & _TICKS_MAX
+
+
+def ticks_us():
+    return ((time.monotonic_ns() - _start) // 1000) & _TICKS_MAX
+
+
+def ticks_diff(a, b):
+    d = (a - b) & _TICKS_MAX
+    return d - _TICKS_PERIOD if d >= _TICKS_PERIOD // 2 else d
+
+
+def ticks_add(a, b):
+    return (a + b) & _TICKS_MAX
+
+
+def sleep_ms(ms):
+    time.sleep(ms / 1000)
+
+
+def sleep_us(us):
+    time.sleep(us / 1000000)
+
+
+def mem_alloc():
+    return 0 # Not known on CPython
+
+
+def mem_free():
+    return 0
+
+
+def install():
+    '''
+    Adds what is missing, nothing is replaced when running on MicroPython
+    '''
+    for f in (ticks_ms, ticks_us, ticks_diff, ticks_add, sleep_ms, sleep_us):
+        if (not hasattr(time, f.__name__)):
+            setattr(time, f.__name__, f)
+    for f in (mem_alloc, mem_free):
+        if (not hasattr(gc, f.__name__)):
+            setattr(gc, f.__name__, f)
+    for name in ("select", "time", "binascii", "errno", "heapq", "ssl"):
+        if ("u" + name not in sys.modules):
+            try:
+                sys.modules["u" + name] = __import__(name)
+            except ImportError:
+                pass
+    for path in (SRC, HOST):
+        if (path not in sys.path):
+            sys.path.insert(0, path)
@@ -0,0 +1,60 @@
+'''
+machine.py
+Stands in for the machine module of MicroPython when the application runs on
+a Linux PC, see tools/run_host.py. The pins keep their value, reset ends the
+program and the sensor pulses always time out.
+'''
+import sys
+import time
+
+
+class Pin:
+    IN = 0
+    OUT = 1
+    PULL_UP = 1
+    PULL_DOWN = 2
+
+    def __init__(self, id, mode=-1, pull=-1, value=None):
+        self._id = id
+        self._value = 0 if value is None else value
+
+    def init(self, mode=-1, pull=-1, value=None):
+        if (value is not None):
+            self._value = value
+
+    def value(self, v=None):
+        if (v is None):
+            return self._value
+        self._value = 1 if v else 0
+
+    def on(self):
+        self._value = 1
+
+    def off(self):
+        self._value = 0
+
+
+class RTC:
+    '''
+    The clock of the PC is used, setting it is ignored
+    '''
+    def datetime(self, dttm=None):
+        if (dttm is None):
+            tm = time.localtime()
+            return (tm[0], tm[1], tm[2], tm[6], tm[3], tm[4], tm[5], 0)
+
+
+def freq():
+    return 125000000
+
+
+def unique_id():
+    return b"\xe6\x61\x41\x04\x03\x4b\x2c\x22"
+
+
+def reset():
+    sys.exit("machine.reset()")
+
+
+def time_pulse_us(pin, pulse_level, timeout_us=1000000):
+    return -2 # No pulse started within the timeout
@@ -0,0 +1,49 @@
+'''
+network.py
+Stands in for the network module of MicroPython when the application runs on
+a Linux PC, see tools/run_host.py. The station interface is connected as
+soon as it is asked to connect, on the loopback address.
+'''
+STA_IF = 0
+AP_IF = 1
+
+STAT_IDLE = 0
+STAT_CONNECTING = 1
+STAT_WRONG_PASSWORD = -3
+STAT_NO_AP_FOUND = -2
+STAT_CONNECT_FAIL = -1
+STAT_GOT_IP = 3
+
+
+class WLAN:
+    def __init__(self, interface=STA_IF):
+        self._active = False
+        self._connected = False
+
+    def active(self, on=None):
+        if (on is not None):
+            self._active = on
+        return self._active
+
+    def connect(self, ssid=None, key=None):
+        self._connected = True
+
+    def disconnect(self):
+        self._connected = False
+
+    def deinit(self):
+        self._active = False
+        self._connected = False
+
+    def isconnected(self):
+        return self._connected
+
+    def status(self, param=None):
+        if (param == "rssi"):
+            if (not self._connected):
+                raise OSError(1)
+            return -50
+        return STAT_GOT_IP if self._connected else STAT_IDLE
+
+    def ifconfig(self):
+        return ("127.0.0.1", "255.0.0.0", "127.0.0.1", "127.0.0.1")
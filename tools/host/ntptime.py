@@ -0,0 +1,9 @@
+'''
+ntptime.py
+Stands in for the ntptime module when the application runs on a Linux PC,
+the clock of the PC is already set.
+'''
+
+
+def settime():
+    pass
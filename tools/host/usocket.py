@@ -0,0 +1,29 @@
+'''
+usocket.py
+Stands in for the usocket module of MicroPython when the application runs on
+a Linux PC, see tools/run_host.py. The sockets get the read, readinto and
+write methods of MicroPython, which return None when a non-blocking socket
+isn't ready.
+'''
+import socket as _socket
+from socket import *
+
+
+class socket(_socket.socket):
+    def read(self, n=-1):
+        try:
+            return self.recv(4096 if n < 0 else n)
+        except BlockingIOError:
+            return None
+
+    def readinto(self, buf, n=-1):
+        try:
+            return self.recv_into(buf, 0 if n < 0 else n)
+        except BlockingIOError:
+            return None
+
+    def write(self, buf, n=-1):
+        try:
+            return self.send(buf if n < 0 else memoryview(buf)[:n])
+        except BlockingIOError:
+            return None
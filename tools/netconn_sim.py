@@ -0,0 +1,216 @@
+'''
+netconn_sim.py
+Runs the connection state machine in src/netconn.py against a stand-in for
+the network module, with an access point that goes away and a signal that
+fades, and checks the state, the counters and the history NETCONN records.
+The clock is simulated so hours of polls run in a moment. Run it on a PC:
+
+    python tools/netconn_sim.py
+    python tools/netconn_sim.py --hours 24 --outages 10 --seed 3
+
+The stand-in only needs isconnected, active, connect, disconnect, status and
+ifconfig, any script of the access point can be tried by changing STUBWLAN.
+'''
+import argparse
+import os
+import random
+import sys
+import types
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+STAT_IDLE = 0
+STAT_CONNECTING = 1
+STAT_NO_AP_FOUND = -2
+STAT_GOT_IP = 3
+
+
+class CLOCK:
+    '''
+    Stands in for the time module of netconn.py, the time only moves with advance
+    '''
+    def __init__(self):
+        self.ms = 0
+
+    def ticks_ms(self):
+        return self.ms
+
+    def ticks_diff(self, a, b):
+        return a - b
+
+    def ticks_add(self, a, b):
+        return a + b
+
+    def time(self):
+        return 1700000000 + self.ms // 1000
+
+    def advance(self, ms):
+        self.ms += ms
+
+
+class STUBWLAN:
+    '''
+    Stands in for network.WLAN, the access point is away during the outages,
+    a connect takes connect_ms once the access point can be seen and the
+    signal strength drifts around rssi
+    '''
+    def __init__(self, clock, rnd, outages, connect_ms=(1500, 8000), rssi=-65):
+        self._clock = clock
+        self._rnd = rnd
+        self._outages = outages # List of (start ms, end ms)
+        self._connect_ms = connect_ms
+        self._rssi = rssi
+        self._connected_at = None # When the pending connect completes
+        self._active = False
+        self.connect_calls = 0
+
+    def _away(self):
+        now = self._clock.ms
+        return any(start <= now < end for start, end in self._outages)
+
+    def active(self, on=None):
+        if (on is not None):
+            self._active = on
+        return self._active
+
+    def connect(self, ssid, pwd):
+        self.connect_calls += 1
+        self._connected_at = self._clock.ms + self._rnd.randint(*self._connect_ms)
+
+    def disconnect(self):
+        self._connected_at = None
+
+    def deinit(self):
+        self._active = False
+
+    def isconnected(self):
+        if (self._connected_at is None or self._away()):
+            if (self._away()):
+                self._connected_at = None # The link is lost, a new connect is needed
+            return False
+        return self._clock.ms >= self._connected_at
+
+    def status(self, param=None):
+        if (param == "rssi"):
+            if (not self.isconnected()):
+                raise OSError(1)
+            self._rssi = max(-95, min(-30, self._rssi + self._rnd.randint(-2, 2)))
+            return self._rssi
+        if (self.isconnected()):
+            return STAT_GOT_IP
+        if (self._connected_at is None):
+            return STAT_NO_AP_FOUND if self._away() else STAT_IDLE
+        return STAT_CONNECTING
+
+    def ifconfig(self):
+        return ("192.168.1.20", "255.255.255.0", "192.168.1.1", "192.168.1.1")
+
+
+class STUBPIN:
+    OUT = 1
+
+    def __init__(self, *args, **kwargs):
+        self._value = 0
+
+    def value(self, v=None):
+        if (v is None):
+            return self._value
+        self._value = 1 if v else 0
+
+    def on(self):
+        self._value = 1
+
+    def off(self):
+        self._value = 0
+
+
+def install_stubs():
+    '''
+    Makes the stand-ins importable as the network and machine modules
+    '''
+    network = types.ModuleType("network")
+    network.STA_IF = 0
+    network.WLAN = None # Set per run, see run
+    sys.modules["network"] = network
+    try:
+        import machine
+        if (not hasattr(machine, "Pin")):
+            raise ImportError()
+    except ImportError:
+        machine = types.ModuleType("machine")
+        machine.Pin = STUBPIN
+        sys.modules["machine"] = machine
+    return network
+
+
+def run(args):
+    network = install_stubs()
+    import appconfig as params
+    params.APPLOG_CONSOLE = args.verbose
+    import netconn
+    from applog import APPLOG
+    from netconn import NETCONN
+
+    rnd = random.Random(args.seed)
+    clock = CLOCK()
+    end = int(args.hours * 3600 * 1000)
+    outages = []
+    for _ in range(args.outages):
+        start = rnd.randint(60000, max(60001, end - 60000))
+        outages.append((start, start + rnd.randint(5000, args.outage_max * 1000)))
+    outages.sort()
+    wlan = STUBWLAN(clock, rnd, outages)
+    network.WLAN = lambda interface: wlan
+    netconn.time = clock
+
+    conn = NETCONN(APPLOG(log_level=APPLOG.INFO))
+    events = []
+    conn.add_listener(lambda up: events.append((clock.ms, up)))
+    step = int(params.NETCONN_POLL_INTERVAL * 1000)
+    up_ms = 0
+    longest_gap = 0
+    gap_start = 0
+    while (clock.ms < end):
+        conn.poll()
+        if (conn.state == NETCONN.UP):
+            up_ms += step
+            if (gap_start is not None):
+                longest_gap = max(longest_gap, clock.ms - gap_start)
+                gap_start = None
+        elif (gap_start is None):
+            gap_start = clock.ms
+        clock.advance(step)
+
+    stats = conn.stats
+    print("{} outages, {} connect calls, up {:.1f}% of {} hours, longest time without link {} s".format(
+        len(outages), wlan.connect_calls, 100 * up_ms / end, args.hours, longest_gap // 1000))
+    for name, value in stats.items():
+        print("  {:18s} {}".format(name, value))
+    print("history, newest first")
+    for t, state, status, rssi in conn.history.records(args.history):
+        print("  {:6d} s {:10s} status {:3d} rssi {:4d}".format(t - 1700000000, NETCONN.STATES[state], status, rssi))
+
+    # The counters follow the listener calls, a link loss is always followed by a connect
+    ups = sum(1 for _, up in events if up)
+    downs = len(events) - ups
+    ok = (ups == stats["connects"] and downs == stats["link_losses"]
+          and stats["reconnects"] == ups - 1 and ups - downs in (0, 1)
+          and len(conn.history) <= params.NETCONN_HISTORY_SIZE
+          and all(-128 <= r[3] <= 0 for r in conn.history.records()))
+    print("OK" if ok else "FAIL")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate the WiFi connection state machine against a stub network module")
+    parser.add_argument("--hours", type=float, default=6, help="Simulated hours")
+    parser.add_argument("--outages", type=int, default=5, help="Times the access point goes away")
+    parser.add_argument("--outage-max", type=int, default=600, help="Max seconds of an outage")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--history", type=int, default=20, help="History records shown")
+    parser.add_argument("--verbose", action="store_true", help="Show the log messages")
+    sys.exit(0 if run(parser.parse_args()) else 1)
+
+
+if __name__ == "__main__":
+    main()
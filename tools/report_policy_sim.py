@@ -0,0 +1,112 @@
+'''
+report_policy_sim.py
+Replays recorded measures through the report policy in src/report_policy.py
+and reports the messages saved compared with publishing every measure on a
+fixed interval, and the error between the measures and the values last
+reported. Run it on a PC:
+
+    curl http://192.168.1.20/api/history.csv > trace.csv
+    python tools/report_policy_sim.py trace.csv
+    python tools/report_policy_sim.py trace.csv --temperature-deadband 0.3 --heartbeat 300
+    python tools/report_policy_sim.py  (a synthetic day with noise and a door left open)
+
+A trace has the lines time,temperature,humidity in any order, as returned
+by /api/history.csv. The settings default to the ones in src/appconfig.py.
+'''
+import argparse
+import math
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+import appconfig as params
+from report_policy import REPORT_POLICY
+
+
+def load(path):
+    samples = []
+    with open(path) as f:
+        for line in f:
+            fields = line.strip().split(",")
+            if (len(fields) != 3 or not fields[0].isdigit()):
+                continue # Header or damaged line
+            samples.append((int(fields[0]), float(fields[1]), float(fields[2])))
+    samples.sort()
+    return samples
+
+
+def synthetic(interval=params.DHT11_POLL_INTERVALL, hours=24, seed=1):
+    '''
+    A day of measures from the DHT11, a slow daily cycle, the 1 degree and
+    1 percent resolution of the sensor, and a window opened for 20 minutes.
+    The reads are filtered with the median of DHT11_MEDIAN_WINDOW reads as in dht11.py.
+    '''
+    rnd = random.Random(seed)
+    reads = []
+    for i in range(int(hours * 3600 / interval)):
+        t = i * interval
+        temperature = 21 + 2 * math.sin(2 * math.pi * t / 86400) + rnd.gauss(0, 0.3)
+        humidity = 45 + 5 * math.sin(2 * math.pi * t / 86400 + 1) + rnd.gauss(0, 0.8)
+        if (36000 <= t < 37200): # Window open
+            temperature -= 4 * min(1, (t - 36000) / 300)
+            humidity += 10 * min(1, (t - 36000) / 300)
+        reads.append((t, float(round(temperature)), float(round(humidity))))
+    window = max(1, params.DHT11_MEDIAN_WINDOW)
+    samples = []
+    for i in range(len(reads)):
+        last = reads[max(0, i - window + 1):i + 1]
+        samples.append((reads[i][0], sorted(r[1] for r in last)[len(last) // 2],
+                        sorted(r[2] for r in last)[len(last) // 2]))
+    return samples
+
+
+def simulate(samples, column, policy, interval):
+    '''
+    Returns (reports, fixed interval reports, max error, mean error) for one column
+    '''
+    policy.reset()
+    fixed = 0
+    last_fixed = None
+    errors = []
+    for sample in samples:
+        t, value = sample[0], sample[column]
+        policy.update(value, t)
+        errors.append(abs(value - policy.reported))
+        if (last_fixed is None or t - last_fixed >= interval):
+            fixed += 1
+            last_fixed = t
+    return policy.reports, fixed, max(errors), sum(errors) / len(errors)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate the MQTT report policy on recorded measures")
+    parser.add_argument("traces", nargs="*", help="CSV files time,temperature,humidity")
+    parser.add_argument("--interval", type=float, default=60, help="Seconds between publishes without the policy")
+    parser.add_argument("--temperature-deadband", type=float, default=params.MQTT_TEMPERATURE_DEADBAND)
+    parser.add_argument("--temperature-rate", type=float, default=params.MQTT_TEMPERATURE_RATE)
+    parser.add_argument("--humidity-deadband", type=float, default=params.MQTT_HUMIDITY_DEADBAND)
+    parser.add_argument("--humidity-rate", type=float, default=params.MQTT_HUMIDITY_RATE)
+    parser.add_argument("--heartbeat", type=float, default=params.MQTT_HEARTBEAT)
+    parser.add_argument("--min-spacing", type=float, default=params.MQTT_MIN_SPACING)
+    args = parser.parse_args()
+
+    traces = [(path, load(path)) for path in args.traces] or [("synthetic", synthetic())]
+    channels = (("temperature", 1, args.temperature_deadband, args.temperature_rate),
+                ("humidity", 2, args.humidity_deadband, args.humidity_rate))
+    print("{:16s} {:12s} {:>7s} {:>8s} {:>7s} {:>6s} {:>9s} {:>10s}".format(
+        "trace", "channel", "samples", "reports", "fixed", "saved", "max err", "mean err"))
+    for name, samples in traces:
+        if (not samples):
+            print("{:16s} no measures".format(name))
+            continue
+        for channel, column, deadband, rate in channels:
+            policy = REPORT_POLICY(deadband, rate, args.heartbeat, args.min_spacing)
+            reports, fixed, max_error, mean_error = simulate(samples, column, policy, args.interval)
+            print("{:16s} {:12s} {:7d} {:8d} {:7d} {:5.0f}% {:9.2f} {:10.3f}".format(
+                os.path.basename(name)[:16], channel, len(samples), reports, fixed,
+                100 * (1 - reports / fixed), max_error, mean_error))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+'''
+run_host.py
+Runs the application in src on a Linux PC with the stand-ins in tools/host
+for the machine, network, micropython and ntptime modules, to measure the web
+server and the tasks without a PICO. The WiFi is always connected on the
+loopback address, the sensor never answers so the measures are missing.
+The log and the MQTT queue are written in a temporary folder.
+
+    python tools/run_host.py --port 8080 --seconds 60
+    python tools/webload.py 127.0.0.1 --port 8080 --path /api/measures --seconds 10
+
+The latency is reported by webload.py, at the end the runner prints the CPU
+time used per second of wall time, run it once without load for the idle CPU.
+'''
+import argparse
+import os
+import runpy
+import signal
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "host"))
+import hostshim
+
+
+def stop(signum, frame):
+    raise KeyboardInterrupt("--seconds elapsed")
+
+
+def run(args):
+    hostshim.install()
+    import appconfig as params
+    params.listen_port = args.port
+    params.MQTT_BROKER = args.broker
+    params.APPLOG_CONSOLE = args.verbose
+    if (args.seconds):
+        signal.signal(signal.SIGALRM, stop)
+        signal.alarm(args.seconds)
+    main = os.path.join(hostshim.SRC, "main.py")
+    with tempfile.TemporaryDirectory() as workdir:
+        os.chdir(workdir)
+        wall = time.monotonic()
+        cpu = time.process_time()
+        try:
+            runpy.run_path(main, run_name="__main__")
+        except KeyboardInterrupt: # CTRL-C before main.py handles it
+            pass
+        wall = time.monotonic() - wall
+        cpu = time.process_time() - cpu
+    print("ran {:.1f} s, CPU {:.2f} s, {:.1f}% of one core".format(wall, cpu, 100 * cpu / max(wall, 0.001)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the application on a Linux PC with stub machine and network modules")
+    parser.add_argument("--port", type=int, default=8080, help="Port of the web server")
+    parser.add_argument("--broker", default="localhost", help="MQTT broker")
+    parser.add_argument("--seconds", type=int, default=0, help="Stop after this many seconds, 0 runs until CTRL-C")
+    parser.add_argument("--verbose", action="store_true", help="Show the log messages")
+    run(parser.parse_args())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+'''
+webload.py
+Load generator for the webserver on the PICO, run it on a PC on the same network.
+Opens a number of concurrent clients that request a page as fast as they can and
+reports requests per second and the latency percentiles.
+
+    python tools/webload.py 192.168.1.20 --path /api/measures --clients 4 --seconds 10
+    python tools/webload.py 192.168.1.20 --path /refresh? --keepalive
+'''
+import argparse
+import asyncio
+import time
+
+
+async def read_response(reader):
+    '''
+    Reads one response, returns the status code and whether the server keeps
+    the connection open
+    '''
+    status = await reader.readline()
+    if (not status):
+        raise ConnectionError("Connection closed")
+    code = int(status.split()[1])
+    length = None
+    chunked = False
+    keep_alive = False
+    while True:
+        line = await reader.readline()
+        if (line in (b"\r\n", b"\n", b"")):
+            break
+        name, _, value = line.decode().partition(":")
+        name = name.strip().lower()
+        value = value.strip().lower()
+        if (name == "content-length"):
+            length = int(value)
+        elif (name == "transfer-encoding"):
+            chunked = value == "chunked"
+        elif (name == "connection"):
+            keep_alive = value == "keep-alive"
+
+    if (code == 304):
+        pass
+    elif (chunked):
+        while True:
+            size = int((await reader.readline()).strip(), 16)
+            await reader.readexactly(size + 2)
+            if (size == 0):
+                break
+    elif (length is not None):
+        await reader.readexactly(length)
+    else:
+        await reader.read()
+        keep_alive = False
+    return code, keep_alive
+
+
+async def client(args, deadline, latencies, errors):
+    reader = writer = None
+    connection = "keep-alive" if args.keepalive else "close"
+    request = "GET {} HTTP/1.1\r\nHost: {}\r\nConnection: {}\r\n\r\n".format(args.path, args.host, connection).encode()
+    while time.monotonic() < deadline:
+        start = time.monotonic()
+        try:
+            if (writer is None):
+                reader, writer = await asyncio.wait_for(asyncio.open_connection(args.host, args.port), args.timeout)
+            writer.write(request)
+            code, keep_alive = await asyncio.wait_for(read_response(reader), args.timeout)
+            if (code in (200, 304)):
+                latencies.append(time.monotonic() - start)
+            else:
+                errors[code] = errors.get(code, 0) + 1
+        except (OSError, asyncio.TimeoutError, ConnectionError, ValueError, asyncio.IncompleteReadError) as e:
+            errors[type(e).__name__] = errors.get(type(e).__name__, 0) + 1
+            keep_alive = False
+        if (not keep_alive and writer is not None):
+            writer.close()
+            writer = None
+    if (writer is not None):
+        writer.close()
+
+
+def percentile(values, p):
+    if (not values):
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Load generator for the PICO webserver")
+    parser.add_argument("host")
+    parser.add_argument("--port", type=int, default=80)
+    parser.add_argument("--path", default="/api/measures")
+    parser.add_argument("--clients", type=int, default=4)
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--timeout", type=float, default=10)
+    parser.add_argument("--keepalive", action="store_true", help="Reuse connections (HTTP/1.1 keep-alive)")
+    args = parser.parse_args()
+
+    latencies = []
+    errors = {}
+    start = time.monotonic()
+    deadline = start + args.seconds
+    await asyncio.gather(*(client(args, deadline, latencies, errors) for _ in range(args.clients)))
+    elapsed = time.monotonic() - start
+
+    latencies.sort()
+    print("requests  {}".format(len(latencies)))
+    print("req/s     {:.1f}".format(len(latencies) / elapsed))
+    print("p50 ms    {:.1f}".format(percentile(latencies, 50) * 1000))
+    print("p99 ms    {:.1f}".format(percentile(latencies, 99) * 1000))
+    print("max ms    {:.1f}".format(latencies[-1] * 1000 if latencies else 0.0))
+    print("errors    {}".format(errors if errors else 0))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())